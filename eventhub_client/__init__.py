@@ -1,2 +1,2 @@
-from .publisher import Publisher
+from .publisher import Publisher,BufferedPublisher
 from .subscriber import Subscriber
@@ -0,0 +1,2 @@
+from .publisher import AsyncPublisher
+from .subscriber import AsyncSubscriber
@@ -0,0 +1,57 @@
+import json
+import asyncio
+
+import asyncpg
+
+from eventhub_utils import env
+
+from .. import settings
+
+POOL_MIN_SIZE = env("EVENTHUB_AIO_POOL_MIN_SIZE",1)
+POOL_MAX_SIZE = env("EVENTHUB_AIO_POOL_MAX_SIZE",10)
+
+def _connect_kwargs():
+    return {
+        "database":settings.DatabaseConfig.default["dbname"],
+        "user":settings.DatabaseConfig.default["user"],
+        "password":settings.DatabaseConfig.default["password"],
+        "host":settings.DatabaseConfig.default["host"],
+        "port":settings.DatabaseConfig.default["port"]
+    }
+
+async def _init_connection(connection):
+    #decode json columns into python objects, the same as JSONField
+    for json_type in ("json","jsonb"):
+        await connection.set_type_codec(json_type,encoder=json.dumps,decoder=json.loads,schema="pg_catalog")
+
+async def connect():
+    """
+    Return a dedicated connection which is not managed by the pool, used to listen the notifications
+    """
+    connection = await asyncpg.connect(**_connect_kwargs())
+    await _init_connection(connection)
+    return connection
+
+class DatabasePool(object):
+    _pool = None
+    _lock = None
+
+    @classmethod
+    async def get(cls):
+        """
+        Return the process-wide connection pool, created on first use
+        """
+        if cls._pool is None:
+            if cls._lock is None:
+                cls._lock = asyncio.Lock()
+            async with cls._lock:
+                if cls._pool is None:
+                    cls._pool = await asyncpg.create_pool(min_size=POOL_MIN_SIZE,max_size=POOL_MAX_SIZE,init=_init_connection,**_connect_kwargs())
+        return cls._pool
+
+    @classmethod
+    async def close(cls):
+        if cls._pool is not None:
+            pool = cls._pool
+            cls._pool = None
+            await pool.close()
@@ -0,0 +1,101 @@
+import logging
+
+from eventhub_utils import timezone
+
+from .. import settings
+from .. import models
+from .database import DatabasePool
+
+logger = logging.getLogger(__name__)
+
+class AsyncPublisher(object):
+    """
+    The asyncio version of eventhub_client.Publisher.
+    Create it with 'await AsyncPublisher.create(publisher,event_type)'
+    """
+    def __init__(self,publisher,event_type,pool):
+        """
+        publisher: the publisher name
+        event_type: the event type name
+        """
+        self.publisher = publisher
+        self.event_type = event_type
+        self.host = settings.HOSTNAME
+        self._pool = pool
+        self._sample_saved = False
+
+    @classmethod
+    async def create(cls,publisher,event_type,pool=None):
+        """
+        Create the publisher and event type if not exist, and return the AsyncPublisher object
+        """
+        publisher = publisher.name if isinstance(publisher,models.Publisher) else publisher
+        event_type = event_type.name if isinstance(event_type,models.EventType) else event_type
+        pool = pool or await DatabasePool.get()
+        obj = cls(publisher,event_type,pool)
+        async with pool.acquire() as conn:
+            now = timezone.now()
+            user = models.User.PROGRAMMATIC.id
+            await conn.execute("""
+INSERT INTO publisher (name,category,active,active_modifier_id,active_modified,modifier_id,modified,creator_id,created)
+VALUES ($1,$2,true,$3,$4::timestamptz,$3,$4::timestamptz,$3,$4::timestamptz)
+ON CONFLICT (name) DO NOTHING
+""",publisher,models.PROGRAMMATIC,user,now)
+            await conn.execute("""
+INSERT INTO event_type (name,publisher_id,category,active,sample,active_modifier_id,active_modified,modifier_id,modified,creator_id,created)
+VALUES ($1,$2,$3,true,NULL,$4,$5::timestamptz,$4,$5::timestamptz,$4,$5::timestamptz)
+ON CONFLICT (name) DO NOTHING
+""",event_type,publisher,models.PROGRAMMATIC,user,now)
+            obj._sample_saved = await conn.fetchval("SELECT sample IS NOT NULL FROM event_type WHERE name = $1",event_type)
+        return obj
+
+    async def _save_sample(self,conn,payload):
+        if self._sample_saved:
+            return
+        await conn.execute("UPDATE event_type SET sample = $2 WHERE name = $1 AND sample IS NULL",self.event_type,payload)
+        self._sample_saved = True
+
+    async def publish(self, payload):
+        """
+        payload
+        Return the created event object
+        """
+        publish_time = timezone.now()
+        async with self._pool.acquire() as conn:
+            async with conn.transaction():
+                await self._save_sample(conn,payload)
+                event_id = await conn.fetchval("""
+INSERT INTO event (publisher_id,event_type_id,active,source,publish_time,payload)
+VALUES ($1,$2,true,$3,$4::timestamptz,$5)
+RETURNING id
+""",self.publisher,self.event_type,self.host,publish_time,payload)
+
+        publisher = models.Publisher(name=self.publisher)
+        return models.Event(
+            id=event_id,
+            publisher=publisher,
+            event_type=models.EventType(name=self.event_type,publisher=publisher),
+            active=True,
+            source=self.host,
+            publish_time=publish_time,
+            payload=payload
+        )
+
+    async def publish_many(self, payloads):
+        """
+        payloads: a list of payload
+        Publish all the payloads with one multi-row insert statement
+        Return the list of created event ids with the same order as payloads
+        """
+        payloads = list(payloads)
+        if not payloads:
+            return []
+        async with self._pool.acquire() as conn:
+            async with conn.transaction():
+                await self._save_sample(conn,payloads[0])
+                rows = await conn.fetch("""
+INSERT INTO event (publisher_id,event_type_id,active,source,publish_time,payload)
+SELECT $1,$2,true,$3,$4::timestamptz,p.payload FROM json_array_elements($5::json) WITH ORDINALITY AS p(payload,seq) ORDER BY p.seq
+RETURNING id
+""",self.publisher,self.event_type,self.host,timezone.now(),payloads)
+        return [row["id"] for row in rows]
@@ -0,0 +1,347 @@
+import os
+import json
+import asyncio
+import collections
+import inspect
+import logging
+import traceback
+
+from eventhub_utils import timezone
+
+from .. import settings
+from .. import models
+from .database import DatabasePool,connect
+
+logger = logging.getLogger(__name__)
+
+MISSED_EVENTS_SQL = """
+SELECT id FROM event WHERE event_type_id = $1 AND id > $2 ORDER BY id LIMIT $3
+"""
+
+#the due failed events and the processing events which maybe timeout, paged after ($4,$5) with the index on 'next_retry_at'
+RETRY_EVENTS_SQL = """
+SELECT event_id,next_retry_at FROM subscribed_event
+WHERE subscriber_id = $1 AND event_type_id = $2 AND next_retry_at <= $3::timestamptz
+AND ($4::timestamptz IS NULL OR (next_retry_at,event_id) > ($4::timestamptz,$5::bigint))
+ORDER BY next_retry_at,event_id LIMIT $6
+"""
+
+class Subscription(object):
+    def __init__(self,subscribed_event_type,event_type_name,callback,concurrency):
+        self.id = subscribed_event_type["id"]
+        self.publisher = subscribed_event_type["publisher_id"]
+        self.event_type = subscribed_event_type["event_type_id"]
+        self.replay_missed_events = subscribed_event_type["replay_missed_events"]
+        self.replay_failed_events = subscribed_event_type["replay_failed_events"]
+        self.last_dispatched_event_id = subscribed_event_type["last_dispatched_event_id"]
+        self.last_listening_time = subscribed_event_type["last_listening_time"]
+        self.event_type_name = event_type_name
+        self.callback = callback
+        #bound the number of events processed concurrently for this event type
+        self.semaphore = asyncio.Semaphore(concurrency)
+        self.tasks = set()
+        #the notified event ids waiting for the semaphore, and the task creating their processing tasks
+        self.pending = collections.deque()
+        self.dispatcher = None
+        #the task retrying the due events, one at a time
+        self.retrier = None
+
+class AsyncSubscriber(object):
+    """
+    The asyncio version of eventhub_client.Subscriber.
+    All subscriptions share one listening connection and the connection pool; the events are processed in tasks,
+    and the number of events processed concurrently is bounded per event type.
+    Create it with 'await AsyncSubscriber.create(subscriber)'
+    """
+    REPLAY_PAGE_SIZE = 100
+
+    def __init__(self,subscriber,pool,concurrency=10,check_interval=5):
+        """
+        subscriber: the subscriber name
+        concurrency: the default maximum number of events processed concurrently per event type
+        check_interval: the seconds between checking the listening connection
+        """
+        self.subscriber = subscriber
+        self._pool = pool
+        self._host = settings.HOSTNAME
+        self._concurrency = concurrency
+        self._check_interval = check_interval
+        self._subscriptions = {}
+        self._connection = None
+        self._supervisor = None
+
+    @classmethod
+    async def create(cls,subscriber,concurrency=10,check_interval=5,pool=None,category=models.PROGRAMMATIC):
+        """
+        Create the subscriber if not exist, and return the AsyncSubscriber object
+        """
+        subscriber = subscriber.name if isinstance(subscriber,models.Subscriber) else subscriber
+        pool = pool or await DatabasePool.get()
+        async with pool.acquire() as conn:
+            now = timezone.now()
+            user = models.User.PROGRAMMATIC.id
+            await conn.execute("""
+INSERT INTO subscriber (name,category,active,active_modifier_id,active_modified,modifier_id,modified,creator_id,created)
+VALUES ($1,$2,true,$3,$4::timestamptz,$3,$4::timestamptz,$3,$4::timestamptz)
+ON CONFLICT (name) DO NOTHING
+""",subscriber,category,user,now)
+        return cls(subscriber,pool,concurrency=concurrency,check_interval=check_interval)
+
+    @property
+    def has_subscription(self):
+        return True if self._subscriptions else False
+
+    def subscribed(self,event_type_name):
+        """
+        event_type_name: 'publisher.event_type'
+        """
+        return event_type_name in self._subscriptions
+
+    async def _listen_connection(self):
+        if self._connection is None or self._connection.is_closed():
+            logger.info("Try to connect to database")
+            self._connection = await connect()
+            for subscription in self._subscriptions.values():
+                await self._connection.add_listener(subscription.event_type_name,self._on_notification)
+        return self._connection
+
+    async def subscribe(self,event_type,callback,concurrency=None):
+        """
+        event_type: the event type name
+        callback: a coroutine function or a function with one parameter 'event'
+        concurrency: the maximum number of events processed concurrently for this event type
+        Return True if subscribed successfully; return False if already subscribed
+        """
+        event_type = event_type.name if isinstance(event_type,models.EventType) else event_type
+        async with self._pool.acquire() as conn:
+            publisher = await conn.fetchval("SELECT publisher_id FROM event_type WHERE name = $1",event_type)
+            if publisher is None:
+                raise Exception("Event type({}) does not exist".format(event_type))
+            event_type_name = "{}.{}".format(publisher,event_type)
+            if event_type_name in self._subscriptions:
+                self._subscriptions[event_type_name].callback = callback
+                return False
+
+            now = timezone.now()
+            user = models.User.PROGRAMMATIC.id
+            subscribed_event_type = await conn.fetchrow("""
+WITH inserted AS (
+    INSERT INTO subscribed_event_type (subscriber_id,publisher_id,event_type_id,category,replay_missed_events,replay_failed_events,active,active_modifier_id,active_modified,modifier_id,modified,creator_id,created)
+    SELECT s.name,$2,$3,s.category,true,true,true,$4,$5::timestamptz,$4,$5::timestamptz,$4,$5::timestamptz FROM subscriber AS s
+    WHERE s.name = $1 AND NOT EXISTS (SELECT 1 FROM subscribed_event_type WHERE subscriber_id = $1 AND publisher_id = $2 AND event_type_id = $3)
+    RETURNING *
+)
+SELECT * FROM inserted
+UNION ALL
+SELECT * FROM subscribed_event_type WHERE subscriber_id = $1 AND publisher_id = $2 AND event_type_id = $3
+LIMIT 1
+""",self.subscriber,publisher,event_type,user,now)
+
+            subscription = Subscription(subscribed_event_type,event_type_name,callback,concurrency or self._concurrency)
+            self._subscriptions[event_type_name] = subscription
+            listen_connection = await self._listen_connection()
+            await listen_connection.add_listener(event_type_name,self._on_notification)
+            await conn.execute("UPDATE subscribed_event_type SET last_listening_time = $2::timestamptz WHERE id = $1",subscription.id,timezone.now())
+        logger.info("Listen to {}".format(event_type_name))
+
+        self._spawn(subscription,self._replay(subscription))
+        return True
+
+    async def unsubscribe(self,event_type_name,wait=True):
+        """
+        event_type_name: 'publisher.event_type'
+        Return true if unsubscribed successfully; return False if not subscribed before
+        """
+        subscription = self._subscriptions.pop(event_type_name,None)
+        if not subscription:
+            return False
+        try:
+            if self._connection and not self._connection.is_closed():
+                await self._connection.remove_listener(event_type_name,self._on_notification)
+            logger.info("Stop listen to {}".format(event_type_name))
+        except:
+            logger.error(traceback.format_exc())
+        if wait and subscription.tasks:
+            await asyncio.gather(*subscription.tasks,return_exceptions=True)
+        return True
+
+    def _spawn(self,subscription,coro):
+        task = asyncio.ensure_future(coro)
+        subscription.tasks.add(task)
+        task.add_done_callback(subscription.tasks.discard)
+        return task
+
+    def _on_notification(self,connection,pid,channel,payload):
+        subscription = self._subscriptions.get(channel)
+        if not subscription:
+            #not listening this event type. skip
+            logger.info("The subscriber({}) is not listening this event type ({}), skip the event({}).".format(self.subscriber,channel,payload))
+            return
+        subscription.pending.append(json.loads(payload)["id"])
+        if not subscription.dispatcher:
+            subscription.dispatcher = self._spawn(subscription,self._dispatch(subscription))
+
+    async def _dispatch(self,subscription):
+        """
+        Create the processing tasks of the notified events; the task is created after the semaphore is acquired,
+        so the number of tasks is bounded by the concurrency
+        """
+        try:
+            while subscription.pending:
+                await subscription.semaphore.acquire()
+                self._spawn(subscription,self._run(subscription,subscription.pending.popleft()))
+        finally:
+            subscription.dispatcher = None
+
+    async def _run(self,subscription,event_id):
+        """
+        Process the event and release the semaphore acquired by the dispatcher
+        """
+        try:
+            await self.process_event(subscription,event_id)
+        except:
+            logger.error("Failed to process the event({}) for {}.{}".format(event_id,self.subscriber,traceback.format_exc()))
+        finally:
+            subscription.semaphore.release()
+
+    async def _process(self,subscription,event_id):
+        async with subscription.semaphore:
+            try:
+                await self.process_event(subscription,event_id)
+            except:
+                logger.error("Failed to process the event({}) for {}.{}".format(event_id,self.subscriber,traceback.format_exc()))
+
+    async def process_event(self,subscription,event_id):
+        """
+        Return True if processed; return False if the event does not exist
+        """
+        #claim and complete the event with the statements of eventhub_client.Subscriber with the typed numbered parameters,
+        #so the retry time, the backoff and the dead events are the same as the sync subscriber
+        claim = models.SubscribedEvent.CLAIM_STATEMENT
+        async with self._pool.acquire() as conn:
+            row = await conn.fetchrow(claim.numbered_sql,*claim.values(models.SubscribedEvent.claim_params(self.subscriber,[event_id],self._host,os.getpid())))
+        if not row:
+            return False
+        subscribed_event_id,created = row[6],row[7]
+        if not subscribed_event_id:
+            #already processed or is processing by other process,treat it as processed
+            return True
+
+        event = models.Event.from_row(row)
+        now = timezone.now()
+        callback = subscription.callback
+        try:
+            if inspect.iscoroutinefunction(callback):
+                result = await callback(event)
+            else:
+                #run the sync callback in the default executor, so it doesn't block the event loop
+                result = await asyncio.get_event_loop().run_in_executor(None,callback,event)
+                if inspect.isawaitable(result):
+                    result = await result
+            status = models.SubscribedEvent.SUCCEED
+            result = json.dumps(result)
+        except:
+            status = models.SubscribedEvent.FAILED
+            result = traceback.format_exc()
+
+        complete = models.SubscribedEvent.COMPLETE_STATEMENT
+        async with self._pool.acquire() as conn:
+            last_dispatched = await conn.fetchrow(complete.numbered_sql,*complete.values(models.SubscribedEvent.complete_params(
+                [(subscribed_event_id,status,result)],subscription.id,event.id if created else None,now
+            )))
+        if last_dispatched:
+            #update the local value with the latest value in database
+            subscription.last_dispatched_event_id = last_dispatched[0]
+        return True
+
+    async def _replay(self,subscription):
+        if subscription.replay_missed_events:
+            #replay failed event only if replay missed events is enabled
+            await self._replay_failed_events(subscription)
+        await self._replay_missed_events(subscription)
+
+    async def _process_page(self,subscription,event_ids):
+        await asyncio.gather(*[self._process(subscription,event_id) for event_id in event_ids])
+
+    async def _replay_missed_events(self,subscription):
+        if not subscription.replay_missed_events:
+            return
+        last_event_id = subscription.last_dispatched_event_id or 0
+        while subscription.event_type_name in self._subscriptions:
+            async with self._pool.acquire() as conn:
+                event_ids = [row["id"] for row in await conn.fetch(MISSED_EVENTS_SQL,subscription.event_type,last_event_id,self.REPLAY_PAGE_SIZE)]
+            if not event_ids:
+                break
+            await self._process_page(subscription,event_ids)
+            last_event_id = event_ids[-1]
+
+    async def _replay_failed_events(self,subscription):
+        """
+        Retry the due failed events and the processing events which maybe timeout, page by page
+        """
+        if not subscription.replay_failed_events:
+            return
+        until = timezone.now()
+        after = (None,None)
+        while subscription.event_type_name in self._subscriptions:
+            async with self._pool.acquire() as conn:
+                rows = await conn.fetch(RETRY_EVENTS_SQL,self.subscriber,subscription.event_type,until,after[0],after[1],self.REPLAY_PAGE_SIZE)
+            if not rows:
+                break
+            await self._process_page(subscription,[row["event_id"] for row in rows])
+            if len(rows) < self.REPLAY_PAGE_SIZE:
+                break
+            after = (rows[-1]["next_retry_at"],rows[-1]["event_id"])
+
+    def _retry(self,subscription):
+        """
+        Retry the due events of the subscription if it's not retrying
+        """
+        if subscription.retrier is None or subscription.retrier.done():
+            subscription.retrier = self._spawn(subscription,self._replay_failed_events(subscription))
+
+    async def _supervise(self):
+        """
+        Reconnect the listening connection if broken and retry the due events periodically
+        """
+        while True:
+            await asyncio.sleep(self._check_interval)
+            try:
+                if self._connection is None or self._connection.is_closed():
+                    await self._listen_connection()
+                    #the notifications are lost during reconnecting, replay the missed events
+                    for subscription in list(self._subscriptions.values()):
+                        self._spawn(subscription,self._replay(subscription))
+                #the due events are fetched with the index on 'next_retry_at', only the failed events whose backoff is over are retried
+                for subscription in list(self._subscriptions.values()):
+                    self._retry(subscription)
+            except asyncio.CancelledError:
+                raise
+            except:
+                logger.error(traceback.format_exc())
+
+    @property
+    def started(self):
+        return self._supervisor is not None and not self._supervisor.done()
+
+    async def start(self):
+        if not self.started:
+            await self._listen_connection()
+            self._supervisor = asyncio.ensure_future(self._supervise())
+
+    async def close(self):
+        """
+        Stop listening, and wait for the events being processed
+        """
+        if self._supervisor:
+            self._supervisor.cancel()
+            try:
+                await self._supervisor
+            except asyncio.CancelledError:
+                pass
+            self._supervisor = None
+        for event_type_name in list(self._subscriptions.keys()):
+            await self.unsubscribe(event_type_name)
+        if self._connection:
+            await self._connection.close()
+            self._connection = None
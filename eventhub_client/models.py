@@ -1,13 +1,23 @@
-from datetime import timedelta
+from datetime import timedelta,datetime
 import imp
+import time
+import json
+import select
+import logging
+import traceback
+import collections
+from threading import Thread,Lock
 
 import peewee as models
 from playhouse.postgres_ext import JSONField
 
 from eventhub_utils import timezone,cachedclassproperty,classproperty,hashvalue
+from eventhub_utils.database import PreparedStatement
 
 from . import settings
 
+logger = logging.getLogger(__name__)
+
 PROGRAMMATIC = 1
 MANAGED = 2
 SYSTEM = 999
@@ -22,6 +32,40 @@ CATEGORY_CHOICES = (
     (UNITESTING,"Unitesting")
 )
 
+#the compiled code objects of the event processing modules, (module name,code hash) -> code object
+_compiled_codes = collections.OrderedDict()
+_compiled_codes_lock = Lock()
+
+def compile_callback_code(module_name,code):
+    """
+    Return the compiled code object of the event processing code.
+    The code objects are cached and evicted by LRU, so the same code is compiled once per process
+    """
+    key = (module_name,hashvalue(code))
+    with _compiled_codes_lock:
+        compiled = _compiled_codes.get(key)
+        if compiled:
+            _compiled_codes.move_to_end(key)
+            return compiled
+
+    compiled = compile(code,"<{}>".format(module_name),"exec")
+    with _compiled_codes_lock:
+        _compiled_codes[key] = compiled
+        while len(_compiled_codes) > settings.CALLBACK_CODE_CACHE_SIZE:
+            _compiled_codes.popitem(last=False)
+    return compiled
+
+def load_callback_module(module_name,code,parameters=None):
+    """
+    Create a module from the event processing code and set the parameters as the module attributes
+    """
+    m = imp.new_module(module_name)
+    exec(compile_callback_code(module_name,code),m.__dict__)
+    if parameters:
+        for k,v in parameters.items():
+            setattr(m,k,v)
+    return m
+
 class BaseModel(models.Model):
     @classproperty
     def table_name(cls):
@@ -72,6 +116,142 @@ except:
     pass
 
 
+#the model caches, table name -> ModelCache
+MODEL_CACHES = {}
+
+class ModelCache(object):
+    """
+    A thread safe in-process cache of the rarely changed model objects, keyed by primary key.
+    The objects expire after ttl seconds and are evicted by LRU if the cache is full;
+    they are also invalidated by the notifications from the channel settings.MODEL_CACHE_CHANNEL when the rows are changed.
+    The cached objects are shared by threads, don't change them.
+    """
+    def __init__(self,model,maxsize=settings.MODEL_CACHE_SIZE,ttl=settings.MODEL_CACHE_TTL):
+        self.model = model
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._lock = Lock()
+        #pk -> (expire time,object)
+        self._objects = collections.OrderedDict()
+        #increased when invalidated, the objects loaded before the invalidation are not cached
+        self._generation = 0
+        MODEL_CACHES[model._meta.table_name] = self
+
+    def get(self,pk):
+        """
+        Return the cached object; load it from database if not cached or expired.
+        Raise DoesNotExist if not found
+        """
+        with self._lock:
+            item = self._objects.get(pk)
+            if item and item[0] > time.time():
+                self._objects.move_to_end(pk)
+                return item[1]
+            generation = self._generation
+
+        ModelCacheInvalidator.ensure_started()
+        with self.model.database.active_context():
+            obj = self.model.get_by_id(pk)
+        self.put(obj,generation)
+        return obj
+
+    def get_or_create(self,pk,defaults):
+        """
+        Return the cached object; create it with the defaults if not exist
+        """
+        try:
+            return self.get(pk)
+        except self.model.DoesNotExist:
+            with self._lock:
+                generation = self._generation
+            with self.model.database.active_context():
+                obj = self.model.get_or_create(**{self.model._meta.primary_key.name:pk},defaults=defaults)[0]
+            self.put(obj,generation)
+            return obj
+
+    def put(self,obj,generation=None):
+        """
+        generation: the generation when the object was loaded; the object is not cached if the cache was invalidated after that
+        """
+        with self._lock:
+            if generation is not None and generation != self._generation:
+                return
+            pk = obj._pk
+            self._objects[pk] = (time.time() + self.ttl,obj)
+            self._objects.move_to_end(pk)
+            while len(self._objects) > self.maxsize:
+                self._objects.popitem(last=False)
+
+    def invalidate(self,pk=None):
+        """
+        Remove the object from the cache; remove all objects if pk is None
+        """
+        with self._lock:
+            self._generation += 1
+            if pk is None:
+                self._objects.clear()
+            else:
+                self._objects.pop(pk,None)
+
+class ModelCacheInvalidator(Thread):
+    """
+    Listen to the channel settings.MODEL_CACHE_CHANNEL and invalidate the cached objects.
+    The notification payload is {"table":table name,"id":primary key}, sent by the triggers created with eventhub_client.schema.
+    All caches are invalidated after reconnecting, because the notifications are lost when the connection is broken.
+    """
+    _instance = None
+    _lock = Lock()
+
+    def __init__(self):
+        super().__init__(name="Model Cache Invalidator",daemon=True)
+
+    @classmethod
+    def ensure_started(cls):
+        if cls._instance or not settings.MODEL_CACHE_LISTEN:
+            return
+        with cls._lock:
+            if not cls._instance:
+                cls._instance = ModelCacheInvalidator()
+                cls._instance.start()
+
+    def invalidate_all(self):
+        for cache in MODEL_CACHES.values():
+            cache.invalidate()
+
+    def run(self):
+        database = settings.Database.Default.get("model_cache_invalidator",thread_safe=False)
+        while True:
+            try:
+                database.connect(reuse_if_open=True)
+                connection = database.connection()
+                connection.autocommit = True
+                with connection.cursor() as cur:
+                    cur.execute('LISTEN "{}";'.format(settings.MODEL_CACHE_CHANNEL))
+                #the changes may be missed before listening
+                self.invalidate_all()
+                while True:
+                    if select.select([connection],[],[],settings.MODEL_CACHE_TTL) == ([],[],[]):
+                        continue
+                    connection.poll()
+                    if not connection.notifies:
+                        continue
+                    #take all the received notifications at once
+                    notifies = connection.notifies
+                    connection.notifies = []
+                    for notify_event in notifies:
+                        notify = json.loads(notify_event.payload)
+                        cache = MODEL_CACHES.get(notify["table"])
+                        if cache:
+                            cache.invalidate(notify["id"])
+            except:
+                logger.error("The model cache invalidator is broken, try again after 2 seconds.{}".format(traceback.format_exc()))
+                self.invalidate_all()
+                try:
+                    database.close()
+                except:
+                    pass
+                time.sleep(2)
+
 class AuditModel(BaseModel):
     creator = models.ForeignKeyField(User,null=False)
     created = models.DateTimeField(default=timezone.now)
@@ -96,6 +276,8 @@ class Publisher(ActiveModel):
     class Meta:
         table_name = 'publisher'
 
+Publisher.cache = ModelCache(Publisher)
+
 class EventType(ActiveModel):
     name = models.CharField(max_length=32,null=False,primary_key=True)
     publisher = models.ForeignKeyField(Publisher,null=False,backref="event_types")
@@ -109,6 +291,8 @@ class EventType(ActiveModel):
     class Meta:
         table_name = 'event_type'
 
+EventType.cache = ModelCache(EventType)
+
 
 class Event(BaseModel):
     publisher = models.ForeignKeyField(Publisher,null=False,backref="publisher_events")
@@ -118,12 +302,68 @@ class Event(BaseModel):
     publish_time = models.DateTimeField(default=timezone.now)
     payload = JSONField(null=False)
 
+    GET_STATEMENT = PreparedStatement("eventhub_get_event",
+        "SELECT id,publisher_id,event_type_id,source,publish_time,payload FROM event WHERE id = %(id)s",
+        [("id","bigint")],
+        prepare=settings.DB_PREPARED_STATEMENTS
+    )
+
+    @classmethod
+    def from_row(cls,row):
+        """
+        Create the event from the row (id,publisher_id,event_type_id,source,publish_time,payload);
+        publish_time is converted into the configured timezone, the same as the event created from the notification
+        """
+        publisher = Publisher(name=row[1])
+        publish_time = row[4]
+        if publish_time is not None and publish_time.tzinfo is not None:
+            publish_time = publish_time.astimezone(settings.TZ)
+        return cls(
+            id=row[0],
+            publisher=publisher,
+            event_type=EventType(name=row[2],publisher=publisher),
+            source=row[3],
+            publish_time=publish_time,
+            payload=row[5]
+        )
+
+    @classmethod
+    def from_notification(cls,notification):
+        """
+        Create the event from the notification payload sent by the trigger created with eventhub_client.schema.
+        Return None if the event is not inlined in the notification
+        """
+        if "payload" not in notification:
+            return None
+        return cls.from_row((
+            notification["id"],
+            notification["publisher"],
+            notification["event_type"],
+            notification["source"],
+            datetime.fromtimestamp(notification["publish_time"],tz=settings.TZ),
+            notification["payload"]
+        ))
+
+    @classmethod
+    def fetch(cls,pk):
+        """
+        Load the event with the prepared statement; only the columns used by the subscribers are loaded.
+        Raise Event.DoesNotExist if not found
+        """
+        row = cls.GET_STATEMENT.execute(cls.database,{"id":pk}).fetchone()
+        if not row:
+            raise cls.DoesNotExist("Event({}) doesn't exist".format(pk))
+        return cls.from_row(row)
 
     def __str__(self):
         return "{}({})".format(self.event_type,self.id)
 
     class Meta:
         table_name = 'event'
+        indexes = (
+            #replay the missed events of an event type by id
+            (("event_type","id"),False),
+        )
 
 class EventProcessingModule(ActiveModel):
     name = models.CharField(max_length=64,null=False,unique=True)
@@ -132,12 +372,20 @@ class EventProcessingModule(ActiveModel):
     comments = models.TextField(null=True)
 
 
+    @property
+    def code_hash(self):
+        if not hasattr(self,"_code_hash"):
+            self._code_hash = hashvalue(self.code) if self.code else None
+        return self._code_hash
+
     def __str__(self):
         return self.name
 
     class Meta(object):
         db_table = "event_processing_module"
 
+EventProcessingModule.cache = ModelCache(EventProcessingModule)
+
 
 class Subscriber(ActiveModel):
     name = models.CharField(max_length=32,null=False,primary_key=True)
@@ -150,6 +398,8 @@ class Subscriber(ActiveModel):
     class Meta:
         table_name = 'subscriber'
 
+Subscriber.cache = ModelCache(Subscriber)
+
 class SubscribedEventType(ActiveModel):
     subscriber = models.ForeignKeyField(Subscriber,null=False,backref="event_types")
     publisher = models.ForeignKeyField(Publisher,null=False,backref="subscribed_publisher_event_types")
@@ -172,33 +422,43 @@ class SubscribedEventType(ActiveModel):
     def is_editable(self):
         return self.category in (MANAGED,TESTING)
 
+    @property
+    def processing_module(self):
+        """
+        Return the cached event processing module; return None if not configured
+        """
+        if not self.event_processing_module_id:
+            return None
+        return EventProcessingModule.cache.get(self.event_processing_module_id)
+
     @property
     def callback_module(self):
         """
         Return the configured callback if have; otherwise, return None
         throw exception if not configured properly.
+        The module is reloaded if the code of the event processing module is changed
         """
-        if not hasattr(self,"_callback_module"):
-            if not self.event_processing_module or not self.event_processing_module.code:
-                #no event processing module, ignore
-                return None
-            else:
-                module_name = "event_{}".format(hashvalue('{}_{}'.format(self.subscriber.name,self.event_type.name)))
-                m = imp.new_module(module_name)
-                exec(self.event_processing_module.code,m.__dict__)
-                if not hasattr(m,"process"):
-                    #no event processing method
-                    raise Exception("'process' method is not found in event processing module({})".format(self.event_processing_module.name))
-                if self.event_processing_module.parameters and not self.parameters:
-                    #not configured the parameters, ignore
-                    raise Exception("Missing parameters for subscribed event type({})".format(self))
-                if self.parameters:
-                    for k,v in self.parameters.items():
-                        setattr(m,k,v)
-                self._callback_module = m
+        processing_module = self.processing_module
+        if not processing_module or not processing_module.code:
+            #no event processing module, ignore
+            return None
+        if getattr(self,"_callback_module_hash",None) != processing_module.code_hash:
+            if processing_module.parameters and not self.parameters:
+                #not configured the parameters, ignore
+                raise Exception("Missing parameters for subscribed event type({})".format(self))
+            m = load_callback_module(self.callback_module_name,processing_module.code,self.parameters)
+            if not hasattr(m,"process"):
+                #no event processing method
+                raise Exception("'process' method is not found in event processing module({})".format(processing_module.name))
+            self._callback_module = m
+            self._callback_module_hash = processing_module.code_hash
 
         return self._callback_module
 
+    @property
+    def callback_module_name(self):
+        return "event_{}".format(hashvalue('{}_{}'.format(self.subscriber_id,self.event_type_id)))
+
     @property
     def callback(self):
         _module = self.callback_module
@@ -216,9 +476,16 @@ class SubscribedEvent(BaseModel):
     SUCCEED = 1
     FAILED = -1
     TIMEOUT = -2
+    #failed too many times, not retried any more
+    DEAD = -3
 
     PROCESSING_TIMEOUT = timedelta(hours=1)
     REPROCESSING_INTERVAL = timedelta(minutes=5)
+    #a failed event is retried after RETRY_BACKOFF * 2^(process_times - 1), at most MAX_RETRY_BACKOFF
+    RETRY_BACKOFF = timedelta(seconds=settings.RETRY_BACKOFF)
+    MAX_RETRY_BACKOFF = timedelta(seconds=settings.MAX_RETRY_BACKOFF)
+    #the event is dead after failed MAX_PROCESS_TIMES times
+    MAX_PROCESS_TIMES = settings.MAX_PROCESS_TIMES
 
     subscriber = models.ForeignKeyField(Subscriber,null=False,backref="events")
     publisher = models.ForeignKeyField(Publisher,null=False,backref="subscribed_publisher_events")
@@ -231,9 +498,306 @@ class SubscribedEvent(BaseModel):
     process_end_time = models.DateTimeField(null=True)
     status = models.IntegerField(default=PROCESSING)
     result = models.TextField(null=True)
+    #the time to retry a failed event or a processing event which maybe timeout; null if succeed or dead
+    next_retry_at = models.DateTimeField(null=True)
+
+    #get the processing lock of the events and load the events with one statement.
+    #the events which are already loaded, for example inlined in the notifications, are not read from the event table.
+    #the processing history is saved if a failed or timeout event is reprocessed.
+    CLAIM_SQL = """
+WITH e AS (
+    SELECT id,publisher_id,event_type_id,source,publish_time,payload FROM event WHERE id = ANY(%(events)s::bigint[])
+    UNION ALL
+    SELECT id,publisher_id,event_type_id,NULL,NULL,NULL FROM unnest(%(loaded_events)s::bigint[],%(publishers)s::varchar[],%(event_types)s::varchar[]) AS l(id,publisher_id,event_type_id)
+), s AS (
+    SELECT DISTINCT ON (event_id) * FROM subscribed_event WHERE subscriber_id = %(subscriber)s AND event_id = ANY(%(events)s::bigint[] || %(loaded_events)s::bigint[]) ORDER BY event_id,id
+), inserted AS (
+    INSERT INTO subscribed_event (subscriber_id,publisher_id,event_type_id,event_id,process_host,process_pid,process_times,process_start_time,status,next_retry_at)
+    SELECT %(subscriber)s,e.publisher_id,e.event_type_id,e.id,%(host)s,%(pid)s,1,%(now)s,{processing},%(timeout_at)s FROM e WHERE NOT EXISTS (SELECT 1 FROM s WHERE s.event_id = e.id)
+    ON CONFLICT DO NOTHING
+    RETURNING id,event_id
+), updated AS (
+    UPDATE subscribed_event AS se SET process_host = %(host)s,process_pid = %(pid)s,process_times = s.process_times + 1,process_start_time = %(now)s,process_end_time = NULL,status = {processing},result = NULL,next_retry_at = %(timeout_at)s
+    FROM s
+    WHERE se.id = s.id AND se.process_times = s.process_times AND (s.status = {failed} OR (s.status = {processing} AND s.process_start_time < %(timeout)s))
+    RETURNING se.id,se.event_id
+), history AS (
+    INSERT INTO event_processing_history (subscribed_event_id,process_host,process_pid,process_start_time,process_end_time,status,result)
+    SELECT s.id,s.process_host,s.process_pid,s.process_start_time,s.process_end_time,CASE WHEN s.status = {processing} THEN {timeout} ELSE s.status END,s.result
+    FROM s JOIN updated ON updated.id = s.id
+)
+SELECT e.id,e.publisher_id,e.event_type_id,e.source,e.publish_time,e.payload,COALESCE(inserted.id,updated.id),inserted.id IS NOT NULL
+FROM e LEFT JOIN inserted ON inserted.event_id = e.id LEFT JOIN updated ON updated.event_id = e.id
+ORDER BY e.id
+""".format(processing=PROCESSING,failed=FAILED,timeout=TIMEOUT)
+
+    #save the processing results, and move the last dispatched event of the subscribed event type forward to the latest event processed the first time.
+    #return the last dispatched event and time of the subscribed event type
+    COMPLETE_SQL = """
+WITH v AS (
+    SELECT * FROM unnest(%(subscribed_events)s::bigint[],%(statuses)s::integer[],%(results)s::text[]) AS v(id,status,result)
+), se AS (
+    UPDATE subscribed_event AS se SET process_end_time = %(now)s,result = v.result,
+        status = CASE WHEN v.status = {failed} AND se.process_times >= %(max_process_times)s THEN {dead} ELSE v.status END,
+        next_retry_at = CASE WHEN v.status = {failed} AND se.process_times < %(max_process_times)s
+            THEN %(now)s + LEAST(%(retry_backoff)s * power(2,se.process_times - 1),%(max_retry_backoff)s) * interval '1 second'
+            ELSE NULL END
+    FROM v WHERE se.id = v.id
+), t AS (
+    UPDATE subscribed_event_type SET last_dispatched_event_id = %(event)s::bigint,last_dispatched_time = %(dispatched_time)s
+    WHERE %(event)s::bigint IS NOT NULL AND id = %(subscribed_event_type)s AND (last_dispatched_event_id IS NULL OR last_dispatched_event_id < %(event)s::bigint)
+    RETURNING last_dispatched_event_id,last_dispatched_time
+)
+SELECT last_dispatched_event_id,last_dispatched_time FROM t
+UNION ALL
+SELECT last_dispatched_event_id,last_dispatched_time FROM subscribed_event_type
+WHERE %(event)s::bigint IS NOT NULL AND id = %(subscribed_event_type)s AND NOT EXISTS (SELECT 1 FROM t)
+""".format(failed=FAILED,dead=DEAD)
+
+    #pull mode: claim the new events of an event type after the pull position, the events being claimed by other replicas of the subscriber are skipped.
+    #the events are locked with a transaction level advisory lock keyed by (subscriber,event) instead of 'FOR UPDATE SKIP LOCKED' on the shared event table,
+    #so the subscribers don't skip each other's events and the event rows are not written; a hash collision only makes the event pulled later.
+    #the smallest skipped event which is not claimed yet is returned, the pull position can't be moved after it.
+    #the event ids are taken from the sequence in insert order but committed in any order, a smaller event id maybe committed after a larger one is pulled.
+    #an event is settled if it is inserted by a transaction older than the oldest running transaction, then no running transaction holds a smaller event id
+    #(except during the few instructions between taking the id and getting the transaction id in one insert statement);
+    #the pull position is not moved after the first unsettled event, the events after it are scanned again and the claimed ones are skipped.
+    #the 64-bit transaction id of the event is rebuilt from the 32-bit xmin and the epoch of the current transaction
+    PULL_SQL = """
+WITH h AS (
+    SELECT txid_current() AS cur,txid_snapshot_xmin(txid_current_snapshot()) AS xmin
+), c AS (
+    SELECT id FROM event AS ev
+    WHERE ev.event_type_id = %(event_type)s AND ev.id > %(after)s
+        AND NOT EXISTS (SELECT 1 FROM subscribed_event AS s WHERE s.subscriber_id = %(subscriber)s AND s.event_id = ev.id)
+    ORDER BY ev.id LIMIT %(limit)s * 2
+), e AS (
+    SELECT ev.id,ev.publisher_id,ev.event_type_id,ev.source,ev.publish_time,ev.payload,
+        h.cur - mod(mod(h.cur,4294967296) - ev.xmin::text::bigint + 4294967296,4294967296) < h.xmin AS settled
+    FROM c JOIN event AS ev ON ev.id = c.id CROSS JOIN h
+    WHERE pg_try_advisory_xact_lock(hashtextextended(%(subscriber)s || ':' || c.id,0))
+    ORDER BY c.id LIMIT %(limit)s
+), inserted AS (
+    INSERT INTO subscribed_event (subscriber_id,publisher_id,event_type_id,event_id,process_host,process_pid,process_times,process_start_time,status,next_retry_at)
+    SELECT %(subscriber)s,e.publisher_id,e.event_type_id,e.id,%(host)s,%(pid)s,1,%(now)s,{processing},%(timeout_at)s FROM e
+    ON CONFLICT DO NOTHING
+    RETURNING id,event_id
+), skipped AS (
+    SELECT min(c.id) AS id FROM c
+    WHERE c.id < (SELECT max(id) FROM e) AND NOT EXISTS (SELECT 1 FROM e WHERE e.id = c.id)
+)
+SELECT e.id,e.publisher_id,e.event_type_id,e.source,e.publish_time,e.payload,inserted.id,(SELECT id FROM skipped),e.settled
+FROM e LEFT JOIN inserted ON inserted.event_id = e.id
+ORDER BY e.id
+""".format(processing=PROCESSING)
+
+    #pull mode: claim the due failed events and the timeout processing events of an event type with 'FOR UPDATE SKIP LOCKED'
+    PULL_RETRY_SQL = """
+WITH s AS (
+    SELECT * FROM subscribed_event WHERE subscriber_id = %(subscriber)s AND event_type_id = %(event_type)s AND next_retry_at <= %(now)s
+    ORDER BY next_retry_at LIMIT %(limit)s
+    FOR UPDATE SKIP LOCKED
+), updated AS (
+    UPDATE subscribed_event AS se SET process_host = %(host)s,process_pid = %(pid)s,process_times = s.process_times + 1,process_start_time = %(now)s,process_end_time = NULL,status = {processing},result = NULL,next_retry_at = %(timeout_at)s
+    FROM s
+    WHERE se.id = s.id
+    RETURNING se.id,se.event_id
+), history AS (
+    INSERT INTO event_processing_history (subscribed_event_id,process_host,process_pid,process_start_time,process_end_time,status,result)
+    SELECT s.id,s.process_host,s.process_pid,s.process_start_time,s.process_end_time,CASE WHEN s.status = {processing} THEN {timeout} ELSE s.status END,s.result
+    FROM s
+)
+SELECT e.id,e.publisher_id,e.event_type_id,e.source,e.publish_time,e.payload,updated.id
+FROM updated JOIN event AS e ON e.id = updated.event_id
+ORDER BY e.id
+""".format(processing=PROCESSING,timeout=TIMEOUT)
+
+    #the claim and complete statements are executed for each event, prepare them once per connection
+    CLAIM_STATEMENT = PreparedStatement("eventhub_claim_events",CLAIM_SQL,[
+        ("events","bigint[]"),
+        ("loaded_events","bigint[]"),
+        ("publishers","varchar[]"),
+        ("event_types","varchar[]"),
+        ("subscriber","varchar"),
+        ("host","varchar"),
+        ("pid","varchar"),
+        ("now","timestamptz"),
+        ("timeout","timestamptz"),
+        ("timeout_at","timestamptz")
+    ],prepare=settings.DB_PREPARED_STATEMENTS)
+
+    COMPLETE_STATEMENT = PreparedStatement("eventhub_complete_events",COMPLETE_SQL,[
+        ("subscribed_events","bigint[]"),
+        ("statuses","integer[]"),
+        ("results","text[]"),
+        ("now","timestamptz"),
+        ("subscribed_event_type","bigint"),
+        ("event","bigint"),
+        ("dispatched_time","timestamptz"),
+        ("max_process_times","integer"),
+        ("retry_backoff","float8"),
+        ("max_retry_backoff","float8")
+    ],prepare=settings.DB_PREPARED_STATEMENTS)
+
+    PULL_STATEMENT = PreparedStatement("eventhub_pull_events",PULL_SQL,[
+        ("subscriber","varchar"),
+        ("event_type","varchar"),
+        ("after","bigint"),
+        ("limit","integer"),
+        ("host","varchar"),
+        ("pid","varchar"),
+        ("now","timestamptz"),
+        ("timeout_at","timestamptz")
+    ],prepare=settings.DB_PREPARED_STATEMENTS)
+
+    PULL_RETRY_STATEMENT = PreparedStatement("eventhub_pull_retries",PULL_RETRY_SQL,[
+        ("subscriber","varchar"),
+        ("event_type","varchar"),
+        ("limit","integer"),
+        ("host","varchar"),
+        ("pid","varchar"),
+        ("now","timestamptz"),
+        ("timeout_at","timestamptz")
+    ],prepare=settings.DB_PREPARED_STATEMENTS)
+
+    @classmethod
+    def claim(cls,subscriber,event_id,host,pid):
+        """
+        event_id: the event id or the loaded event
+        Get the processing lock of the event for the subscriber.
+        Return (event,subscribed event id,created); subscribed event id is None if the event is already processed or being processed by other process.
+        Return None if the event doesn't exist
+        """
+        claimed = cls.claim_many(subscriber,[event_id],host,pid)
+        return claimed[0] if claimed else None
+
+    @classmethod
+    def claim_many(cls,subscriber,event_ids,host,pid):
+        """
+        event_ids: the list of event id or loaded event; the loaded events are not read from database again
+        Get the processing locks of the events for the subscriber with one statement.
+        Return the list of (event,subscribed event id,created) ordered by event id, the events which don't exist are excluded;
+        subscribed event id is None if the event is already processed or being processed by other process.
+        """
+        loaded_events = dict((e.id,e) for e in event_ids if isinstance(e,Event))
+        cursor = cls.CLAIM_STATEMENT.execute(cls.database,cls.claim_params(subscriber,event_ids,host,pid))
+        return [(loaded_events.get(row[0]) or Event.from_row(row),row[6],row[7]) for row in cursor.fetchall()]
+
+    @classmethod
+    def claim_params(cls,subscriber,event_ids,host,pid):
+        """
+        Return the parameters of CLAIM_STATEMENT, shared with the asyncio subscriber
+        """
+        loaded_events = dict((e.id,e) for e in event_ids if isinstance(e,Event))
+        now = timezone.now()
+        return {
+            "subscriber":subscriber.name if isinstance(subscriber,Subscriber) else subscriber,
+            "events":[e for e in event_ids if not isinstance(e,Event)],
+            "loaded_events":list(loaded_events.keys()),
+            "publishers":[e.publisher_id for e in loaded_events.values()],
+            "event_types":[e.event_type_id for e in loaded_events.values()],
+            "host":host,
+            "pid":str(pid),
+            "now":now,
+            "timeout":now - cls.PROCESSING_TIMEOUT,
+            #retry the event if the processing is not finished before the timeout
+            "timeout_at":now + cls.PROCESSING_TIMEOUT
+        }
+
+    @classmethod
+    def pull(cls,subscriber,event_type,after,limit,host,pid):
+        """
+        Claim at most 'limit' new events of the event type whose id is greater than 'after' for the subscriber with one statement,
+        the events locked by the other replicas of the subscriber are skipped.
+        Return (claimed,after): claimed is the list of (event,subscribed event id,True) ordered by event id;
+        after is the event id to pull after next time, the skipped events and the events from the first unsettled event are pulled again
+        """
+        now = timezone.now()
+        rows = cls.PULL_STATEMENT.execute(cls.database,{
+            "subscriber":subscriber.name if isinstance(subscriber,Subscriber) else subscriber,
+            "event_type":event_type,
+            "after":after,
+            "limit":limit,
+            "host":host,
+            "pid":str(pid),
+            "now":now,
+            "timeout_at":now + cls.PROCESSING_TIMEOUT
+        }).fetchall()
+        if not rows:
+            return ([],after)
+        skipped = rows[0][7]
+        position = rows[-1][0]
+        for row in rows:
+            if not row[8]:
+                #a smaller event id maybe committed later, don't move the position after the unsettled event
+                position = row[0] - 1
+                break
+        if skipped:
+            position = min(position,skipped - 1)
+        return ([(Event.from_row(row),row[6],True) for row in rows if row[6]],position)
+
+    @classmethod
+    def pull_retries(cls,subscriber,event_type,limit,host,pid):
+        """
+        Claim at most 'limit' due failed events and timeout processing events of the event type for the subscriber with one statement,
+        the events locked by the other replicas are skipped.
+        Return the list of (event,subscribed event id,False) ordered by event id
+        """
+        now = timezone.now()
+        rows = cls.PULL_RETRY_STATEMENT.execute(cls.database,{
+            "subscriber":subscriber.name if isinstance(subscriber,Subscriber) else subscriber,
+            "event_type":event_type,
+            "limit":limit,
+            "host":host,
+            "pid":str(pid),
+            "now":now,
+            "timeout_at":now + cls.PROCESSING_TIMEOUT
+        }).fetchall()
+        return [(Event.from_row(row),row[6],False) for row in rows]
+
+    @classmethod
+    def complete(cls,subscribed_event_id,status,result,subscribed_event_type,event_id,created,dispatched_time):
+        """
+        Save the processing result.
+        Return (last dispatched event id,last dispatched time) of the subscribed event type if created is True; otherwise return None
+        """
+        return cls.complete_many([(subscribed_event_id,status,result)],subscribed_event_type,event_id if created else None,dispatched_time)
+
+    @classmethod
+    def complete_many(cls,results,subscribed_event_type,last_event_id,dispatched_time):
+        """
+        results: the list of (subscribed event id,status,result)
+        last_event_id: the latest event processed the first time; None if all events are reprocessed
+        Save the processing results with one statement.
+        Return (last dispatched event id,last dispatched time) of the subscribed event type if last_event_id is not None; otherwise return None
+        """
+        cursor = cls.COMPLETE_STATEMENT.execute(cls.database,cls.complete_params(results,subscribed_event_type,last_event_id,dispatched_time))
+        return cursor.fetchone()
+
+    @classmethod
+    def complete_params(cls,results,subscribed_event_type,last_event_id,dispatched_time):
+        """
+        Return the parameters of COMPLETE_STATEMENT, shared with the asyncio subscriber
+        """
+        return {
+            "subscribed_events":[r[0] for r in results],
+            "statuses":[r[1] for r in results],
+            "results":[r[2] for r in results],
+            "now":timezone.now(),
+            "subscribed_event_type":subscribed_event_type.id if isinstance(subscribed_event_type,SubscribedEventType) else subscribed_event_type,
+            "event":last_event_id,
+            "dispatched_time":dispatched_time,
+            "max_process_times":cls.MAX_PROCESS_TIMES,
+            "retry_backoff":cls.RETRY_BACKOFF.total_seconds(),
+            "max_retry_backoff":cls.MAX_RETRY_BACKOFF.total_seconds()
+        }
 
     class Meta:
         table_name = 'subscribed_event'
+        indexes = (
+            #an event is processed once by a subscriber
+            (("subscriber","event"),True),
+        )
 
 class EventProcessingHistory(BaseModel):
     subscribed_event = models.ForeignKeyField(SubscribedEvent,null=False,backref="processing_history")
@@ -247,3 +811,50 @@ class EventProcessingHistory(BaseModel):
     class Meta:
         table_name = 'event_processing_history'
 
+
+class SubscriberReplica(BaseModel):
+    """
+    The heartbeat of a replica of a partitioned subscriber
+    positions: event type name -> the event id before which all the events of the replica's partitions are processed
+    """
+    subscriber = models.ForeignKeyField(Subscriber,null=False,backref="replicas")
+    replica = models.CharField(max_length=256,null=False)
+    heartbeat = models.DateTimeField(null=False)
+    positions = JSONField(null=True)
+
+    #the rows of the dead replicas are kept a while, so the live replicas can read their positions after rebalancing
+    HEARTBEAT_SQL = """
+WITH beat AS (
+    INSERT INTO subscriber_replica (subscriber_id,replica,heartbeat,positions) VALUES (%(subscriber)s,%(replica)s,now(),%(positions)s::json)
+    ON CONFLICT (subscriber_id,replica) DO UPDATE SET heartbeat = EXCLUDED.heartbeat,positions = EXCLUDED.positions
+), expired AS (
+    DELETE FROM subscriber_replica WHERE subscriber_id = %(subscriber)s AND heartbeat < now() - %(ttl)s * 3 * interval '1 second'
+)
+SELECT replica,heartbeat >= now() - %(ttl)s * interval '1 second',positions FROM subscriber_replica WHERE subscriber_id = %(subscriber)s
+"""
+
+    @classmethod
+    def heartbeat(cls,subscriber,replica,positions,ttl):
+        """
+        Save the heartbeat and the positions of the replica with one statement.
+        Return the list of (replica,live,positions) of the subscriber's replicas saved before this heartbeat
+        """
+        cursor = cls.database.execute_sql(cls.HEARTBEAT_SQL,{
+            "subscriber":subscriber.name if isinstance(subscriber,Subscriber) else subscriber,
+            "replica":replica,
+            "positions":json.dumps(positions),
+            "ttl":ttl
+        })
+        return cursor.fetchall()
+
+    @classmethod
+    def leave(cls,subscriber,replica,ttl):
+        """
+        Expire the heartbeat of the replica, so its partitions are reassigned by the other replicas at their next heartbeat;
+        the row is kept to provide its positions
+        """
+        cls.update(heartbeat=timezone.now() - timedelta(seconds=ttl + 1)).where((cls.subscriber == subscriber) & (cls.replica == replica)).execute()
+
+    class Meta:
+        table_name = 'subscriber_replica'
+        primary_key = models.CompositeKey('subscriber','replica')
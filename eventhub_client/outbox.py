@@ -0,0 +1,317 @@
+import os
+import json
+import time
+import atexit
+import logging
+import traceback
+from threading import Thread,Condition
+
+from eventhub_utils import JSONEncoder,JSONDecoder
+from eventhub_utils.database import CONNECTION_ERRORS
+from . import models
+
+logger = logging.getLogger(__name__)
+
+class OutboxClosed(Exception):
+    pass
+
+class OutboxReplayWorker(Thread):
+    def __init__(self,outbox):
+        super().__init__(name="Outbox Replay Worker {}".format(outbox.folder),daemon=True)
+        self.outbox = outbox
+
+    def run(self):
+        logger.info("The replay worker of outbox({}) is running".format(self.outbox.folder))
+        try:
+            while self.outbox._replay_next():
+                pass
+        except KeyboardInterrupt:
+            pass
+        logger.info("The replay worker of outbox({}) is end".format(self.outbox.folder))
+
+class Outbox(object):
+    """
+    A durable local outbox to keep the published events when the database is unavailable.
+    The events are appended into segment files as json lines and fsynced in batches;
+    a replay worker thread inserts them into the event table in order once the database is active again,
+    and then removes the consumed segments.
+    After a connection error the publishers spool the events without connecting to the database, so the publish latency is bounded,
+    until the replay worker finds the database active again.
+    The outbox provides at-least-once delivery: an event can be inserted twice if the process crashes
+    after the events are inserted but before the checkpoint is saved.
+    """
+    SEGMENT_SUFFIX = ".seg"
+    CHECKPOINT_FILE = "checkpoint"
+
+    def __init__(self,folder,segment_size=10000,sync_batch=100,sync_interval=200,batch_size=500,retry_interval=2000):
+        """
+        folder: the folder to save the segment files; the folder can only be used by one process
+        segment_size: the maximum number of events in one segment file
+        sync_batch: fsync the segment file once the number of unsynced events reaches sync_batch
+        sync_interval: the maximum milliseconds an appended event is not fsynced
+        batch_size: the maximum number of events replayed in one statement
+        retry_interval: the waiting milliseconds before replaying again if the database is still unavailable
+        """
+        self.folder = os.path.abspath(folder)
+        os.makedirs(self.folder,exist_ok=True)
+        self._segment_size = segment_size
+        self._sync_batch = sync_batch
+        self._sync_interval = sync_interval / 1000.0
+        self._batch_size = batch_size
+        self._retry_interval = retry_interval / 1000.0
+
+        self._condition = Condition()
+        self._closed = False
+        #False after a connection error until the replay worker finds the database active again
+        self._database_available = True
+
+        #the replay position (segment,offset); all segments before 'segment' are consumed
+        self._checkpoint = self._load_checkpoint()
+        self._pending = self._count_pending()
+
+        #always write into a new segment, the last segment maybe ends with a partial line if the process crashed
+        segments = self._segments()
+        self._segment = max(segments[-1] if segments else 0,self._checkpoint[0]) + 1
+        self._file = None
+        self._records = 0
+        self._unsynced = 0
+        self._synced_time = time.time()
+
+        self._replay_worker = OutboxReplayWorker(self)
+        self._replay_worker.start()
+        atexit.register(self.close)
+
+    @property
+    def pending(self):
+        """
+        Return the number of events which are not replayed into the database
+        """
+        return self._pending
+
+    @property
+    def is_empty(self):
+        return self._pending == 0
+
+    @property
+    def database_available(self):
+        return self._database_available
+
+    def database_unavailable(self):
+        """
+        Called after a connection error; the events are spooled without connecting to the database until the replay worker finds the database active again
+        """
+        with self._condition:
+            self._database_available = False
+            self._condition.notify_all()
+
+    def _check_database(self):
+        """
+        Return True if the database is active
+        """
+        try:
+            with models.Event.database.active_context():
+                return models.Event.database.is_active
+        except:
+            return False
+
+    def _segment_file(self,segment):
+        return os.path.join(self.folder,"{:020d}{}".format(segment,self.SEGMENT_SUFFIX))
+
+    def _segments(self):
+        """
+        Return the sorted segment numbers in the folder
+        """
+        return sorted(int(f[:-len(self.SEGMENT_SUFFIX)]) for f in os.listdir(self.folder) if f.endswith(self.SEGMENT_SUFFIX))
+
+    def _load_checkpoint(self):
+        try:
+            with open(os.path.join(self.folder,self.CHECKPOINT_FILE)) as f:
+                checkpoint = json.loads(f.read())
+                return (checkpoint[0],checkpoint[1])
+        except FileNotFoundError:
+            return (0,0)
+
+    def _save_checkpoint(self,checkpoint):
+        checkpoint_file = os.path.join(self.folder,self.CHECKPOINT_FILE)
+        with open(checkpoint_file + ".tmp","w") as f:
+            f.write(json.dumps(list(checkpoint)))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(checkpoint_file + ".tmp",checkpoint_file)
+        self._checkpoint = checkpoint
+        #remove the consumed segments
+        for segment in self._segments():
+            if segment >= checkpoint[0]:
+                break
+            os.remove(self._segment_file(segment))
+
+    def _count_pending(self):
+        pending = 0
+        for segment in self._segments():
+            if segment < self._checkpoint[0]:
+                continue
+            with open(self._segment_file(segment),"rb") as f:
+                if segment == self._checkpoint[0]:
+                    f.seek(self._checkpoint[1])
+                for line in f:
+                    if line.endswith(b"\n"):
+                        pending += 1
+        return pending
+
+    def _sync(self):
+        if self._file and self._unsynced:
+            self._file.flush()
+            os.fsync(self._file.fileno())
+        self._unsynced = 0
+        self._synced_time = time.time()
+
+    def _rollover(self):
+        if self._file:
+            self._sync()
+            self._file.close()
+            self._segment += 1
+        self._file = open(self._segment_file(self._segment),"ab")
+        self._records = 0
+
+    def append(self,publisher,payload,publish_time):
+        """
+        publisher: the eventhub_client.Publisher object
+        Save the event into the outbox
+        """
+        self.extend(publisher,[(publish_time,payload)])
+
+    def extend(self,publisher,events):
+        """
+        publisher: the eventhub_client.Publisher object
+        events: a list of (publish_time,payload)
+        Save the events into the outbox
+        """
+        lines = [json.dumps({
+            "publisher":publisher.publisher.name,
+            "event_type":publisher.event_type.name,
+            "source":publisher.host,
+            "publish_time":publish_time,
+            "payload":payload
+        },cls=JSONEncoder).encode("utf-8") + b"\n" for publish_time,payload in events]
+
+        with self._condition:
+            if self._closed:
+                raise OutboxClosed("The outbox({}) is closed".format(self.folder))
+            for line in lines:
+                if self._file is None or self._records >= self._segment_size:
+                    self._rollover()
+                self._file.write(line)
+                self._records += 1
+            self._file.flush()
+            self._unsynced += len(lines)
+            self._pending += len(lines)
+            if self._unsynced >= self._sync_batch or time.time() - self._synced_time >= self._sync_interval:
+                self._sync()
+            self._condition.notify_all()
+
+    def _read(self):
+        """
+        Return (events,position), position is the replay position after the returned events
+        """
+        events = []
+        segment,offset = self._checkpoint
+        for s in self._segments():
+            if s < segment:
+                continue
+            if s > segment:
+                segment,offset = s,0
+            with open(self._segment_file(segment),"rb") as f:
+                f.seek(offset)
+                for line in f:
+                    if not line.endswith(b"\n"):
+                        #partial line, being written or left by a crashed process
+                        break
+                    events.append(json.loads(line.decode("utf-8"),cls=JSONDecoder))
+                    offset += len(line)
+                    if len(events) >= self._batch_size:
+                        return (events,(segment,offset))
+            if segment >= self._segment:
+                #the segment is being written
+                break
+            #the segment is consumed
+            segment,offset = segment + 1,0
+
+        return (events,(segment,offset))
+
+    def _replay_next(self):
+        """
+        Called by the replay worker thread to replay the next batch into the database.
+        Return False if the outbox is closed; otherwise return True
+        """
+        with self._condition:
+            while not self._pending and not self._closed:
+                if self._unsynced:
+                    self._condition.wait(max(0,self._synced_time + self._sync_interval - time.time()))
+                    if self._unsynced and time.time() - self._synced_time >= self._sync_interval:
+                        self._sync()
+                else:
+                    self._condition.wait()
+            if self._closed:
+                return False
+            if self._unsynced and time.time() - self._synced_time >= self._sync_interval:
+                self._sync()
+            events,position = self._read()
+
+        if events and not self._database_available:
+            if not self._check_database():
+                with self._condition:
+                    self._condition.wait_for(lambda:self._closed,timeout=self._retry_interval)
+                return True
+            logger.info("The database is active again, replay the events from outbox({})".format(self.folder))
+            self._database_available = True
+
+        if events:
+            try:
+                with models.Event.database.active_context():
+                    models.Event.insert_many([{
+                        'publisher':event["publisher"],
+                        'event_type':event["event_type"],
+                        'source':event["source"],
+                        'publish_time':event["publish_time"],
+                        'payload':event["payload"]
+                    } for event in events]).execute()
+            except Exception as ex:
+                logger.error("Failed to replay {} events from outbox({}), the database maybe unavailable.{}".format(len(events),self.folder,traceback.format_exc()))
+                if isinstance(ex,CONNECTION_ERRORS):
+                    #probe the database before replaying again
+                    self._database_available = False
+                with self._condition:
+                    self._condition.wait_for(lambda:self._closed,timeout=self._retry_interval)
+                return True
+
+        with self._condition:
+            if position != self._checkpoint:
+                self._save_checkpoint(position)
+            self._pending -= len(events)
+            if not events:
+                #only partial lines are left in the pending segments, no more complete events can be replayed
+                self._pending = 0
+            self._condition.notify_all()
+        if events:
+            logger.info("Replayed {} events from outbox({})".format(len(events),self.folder))
+        return True
+
+    def close(self,timeout=None):
+        """
+        Fsync the segment file and stop the replay worker; the pending events are replayed after the outbox is opened again.
+        It is safe to call close multiple times.
+        """
+        with self._condition:
+            if self._closed:
+                return
+            self._closed = True
+            if self._file:
+                self._sync()
+                self._file.close()
+                self._file = None
+            self._condition.notify_all()
+        self._replay_worker.join(timeout)
+        try:
+            atexit.unregister(self.close)
+        except:
+            pass
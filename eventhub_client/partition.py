@@ -0,0 +1,233 @@
+import re
+import logging
+import argparse
+import sys
+from datetime import timedelta
+
+from eventhub_utils import timezone
+
+from . import settings
+from . import models
+
+logger = logging.getLogger(__name__)
+
+#the partitioned tables, table -> (partition column,indexes created on the partitioned table)
+#the primary key of a partitioned table must include the partition column, so the foreign keys referencing these tables are not supported
+#after the tables are partitioned.
+#subscribed_event is not partitioned: a unique constraint of a partitioned table must include the partition column, and the unique
+#constraint (subscriber_id,event_id) is what makes an event claimed only once by a subscriber
+PARTITIONED_TABLES = {
+    "event_processing_history":("process_start_time",[
+        "CREATE INDEX IF NOT EXISTS event_processing_history_subscribed_event_id_part ON event_processing_history (subscribed_event_id)"
+    ]),
+    "event":("publish_time",[
+        "CREATE INDEX IF NOT EXISTS event_event_type_id_id_part ON event (event_type_id,id)"
+    ])
+}
+
+INTERVALS = {
+    "day":"1 day",
+    "week":"1 week",
+    "month":"1 month"
+}
+
+PARTITION_BOUND_RE = re.compile(r"TO \('(?P<upper>[^']+)'\)")
+
+def is_partitioned(database,table):
+    row = database.execute_sql("SELECT relkind FROM pg_class WHERE relname = %s AND relnamespace = 'public'::regnamespace",(table,)).fetchone()
+    return row is not None and row[0] == 'p'
+
+def partition_name(table,start):
+    return "{}_p{}".format(table,start.strftime("%Y%m%d"))
+
+def legacy_boundary(database,table,column,interval):
+    """
+    Return the upper bound of the legacy partition: the start of the next interval, or the start of the interval after the latest row if it is later
+    """
+    #max() scans the table if the column is not indexed, it's only executed once when converting the table
+    return database.execute_sql(
+        "SELECT greatest(date_trunc(%s,now()),date_trunc(%s,max({0}))) + %s::interval FROM {1}".format(column,table),
+        (interval,interval,INTERVALS[interval])
+    ).fetchone()[0]
+
+def convert(database=None,interval=settings.PARTITION_INTERVAL):
+    """
+    Convert the tables into range partitioned tables.
+    The existing table is renamed to '<table>_legacy' and attached as the partition of all the rows before the start of the next interval,
+    and the partitions of the following intervals are created.
+    The triggers of the table, for example the event notify trigger, are moved to the partitioned table.
+    The foreign keys referencing the tables are dropped.
+    The table subscribed_event is never converted, because its unique constraint (subscriber_id,event_id) can't be kept.
+    """
+    database = database or models.BaseModel.database
+    if is_partitioned(database,"subscribed_event"):
+        logger.error("The table subscribed_event is partitioned without the unique constraint (subscriber_id,event_id), an event can be claimed more than once by a subscriber; convert it back into a plain table and run 'python -m eventhub_client.schema apply'")
+    for table,(column,indexes) in PARTITIONED_TABLES.items():
+        if is_partitioned(database,table):
+            logger.info("The table {} is already partitioned".format(table))
+            continue
+        logger.info("Convert the table {} into a partitioned table by {}".format(table,column))
+        boundary = legacy_boundary(database,table,column,interval)
+        #the range of the legacy rows is validated without blocking the writes, and then attaching the legacy table doesn't scan it.
+        #the rows inserted before the conversion are still in the current interval, so they are less than the boundary
+        database.execute_sql("ALTER TABLE {0} DROP CONSTRAINT IF EXISTS {0}_legacy_range".format(table))
+        database.execute_sql("ALTER TABLE {0} ADD CONSTRAINT {0}_legacy_range CHECK ({1} IS NOT NULL AND {1} < %s) NOT VALID".format(table,column),(boundary,))
+        database.execute_sql("ALTER TABLE {0} VALIDATE CONSTRAINT {0}_legacy_range".format(table))
+        with database.atomic():
+            #the triggers are kept by the renamed table, create them on the partitioned table again
+            triggers = database.execute_sql(
+                "SELECT tgname,pg_get_triggerdef(oid) FROM pg_trigger WHERE tgrelid = %s::regclass AND NOT tgisinternal",
+                (table,)
+            ).fetchall()
+            #no '%' in the statement, peewee passes an empty tuple as the parameters and psycopg2 reads '%' as a placeholder
+            database.execute_sql("""
+DO $$
+DECLARE
+    r RECORD;
+BEGIN
+    FOR r IN SELECT conname,conrelid::regclass AS tablename FROM pg_constraint WHERE contype = 'f' AND confrelid = '{table}'::regclass LOOP
+        EXECUTE 'ALTER TABLE ' || r.tablename::text || ' DROP CONSTRAINT ' || quote_ident(r.conname);
+    END LOOP;
+END;
+$$
+""".format(table=table))
+            for name,definition in triggers:
+                database.execute_sql('DROP TRIGGER "{}" ON {}'.format(name,table))
+            database.execute_sql("ALTER TABLE {0} RENAME TO {0}_legacy".format(table))
+            database.execute_sql("CREATE TABLE {0} (LIKE {0}_legacy INCLUDING DEFAULTS) PARTITION BY RANGE ({1})".format(table,column))
+            #the primary key must include the partition column; the name 'pkey' is used by the legacy table
+            database.execute_sql("ALTER TABLE {0} ADD CONSTRAINT {0}_part_pkey PRIMARY KEY (id,{1})".format(table,column))
+            #the id sequence is dropped with its owner, move it to the partitioned table before the legacy table is dropped
+            sequence = database.execute_sql("SELECT pg_get_serial_sequence(%s,'id')",("{}_legacy".format(table),)).fetchone()[0]
+            if sequence:
+                database.execute_sql("ALTER SEQUENCE {} OWNED BY {}.id".format(sequence,table))
+            database.execute_sql("ALTER TABLE {0} ATTACH PARTITION {0}_legacy FOR VALUES FROM (MINVALUE) TO (%s)".format(table),(boundary,))
+            #the rows out of the created partitions are saved into the default partition, instead of failing the insert
+            database.execute_sql("CREATE TABLE {0}_default PARTITION OF {0} DEFAULT".format(table))
+            for sql in indexes:
+                database.execute_sql(sql)
+            #the trigger definitions refer to the table name, which is the partitioned table now; they are cloned to all the partitions
+            for name,definition in triggers:
+                database.execute_sql(definition)
+                logger.info("Move trigger {} to the partitioned table {}".format(name,table))
+    create_partitions(database,interval=interval)
+
+def create_partitions(database=None,interval=settings.PARTITION_INTERVAL,premake=settings.PARTITION_PREMAKE):
+    """
+    Create the partitions of the current interval and the next 'premake' intervals if not exist and not covered by the existing partitions.
+    Return the list of created partitions
+    """
+    database = database or models.BaseModel.database
+    created = []
+    with database.atomic():
+        boundaries = [row[0] for row in database.execute_sql(
+            "SELECT generate_series(date_trunc(%s,now()),date_trunc(%s,now()) + %s::interval * %s,%s::interval)",
+            (interval,interval,INTERVALS[interval],premake + 1,INTERVALS[interval])
+        ).fetchall()]
+        for table in PARTITIONED_TABLES.keys():
+            if not is_partitioned(database,table):
+                continue
+            #the intervals before the upper bound of the latest partition, for example the legacy partition, are covered
+            existing = partitions(database,table)
+            covered = existing[-1][1] if existing else None
+            for start,end in zip(boundaries[:-1],boundaries[1:]):
+                if covered and start < covered:
+                    continue
+                name = partition_name(table,start)
+                if database.execute_sql("SELECT to_regclass(%s)",(name,)).fetchone()[0]:
+                    continue
+                database.execute_sql("CREATE TABLE {} PARTITION OF {} FOR VALUES FROM (%s) TO (%s)".format(name,table),(start,end))
+                created.append(name)
+                logger.info("Create partition {}".format(name))
+    return created
+
+def partitions(database,table):
+    """
+    Return the list of (partition,upper bound) ordered by upper bound, the default partition is excluded
+    """
+    result = []
+    for name,bound in database.execute_sql("""
+SELECT c.relname,pg_get_expr(c.relpartbound,c.oid) FROM pg_inherits AS i JOIN pg_class AS c ON c.oid = i.inhrelid
+WHERE i.inhparent = %s::regclass
+""",(table,)).fetchall():
+        m = PARTITION_BOUND_RE.search(bound)
+        if not m:
+            continue
+        upper = database.execute_sql("SELECT %s::timestamptz",(m.group("upper"),)).fetchone()[0]
+        result.append((name,upper))
+    result.sort(key=lambda p:p[1])
+    return result
+
+def _is_droppable(database,table,partition):
+    """
+    Return True if the partition is not needed by the subscribers
+    """
+    if table == "event":
+        min_id,max_id = database.execute_sql("SELECT min(id),max(id) FROM {}".format(partition)).fetchone()
+        if max_id is None:
+            return True
+        #all active subscriptions have dispatched the events
+        row = database.execute_sql("""
+SELECT count(*),min(COALESCE(t.last_dispatched_event_id,0)) FROM subscribed_event_type AS t WHERE t.active
+""").fetchone()
+        if row[0] and row[1] < max_id:
+            return False
+        #no event will be retried
+        return not database.execute_sql(
+            "SELECT 1 FROM subscribed_event WHERE next_retry_at IS NOT NULL AND event_id BETWEEN %s AND %s LIMIT 1",
+            (min_id,max_id)
+        ).fetchone()
+    else:
+        return True
+
+def apply_retention(database=None,retentions=None,archive_schema=None):
+    """
+    Detach the partitions which are older than the retention days and not needed by the subscribers, and then drop them;
+    move them into the archive schema if archive_schema is not None.
+    retentions: table -> retention days
+    Return the list of the removed partitions
+    """
+    database = database or models.BaseModel.database
+    retentions = retentions or {
+        "event":settings.EVENT_RETENTION_DAYS,
+        "event_processing_history":settings.EVENT_PROCESSING_HISTORY_RETENTION_DAYS
+    }
+    removed = []
+    for table in PARTITIONED_TABLES.keys():
+        if not retentions.get(table) or not is_partitioned(database,table):
+            continue
+        before = timezone.now() - timedelta(days=retentions[table])
+        for name,upper in partitions(database,table):
+            if upper > before:
+                break
+            with database.atomic():
+                if not _is_droppable(database,table,name):
+                    logger.info("The partition {} is still needed by the subscribers".format(name))
+                    break
+                database.execute_sql("ALTER TABLE {} DETACH PARTITION {}".format(table,name))
+                if archive_schema:
+                    database.execute_sql("CREATE SCHEMA IF NOT EXISTS {}".format(archive_schema))
+                    database.execute_sql("ALTER TABLE {} SET SCHEMA {}".format(name,archive_schema))
+                    logger.info("Archive partition {} into schema {}".format(name,archive_schema))
+                else:
+                    database.execute_sql("DROP TABLE {}".format(name))
+                    logger.info("Drop partition {}".format(name))
+            removed.append(name)
+    return removed
+
+def main(args=None):
+    parser = argparse.ArgumentParser(prog="python -m eventhub_client.partition",description="Partition the event tables by time and remove the old partitions")
+    parser.add_argument("command",choices=["convert","maintain"],help="convert: convert the tables into partitioned tables; maintain: create the future partitions and apply the retention, run it periodically")
+    parser.add_argument("--interval",choices=list(INTERVALS.keys()),default=settings.PARTITION_INTERVAL)
+    parser.add_argument("--archive-schema",dest="archive_schema",default=None,help="move the old partitions into this schema instead of dropping them")
+    options = parser.parse_args(args)
+
+    if options.command == "convert":
+        convert(interval=options.interval)
+    else:
+        create_partitions(interval=options.interval)
+        apply_retention(archive_schema=options.archive_schema)
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    sys.exit(main())
@@ -1,22 +1,32 @@
 import logging
+import collections
+import atexit
+import time
+import traceback
+from threading import Thread,Condition
 
 from eventhub_utils.decorators import (repeat_if_failed,)
 from eventhub_utils import timezone
+from eventhub_utils.database import CONNECTION_ERRORS
 from . import settings
 from . import models
 
 logger = logging.getLogger(__name__)
 
 class Publisher(object):
-    def __init__(self,publisher,event_type):
+    def __init__(self,publisher,event_type,outbox=None):
+        """
+        outbox: the optional eventhub_client.outbox.Outbox object to save the events when the database is unavailable
+        """
         self.publisher = publisher
         self.event_type = event_type
         self.host = settings.HOSTNAME
+        self.outbox = outbox
 
         if isinstance(publisher,models.Publisher):
             self.publisher = publisher
         else:
-            self.publisher = models.Publisher.get_or_create(name=publisher,defaults={
+            self.publisher = models.Publisher.cache.get_or_create(publisher,defaults={
                 'category':models.PROGRAMMATIC,
                 'active':True,
                 'active_modifier':models.User.PROGRAMMATIC,
@@ -25,12 +35,12 @@ class Publisher(object):
                 'modified':timezone.now(),
                 'creator':models.User.PROGRAMMATIC,
                 'created':timezone.now(),
-            })[0]
+            })
         
         if isinstance(event_type,models.EventType):
             self.event_type = event_type
         else:
-            self.event_type = models.EventType.get_or_create(name=event_type,defaults={
+            self.event_type = models.EventType.cache.get_or_create(event_type,defaults={
                 "publisher":self.publisher,
                 'category':models.PROGRAMMATIC,
                 'active':True,
@@ -41,18 +51,298 @@ class Publisher(object):
                 'modified':timezone.now(),
                 'creator':models.User.PROGRAMMATIC,
                 'created':timezone.now(),
-            })[0]
+            })
+        self._sample_saved = self.event_type.sample is not None
+
+    def _save_sample(self, payload):
+        """
+        Save the payload as the sample of the event type if the sample is not saved.
+        The event type maybe the shared cached object which is read-only, so only the column 'sample' is updated in the database
+        """
+        if self._sample_saved:
+            return
+        models.EventType.update(sample=payload).where((models.EventType.name == self.event_type.name) & (models.EventType.sample.is_null())).execute()
+        self._sample_saved = True
 
-    @repeat_if_failed(retry=3,retry_interval=1000,retry_message="Waiting {2} milliseconds and then trying to publish again, {0}")
     def publish(self, payload):
         """
         payload
-        Return the created event object
+        Return the created event object; return None if the event is saved into the outbox
         """
+        if self.outbox:
+            #publish into the outbox if the outbox is not empty to keep the order of the events,
+            #or if the database is unavailable to keep the publish latency bounded
+            if self.outbox.is_empty and self.outbox.database_available:
+                try:
+                    return self._publish(payload)
+                except Exception as ex:
+                    logger.error("Failed to publish the event for publisher({}.{}), save it into the outbox.{}".format(self.publisher.name,self.event_type.name,traceback.format_exc()))
+                    if isinstance(ex,CONNECTION_ERRORS):
+                        self.outbox.database_unavailable()
+            self.outbox.append(self,payload,timezone.now())
+            return None
+        else:
+            return self._publish_with_retry(payload)
+
+    @repeat_if_failed(retry=3,retry_interval=1000,retry_message="Waiting {2} milliseconds and then trying to publish again, {0}")
+    def _publish_with_retry(self, payload):
+        return self._publish(payload)
+
+    def _publish(self, payload):
         with models.Publisher.database.active_context():
-            if self.event_type.sample is None:
-                self._update_event_type_sample = False
-                self.event_type.sample = payload
-                self.event_type.save()
+            self._save_sample(payload)
             return models.Event.create(publisher=self.publisher,event_type=self.event_type,source=self.host,payload=payload)
 
+
+    def publish_many(self, payloads):
+        """
+        payloads: a list of payload
+        Publish all the payloads with one multi-row insert statement; the event notification is still fired per event by the database.
+        Return the list of created event ids with the same order as payloads; return None if the events are saved into the outbox
+        """
+        now = timezone.now()
+        events = [(now,payload) for payload in payloads]
+        if self.outbox:
+            return self._publish_or_spool(events)
+        else:
+            return self._publish_many_with_retry(events)
+
+    @repeat_if_failed(retry=3,retry_interval=1000,retry_message="Waiting {2} milliseconds and then trying to publish the events again, {0}")
+    def _publish_many_with_retry(self, events):
+        return self._publish_many(events)
+
+    def _publish_or_spool(self, events):
+        """
+        Publish the events into the database if the outbox is empty and the database is available; otherwise or if failed, save the events into the outbox
+        Return the list of created event ids; return None if the events are saved into the outbox
+        """
+        if self.outbox.is_empty and self.outbox.database_available:
+            try:
+                return self._publish_many(events)
+            except Exception as ex:
+                logger.error("Failed to publish {} events for publisher({}.{}), save them into the outbox.{}".format(len(events),self.publisher.name,self.event_type.name,traceback.format_exc()))
+                if isinstance(ex,CONNECTION_ERRORS):
+                    self.outbox.database_unavailable()
+        self.outbox.extend(self,events)
+        return None
+
+    def _publish_many(self, events):
+        """
+        events: a list of (publish_time,payload)
+        Return the list of created event ids with the same order as events
+        """
+        if not events:
+            return []
+        with models.Publisher.database.active_context():
+            self._save_sample(events[0][1])
+            rows = [{
+                'publisher':self.publisher,
+                'event_type':self.event_type,
+                'source':self.host,
+                'publish_time':publish_time,
+                'payload':payload
+            } for publish_time,payload in events]
+            return [row[0] for row in models.Event.insert_many(rows).returning(models.Event.id).tuples().execute()]
+
+
+BLOCK = 1
+DROP_OLDEST = 2
+RAISE = 3
+
+BACKPRESSURE_CHOICES = (
+    (BLOCK,"Block"),
+    (DROP_OLDEST,"Drop Oldest"),
+    (RAISE,"Raise")
+)
+
+class BufferFull(Exception):
+    pass
+
+class BufferClosed(Exception):
+    pass
+
+class Flusher(Thread):
+    def __init__(self,publisher):
+        super().__init__(name="Flusher {}.{}".format(publisher.publisher.name,publisher.event_type.name),daemon=True)
+        self.publisher = publisher
+
+    def run(self):
+        logger.info("The flusher thread for {}.{} is running".format(self.publisher.publisher.name,self.publisher.event_type.name))
+        try:
+            while self.publisher._flush_next():
+                pass
+        except KeyboardInterrupt:
+            pass
+        logger.info("The flusher thread for {}.{} is end".format(self.publisher.publisher.name,self.publisher.event_type.name))
+
+class BufferedPublisher(Publisher):
+    """
+    A non-blocking publisher.
+    The published events are added into a bounded in-memory buffer, and a background flusher thread
+    writes them into the database in batches, once batch_size events are buffered or flush_interval milliseconds elapsed.
+    """
+    def __init__(self,publisher,event_type,buffer_size=10000,batch_size=500,flush_interval=1000,backpressure=BLOCK,block_timeout=None,retry_interval=1000,shutdown_timeout=30,outbox=None):
+        """
+        buffer_size: the maximum number of events held in the buffer
+        batch_size: the maximum number of events written in one statement
+        flush_interval: the maximum milliseconds an event waits in the buffer
+        backpressure: the policy when the buffer is full. BLOCK: wait until the buffer has space; DROP_OLDEST: drop the oldest buffered event; RAISE: throw BufferFull
+        block_timeout: the maximum seconds publish blocks with BLOCK policy, None means waiting forever; throw BufferFull if timeout
+        retry_interval: the waiting milliseconds before writing a failed batch again
+        shutdown_timeout: the maximum seconds waiting for the buffered events being written when the publisher is closed or the process exits
+        outbox: the optional outbox to save the batch if failed to write it into the database
+        """
+        super().__init__(publisher,event_type,outbox=outbox)
+        if backpressure not in (BLOCK,DROP_OLDEST,RAISE):
+            raise Exception("Unsupported backpressure policy({})".format(backpressure))
+        self._buffer_size = buffer_size
+        self._batch_size = batch_size
+        self._flush_interval = flush_interval / 1000.0
+        self._backpressure = backpressure
+        self._block_timeout = block_timeout
+        self._retry_interval = retry_interval / 1000.0
+        self._shutdown_timeout = shutdown_timeout
+
+        self._buffer = collections.deque()
+        self._condition = Condition()
+        #the number of events being written by the flusher
+        self._flushing = 0
+        #the flush requested by flush() or close()
+        self._flush_requested = False
+        self._closed = False
+        #the failed events are not retried after the deadline once the publisher is closed
+        self._close_deadline = None
+        self.dropped = 0
+        #the number of events which can't be written before the close deadline
+        self.lost = 0
+
+        self._flusher = Flusher(self)
+        self._flusher.start()
+        atexit.register(self._close_at_exit)
+
+    @property
+    def pending(self):
+        """
+        Return the number of events which are not written into the database
+        """
+        return len(self._buffer) + self._flushing
+
+    def publish(self, payload):
+        """
+        Add the payload into the buffer and return immediately
+        """
+        with self._condition:
+            if self._closed:
+                raise BufferClosed("The publisher({}.{}) is closed".format(self.publisher.name,self.event_type.name))
+            if len(self._buffer) >= self._buffer_size:
+                if self._backpressure == DROP_OLDEST:
+                    while len(self._buffer) >= self._buffer_size:
+                        self._buffer.popleft()
+                        self.dropped += 1
+                    logger.warning("The buffer of publisher({}.{}) is full, drop the oldest event. {} events were dropped".format(self.publisher.name,self.event_type.name,self.dropped))
+                elif self._backpressure == RAISE:
+                    raise BufferFull("The buffer of publisher({}.{}) is full".format(self.publisher.name,self.event_type.name))
+                elif not self._condition.wait_for(lambda:len(self._buffer) < self._buffer_size or self._closed,timeout=self._block_timeout):
+                    raise BufferFull("The buffer of publisher({}.{}) is still full after waiting {} seconds".format(self.publisher.name,self.event_type.name,self._block_timeout))
+                elif self._closed:
+                    raise BufferClosed("The publisher({}.{}) is closed".format(self.publisher.name,self.event_type.name))
+
+            self._buffer.append((timezone.now(),payload))
+            if len(self._buffer) == 1 or len(self._buffer) >= self._batch_size:
+                #wake up the flusher to start the flush deadline or to flush a full batch
+                self._condition.notify_all()
+
+    def _flush_next(self):
+        """
+        Called by the flusher thread to write the next batch into the database.
+        Return False if the publisher is closed and all events are written; otherwise return True
+        """
+        with self._condition:
+            deadline = (time.time() + self._flush_interval) if self._buffer else None
+            while len(self._buffer) < self._batch_size and not self._flush_requested and not self._closed:
+                if deadline is None:
+                    self._condition.wait()
+                    if self._buffer:
+                        deadline = time.time() + self._flush_interval
+                else:
+                    timeout = deadline - time.time()
+                    if timeout <= 0:
+                        break
+                    self._condition.wait(timeout)
+
+            if not self._buffer:
+                self._flush_requested = False
+                self._condition.notify_all()
+                return not self._closed
+
+            events = [self._buffer.popleft() for i in range(min(self._batch_size,len(self._buffer)))]
+            self._flushing = len(events)
+            #buffer has space now
+            self._condition.notify_all()
+
+        try:
+            if self.outbox:
+                self._publish_or_spool(events)
+            else:
+                self._publish_many(events)
+            failed = False
+        except:
+            logger.error("Failed to publish {} events for publisher({}.{}).{}".format(len(events),self.publisher.name,self.event_type.name,traceback.format_exc()))
+            failed = True
+
+        with self._condition:
+            if failed and self._closed and time.time() + self._retry_interval >= self._close_deadline:
+                #no time to try again before the close deadline, give up the failed events and the buffered events
+                lost = len(events) + len(self._buffer)
+                self._buffer.clear()
+                self.lost += lost
+                self._flushing = 0
+                self._condition.notify_all()
+                logger.error("{} events of publisher({}.{}) are lost because they can't be written before the publisher is closed".format(lost,self.publisher.name,self.event_type.name))
+                return False
+            if failed:
+                #put the failed events back to the head of the buffer, and try again later
+                self._buffer.extendleft(reversed(events))
+            self._flushing = 0
+            self._condition.notify_all()
+
+        if failed:
+            time.sleep(self._retry_interval)
+        return True
+
+    def flush(self,timeout=None):
+        """
+        Wait until all buffered events are written into the database.
+        Return True if all events are written; return False if timeout
+        """
+        with self._condition:
+            if not self._flusher.is_alive():
+                return self.pending == 0
+            self._flush_requested = True
+            self._condition.notify_all()
+            return self._condition.wait_for(lambda:self.pending == 0,timeout=timeout)
+
+    def close(self,timeout=None):
+        """
+        Stop accepting new events, write the buffered events into the database and stop the flusher thread.
+        timeout: the maximum seconds to write the buffered events, default is shutdown_timeout; the events failed to write before it are lost,
+            or saved into the outbox if the outbox is configured
+        It is safe to call close multiple times.
+        Return True if all events are written; return False if timeout
+        """
+        timeout = self._shutdown_timeout if timeout is None else timeout
+        with self._condition:
+            if not self._closed:
+                self._close_deadline = time.time() + timeout
+            self._closed = True
+            self._condition.notify_all()
+        self._flusher.join(timeout)
+        try:
+            atexit.unregister(self._close_at_exit)
+        except:
+            pass
+        return self.pending == 0 and self.lost == 0
+
+    def _close_at_exit(self):
+        if not self.close(self._shutdown_timeout) and self.pending:
+            logger.error("{} events of publisher({}.{}) are lost because the process exits".format(self.pending,self.publisher.name,self.event_type.name))
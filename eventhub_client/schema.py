@@ -0,0 +1,423 @@
+import logging
+import argparse
+import sys
+
+from eventhub_utils import timezone
+
+from . import settings
+from . import models
+from . import partition
+
+logger = logging.getLogger(__name__)
+
+#the tables cached by eventhub_client.models.ModelCache, (table,primary key column)
+MODEL_CACHE_TABLES = (
+    ("publisher","name"),
+    ("event_type","name"),
+    ("subscriber","name"),
+    ("event_processing_module","id")
+)
+
+MODEL_CACHE_FUNCTION_SQL = """
+CREATE OR REPLACE FUNCTION eventhub_notify_model_changed() RETURNS trigger AS $$
+BEGIN
+    PERFORM pg_notify(TG_ARGV[0],json_build_object('table',TG_TABLE_NAME,'id',to_jsonb(OLD)->TG_ARGV[1])::text);
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql
+"""
+
+MODEL_CACHE_TRIGGER_SQL = """
+DROP TRIGGER IF EXISTS eventhub_model_changed ON {table};
+CREATE TRIGGER eventhub_model_changed AFTER UPDATE OR DELETE ON {table}
+FOR EACH ROW EXECUTE PROCEDURE eventhub_notify_model_changed('{channel}','{pk}')
+"""
+
+SUBSCRIPTION_FUNCTION_SQL = """
+CREATE OR REPLACE FUNCTION eventhub_notify_subscription_changed() RETURNS trigger AS $$
+DECLARE
+    r RECORD;
+BEGIN
+    IF TG_OP = 'DELETE' THEN
+        r := OLD;
+    ELSE
+        r := NEW;
+    END IF;
+    IF TG_TABLE_NAME = 'event_processing_module' THEN
+        PERFORM pg_notify(TG_ARGV[0],json_build_object('module',r.id)::text);
+    ELSE
+        PERFORM pg_notify(TG_ARGV[0],json_build_object('subscriber',r.subscriber_id,'id',r.id)::text);
+    END IF;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql
+"""
+
+SUBSCRIPTION_TRIGGER_SQL = """
+DROP TRIGGER IF EXISTS eventhub_subscription_changed ON {table};
+CREATE TRIGGER eventhub_subscription_changed AFTER {operations} ON {table}
+FOR EACH ROW EXECUTE PROCEDURE eventhub_notify_subscription_changed('{channel}')
+"""
+
+#the columns of subscribed_event_type which define the subscription
+SUBSCRIPTION_COLUMNS = (
+    "subscriber_id",
+    "publisher_id",
+    "event_type_id",
+    "active",
+    "category",
+    "event_processing_module_id",
+    "parameters",
+    "replay_missed_events",
+    "replay_failed_events"
+)
+
+def subscription_sqls(channel=None):
+    """
+    Return the list of sql statements to create the triggers which notify the subscribers when the managed subscriptions are changed
+    """
+    channel = channel or settings.SUBSCRIPTION_CHANNEL
+    return [
+        SUBSCRIPTION_FUNCTION_SQL,
+        #last_dispatched_event_id and the other 'last_*' columns are updated by the subscribers all the time, they don't change the subscription
+        SUBSCRIPTION_TRIGGER_SQL.format(
+            table="subscribed_event_type",
+            operations="INSERT OR DELETE OR UPDATE OF {}".format(",".join(SUBSCRIPTION_COLUMNS)),
+            channel=channel
+        ),
+        SUBSCRIPTION_TRIGGER_SQL.format(table="event_processing_module",operations="UPDATE",channel=channel)
+    ]
+
+def install_subscription_triggers(database=None,channel=None):
+    """
+    Create or replace the triggers which notify the subscribers when the managed subscriptions are changed
+    """
+    database = database or models.BaseModel.database
+    with database.atomic():
+        for sql in subscription_sqls(channel):
+            database.execute_sql(sql)
+    logger.info("The subscription triggers are installed")
+
+#the retry time of the failed or processing subscribed events, and the partial index used by the retry scheduler.
+#it is a required migration: the claim and complete statements use the column 'next_retry_at' and fail until it is installed,
+#run 'python -m eventhub_client.schema apply' before upgrading the subscribers
+RETRY_SQLS = [
+    "ALTER TABLE subscribed_event ADD COLUMN IF NOT EXISTS next_retry_at timestamp with time zone NULL"
+]
+
+#(index name,table,sql); the index is created concurrently, so the table is not locked
+RETRY_INDEX = (
+    "subscribed_event_next_retry_at",
+    "subscribed_event",
+    "CREATE INDEX CONCURRENTLY IF NOT EXISTS subscribed_event_next_retry_at ON subscribed_event (subscriber_id,next_retry_at) WHERE next_retry_at IS NOT NULL"
+)
+
+#schedule the existing failed and processing subscribed events to be retried; run in batches of id range (start,end], each batch is committed separately
+RETRY_BACKFILL_SQL = """
+UPDATE subscribed_event SET next_retry_at = CASE WHEN status = {failed} THEN COALESCE(process_end_time,process_start_time) ELSE process_start_time + interval '{timeout} seconds' END
+WHERE id > %(start)s AND id <= %(end)s AND next_retry_at IS NULL AND status IN ({failed},{processing})
+""".format(
+    failed=models.SubscribedEvent.FAILED,
+    processing=models.SubscribedEvent.PROCESSING,
+    timeout=int(models.SubscribedEvent.PROCESSING_TIMEOUT.total_seconds())
+)
+
+RETRY_BACKFILL_BATCH_SIZE = 10000
+
+def install_retry_schema(database=None,batch_size=RETRY_BACKFILL_BATCH_SIZE):
+    """
+    Add the column 'next_retry_at' and its index to the table subscribed_event, and schedule the existing failed and processing events in batches.
+    Required by the subscribers, install it before upgrading them
+    """
+    database = database or models.BaseModel.database
+    with database.atomic():
+        for sql in RETRY_SQLS:
+            database.execute_sql(sql)
+    conn = database.connection()
+    #the index can't be created concurrently in a transaction, and each backfill batch is committed
+    conn.autocommit = True
+    try:
+        name,table,sql = RETRY_INDEX
+        if partition.is_partitioned(database,table):
+            #the indexes of the partitioned tables are created by eventhub_client.partition
+            logger.info("The table {} is partitioned, skip the index {}".format(table,name))
+        else:
+            with conn.cursor() as cur:
+                _drop_invalid_index(cur,name,table)
+                logger.info("Create index {} on {}".format(name,table))
+                cur.execute(sql)
+        with conn.cursor() as cur:
+            cur.execute("SELECT min(id),max(id) FROM subscribed_event")
+            start,last = cur.fetchone()
+        if start is not None:
+            start -= 1
+            while start < last:
+                end = start + batch_size
+                with conn.cursor() as cur:
+                    cur.execute(RETRY_BACKFILL_SQL,{"start":start,"end":end})
+                start = end
+    finally:
+        conn.autocommit = False
+    logger.info("The retry schema is installed")
+
+#the heartbeats of the replicas of the partitioned subscribers
+REPLICA_SQLS = [
+    """
+CREATE TABLE IF NOT EXISTS subscriber_replica (
+    subscriber_id varchar(32) NOT NULL REFERENCES subscriber (name),
+    replica varchar(256) NOT NULL,
+    heartbeat timestamp with time zone NOT NULL,
+    positions json NULL,
+    PRIMARY KEY (subscriber_id,replica)
+)
+"""
+]
+
+def install_replica_schema(database=None):
+    """
+    Create the table subscriber_replica
+    """
+    database = database or models.BaseModel.database
+    with database.atomic():
+        for sql in REPLICA_SQLS:
+            database.execute_sql(sql)
+    logger.info("The replica schema is installed")
+
+#notify the subscribers listening on the channel "publisher.event type" when an event is published.
+#the event is inlined in the notification if the notification is not larger than the inline size; otherwise only the event id is notified.
+#publish_time is the epoch seconds to be parsed without the timestamp format
+EVENT_NOTIFY_FUNCTION_SQL = """
+CREATE OR REPLACE FUNCTION eventhub_notify_event() RETURNS trigger AS $$
+DECLARE
+    payload text;
+BEGIN
+    IF TG_ARGV[0]::integer > 0 THEN
+        payload := json_build_object('id',NEW.id,'publisher',NEW.publisher_id,'event_type',NEW.event_type_id,'source',NEW.source,
+            'publish_time',extract(epoch FROM NEW.publish_time),'payload',NEW.payload)::text;
+    END IF;
+    IF payload IS NULL OR octet_length(payload) > TG_ARGV[0]::integer THEN
+        payload := json_build_object('id',NEW.id)::text;
+    END IF;
+    PERFORM pg_notify(NEW.publisher_id || '.' || NEW.event_type_id,payload);
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql
+"""
+
+EVENT_NOTIFY_TRIGGER_SQL = """
+DROP TRIGGER IF EXISTS eventhub_event_notify ON event;
+CREATE TRIGGER eventhub_event_notify AFTER INSERT ON event
+FOR EACH ROW EXECUTE PROCEDURE eventhub_notify_event('{inline_size}')
+"""
+
+#the other triggers on the table event which seem to send notifications; they are reported but not dropped unless they are configured as legacy triggers
+OTHER_EVENT_NOTIFY_TRIGGERS_SQL = """
+SELECT t.tgname FROM pg_trigger AS t JOIN pg_proc AS p ON p.oid = t.tgfoid
+WHERE t.tgrelid = 'event'::regclass AND NOT t.tgisinternal AND t.tgname <> 'eventhub_event_notify' AND p.prosrc ~* '(pg_notify|\\mnotify\\M)'
+"""
+
+def event_notify_sqls(inline_size=None):
+    """
+    Return the list of sql statements to create the trigger which notifies the subscribers when an event is published
+    """
+    inline_size = settings.NOTIFY_INLINE_SIZE if inline_size is None else inline_size
+    return [EVENT_NOTIFY_FUNCTION_SQL,EVENT_NOTIFY_TRIGGER_SQL.format(inline_size=int(inline_size))]
+
+def legacy_event_notify_sqls(legacy_triggers=None):
+    """
+    Return the list of sql statements to drop the legacy notification triggers on the table event
+    """
+    legacy_triggers = settings.LEGACY_EVENT_NOTIFY_TRIGGERS if legacy_triggers is None else legacy_triggers
+    return ['DROP TRIGGER IF EXISTS "{}" ON event'.format(name.strip()) for name in legacy_triggers if name.strip()]
+
+def install_event_notify_trigger(database=None,inline_size=None,legacy_triggers=None):
+    """
+    Create or replace the trigger which notifies the subscribers when an event is published.
+    legacy_triggers: the names of the notification triggers replaced by the trigger, default is settings.LEGACY_EVENT_NOTIFY_TRIGGERS.
+    The other triggers on the table event which seem to send notifications are only reported, drop them if the subscribers are notified twice
+    """
+    database = database or models.BaseModel.database
+    with database.atomic():
+        for sql in legacy_event_notify_sqls(legacy_triggers):
+            database.execute_sql(sql)
+        for sql in event_notify_sqls(inline_size):
+            database.execute_sql(sql)
+        others = [row[0] for row in database.execute_sql(OTHER_EVENT_NOTIFY_TRIGGERS_SQL).fetchall()]
+    if others:
+        logger.warning("The triggers({}) on the table event may send notifications too, they are not dropped; add them to EVENTHUB_LEGACY_EVENT_NOTIFY_TRIGGERS if they notify the subscribers".format(",".join(others)))
+    logger.info("The event notify trigger is installed")
+
+def model_cache_sqls(channel=None):
+    """
+    Return the list of sql statements to create the triggers which notify the model cache invalidator
+    """
+    channel = channel or settings.MODEL_CACHE_CHANNEL
+    return [MODEL_CACHE_FUNCTION_SQL] + [MODEL_CACHE_TRIGGER_SQL.format(table=table,channel=channel,pk=pk) for table,pk in MODEL_CACHE_TABLES]
+
+def install_model_cache_triggers(database=None,channel=None):
+    """
+    Create or replace the triggers which notify the model cache invalidator when the cached tables are changed
+    """
+    database = database or models.BaseModel.database
+    with database.atomic():
+        for sql in model_cache_sqls(channel):
+            database.execute_sql(sql)
+    logger.info("The model cache triggers are installed on {}".format(",".join(table for table,pk in MODEL_CACHE_TABLES)))
+
+#(index name,table,sql); the indexes are created concurrently, so the tables are not locked
+INDEXES = [
+    (
+        "event_event_type_id_id",
+        "event",
+        "CREATE INDEX CONCURRENTLY IF NOT EXISTS event_event_type_id_id ON event (event_type_id,id)"
+    ),
+    (
+        "subscribed_event_subscriber_id_event_id",
+        "subscribed_event",
+        "CREATE UNIQUE INDEX CONCURRENTLY IF NOT EXISTS subscribed_event_subscriber_id_event_id ON subscribed_event (subscriber_id,event_id)"
+    ),
+    (
+        "subscribed_event_failed",
+        "subscribed_event",
+        "CREATE INDEX CONCURRENTLY IF NOT EXISTS subscribed_event_failed ON subscribed_event (subscriber_id,event_type_id,process_start_time) WHERE status < 0"
+    ),
+    (
+        "event_processing_history_subscribed_event_id",
+        "event_processing_history",
+        "CREATE INDEX CONCURRENTLY IF NOT EXISTS event_processing_history_subscribed_event_id ON event_processing_history (subscribed_event_id)"
+    )
+]
+
+UNIQUE_CONSTRAINT_SQL = """
+DO $$
+BEGIN
+    IF NOT EXISTS (SELECT 1 FROM pg_constraint WHERE conname = 'subscribed_event_subscriber_id_event_id') THEN
+        ALTER TABLE subscribed_event ADD CONSTRAINT subscribed_event_subscriber_id_event_id UNIQUE USING INDEX subscribed_event_subscriber_id_event_id;
+    END IF;
+END;
+$$
+"""
+
+DUPLICATED_SUBSCRIBED_EVENTS_SQL = "SELECT count(*) FROM (SELECT 1 FROM subscribed_event GROUP BY subscriber_id,event_id HAVING count(*) > 1) AS d"
+
+#a failed concurrent build leaves an invalid index which 'IF NOT EXISTS' skips, and an invalid unique index still rejects the duplicated rows
+INVALID_INDEX_SQL = "SELECT 1 FROM pg_index WHERE indexrelid = to_regclass(%s) AND NOT indisvalid"
+
+def _drop_invalid_index(cur,name,table):
+    """
+    Drop the index if it's invalid, so it's created again
+    """
+    cur.execute(INVALID_INDEX_SQL,(name,))
+    if cur.fetchone():
+        logger.warning("The index {} on {} is invalid, drop it".format(name,table))
+        cur.execute("DROP INDEX CONCURRENTLY IF EXISTS {}".format(name))
+
+def install_indexes(database=None):
+    """
+    Create the indexes concurrently and the unique constraint (subscriber_id,event_id) of subscribed_event.
+    The invalid indexes left by the failed builds are dropped and created again.
+    The unique constraint is not created if duplicated subscribed events exist
+    """
+    database = database or models.BaseModel.database
+    duplicated = database.execute_sql(DUPLICATED_SUBSCRIBED_EVENTS_SQL).fetchone()[0]
+    database.commit()
+    conn = database.connection()
+    #the indexes can't be created concurrently in a transaction
+    conn.autocommit = True
+    try:
+        for name,table,sql in INDEXES:
+            if partition.is_partitioned(database,table):
+                #the indexes of the partitioned tables are created by eventhub_client.partition
+                logger.info("The table {} is partitioned, skip the index {}".format(table,name))
+                continue
+            with conn.cursor() as cur:
+                _drop_invalid_index(cur,name,table)
+            if name == "subscribed_event_subscriber_id_event_id" and duplicated:
+                logger.error("{} events are processed more than once by the same subscriber, remove the duplicated subscribed events before creating the unique constraint".format(duplicated))
+                continue
+            logger.info("Create index {} on {}".format(name,table))
+            with conn.cursor() as cur:
+                cur.execute(sql)
+        if not duplicated and not partition.is_partitioned(database,"subscribed_event"):
+            with conn.cursor() as cur:
+                cur.execute(UNIQUE_CONSTRAINT_SQL)
+    finally:
+        conn.autocommit = False
+
+#the hot-path queries to explain, the parameters are taken from a subscribed event type
+PLAN_QUERIES = [
+    (
+        "Replay missed events",
+        "SELECT id FROM event WHERE event_type_id = %(event_type)s AND id > %(event)s ORDER BY id LIMIT 500"
+    ),
+    (
+        "Claim events",
+        models.SubscribedEvent.CLAIM_SQL
+    ),
+    (
+        "Fetch events to retry",
+        "SELECT event_id,publisher_id,event_type_id,next_retry_at FROM subscribed_event WHERE subscriber_id = %(subscriber)s AND next_retry_at <= now() AND event_type_id = ANY(ARRAY[%(event_type)s]) ORDER BY next_retry_at LIMIT 1000"
+    ),
+    (
+        "Failed events",
+        "SELECT event_id FROM subscribed_event WHERE subscriber_id = %(subscriber)s AND event_type_id = %(event_type)s AND status < 0 ORDER BY process_start_time"
+    )
+]
+
+def explain(database=None):
+    """
+    Return the list of (query name,plan) of the hot-path queries
+    """
+    database = database or models.BaseModel.database
+    row = database.execute_sql("SELECT subscriber_id,event_type_id,COALESCE(last_dispatched_event_id,0) FROM subscribed_event_type ORDER BY last_dispatched_time DESC NULLS LAST LIMIT 1").fetchone()
+    if not row:
+        return []
+    now = timezone.now()
+    params = {
+        "subscriber":row[0],
+        "event_type":row[1],
+        "event":row[2],
+        #the parameters of the claim statement, the statement is only planned and not executed
+        "events":[row[2]],
+        "loaded_events":[],
+        "publishers":[],
+        "event_types":[],
+        "host":"explain",
+        "pid":"0",
+        "now":now,
+        "timeout":now - models.SubscribedEvent.PROCESSING_TIMEOUT,
+        "timeout_at":now + models.SubscribedEvent.PROCESSING_TIMEOUT
+    }
+    plans = []
+    for name,sql in PLAN_QUERIES:
+        cursor = database.execute_sql("EXPLAIN {}".format(sql),params)
+        plans.append((name,"\n".join(r[0] for r in cursor.fetchall())))
+    database.rollback()
+    return plans
+
+def main(args=None):
+    parser = argparse.ArgumentParser(prog="python -m eventhub_client.schema",description="Install the triggers, columns and indexes used by the eventhub client")
+    parser.add_argument("command",choices=["apply","sql","plan"],help="apply: install all and report the plans; sql: print the sql statements; plan: report the plans of the hot-path queries")
+    options = parser.parse_args(args)
+
+    if options.command == "sql":
+        print("--the other triggers on the table event which may send notifications are not dropped, find them with:{};".format(OTHER_EVENT_NOTIFY_TRIGGERS_SQL.rstrip().replace("\n","\n--")))
+        print("--schedule the existing failed and processing subscribed events in batches of id range after '{}':{};".format(RETRY_INDEX[0],RETRY_BACKFILL_SQL.rstrip().replace("\n","\n--")))
+        for sql in RETRY_SQLS + [RETRY_INDEX[2]] + REPLICA_SQLS + legacy_event_notify_sqls() + event_notify_sqls() + model_cache_sqls() + subscription_sqls() + [sql for name,table,sql in INDEXES] + [UNIQUE_CONSTRAINT_SQL]:
+            print("{};".format(sql.strip()))
+        return
+
+    if options.command == "apply":
+        install_retry_schema()
+        install_replica_schema()
+        install_event_notify_trigger()
+        install_model_cache_triggers()
+        install_subscription_triggers()
+        install_indexes()
+
+    for name,plan in explain():
+        print("{}:\n{}\n".format(name,plan))
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    sys.exit(main())
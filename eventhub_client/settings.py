@@ -1,19 +1,95 @@
 import socket
 import logging
+import traceback
 
 from playhouse import reflection
 
 from eventhub_utils.settings import *
-from eventhub_utils.database import (PostgresqlExtDatabase,PooledPostgresqlExtDatabase)
+from eventhub_utils.database import (PostgresqlExtDatabase,PooledPostgresqlExtDatabase,liveness_strategy)
 from eventhub_utils import parse_db_connection_string,classproperty
 
 logging.getLogger("pubsub").setLevel(logging.DEBUG)
 
+logger = logging.getLogger(__name__)
+
 HOSTNAME = socket.gethostname()
 
 class DatabaseConfig(object):
     default = parse_db_connection_string(env("EVENTHUB_DATABASE_URL",vtype=str,required=True))
 
+#the liveness strategy of the database connections: 'always' check the connection at checkout,
+#'idle' only check the connection which is not known to be working in the last EVENTHUB_DB_LIVENESS_IDLE seconds,
+#'error' only check the connection after a connection error
+DB_LIVENESS_STRATEGY = env("EVENTHUB_DB_LIVENESS_STRATEGY",'idle')
+DB_LIVENESS_IDLE = env("EVENTHUB_DB_LIVENESS_IDLE",30)
+
+#the connection pool settings; the pool should be large enough for the worker threads, the listener, the replay worker and the publishers
+DB_POOL_MAX_CONNECTIONS = env("EVENTHUB_DB_POOL_MAX_CONNECTIONS",5)
+#the seconds a connection can be reused
+DB_POOL_STALE_TIMEOUT = env("EVENTHUB_DB_POOL_STALE_TIMEOUT",300)
+#the seconds to wait for a free connection
+DB_POOL_TIMEOUT = env("EVENTHUB_DB_POOL_TIMEOUT",5)
+#the number of connections opened at startup
+DB_POOL_PREWARM = env("EVENTHUB_DB_POOL_PREWARM",0)
+
+#use server side prepared statements for the hot-path queries; disable it if the connections are shared by a transaction pooler
+DB_PREPARED_STATEMENTS = env("EVENTHUB_DB_PREPARED_STATEMENTS",True)
+
+#the in-process cache of publisher, event type and subscriber
+MODEL_CACHE_SIZE = env("EVENTHUB_MODEL_CACHE_SIZE",1024)
+#the seconds a cached object can be used without reloading
+MODEL_CACHE_TTL = env("EVENTHUB_MODEL_CACHE_TTL",300)
+#the channel notified by the triggers when the cached tables are changed
+MODEL_CACHE_CHANNEL = env("EVENTHUB_MODEL_CACHE_CHANNEL","eventhub_model_changed")
+#listen to the channel to invalidate the cache; disable it if the triggers are not installed, then the cache depends on the ttl only
+MODEL_CACHE_LISTEN = env("EVENTHUB_MODEL_CACHE_LISTEN",True)
+
+#the maximum number of compiled event processing codes cached in process
+CALLBACK_CODE_CACHE_SIZE = env("EVENTHUB_CALLBACK_CODE_CACHE_SIZE",256)
+
+#the channel notified by the triggers when the managed subscriptions or the event processing modules are changed
+SUBSCRIPTION_CHANNEL = env("EVENTHUB_SUBSCRIPTION_CHANNEL","eventhub_subscription_changed")
+
+#share one listen connection and one listener thread among all the subscribers in the process
+SHARED_LISTENER = env("EVENTHUB_SHARED_LISTENER",False)
+
+#claim the events from database in batches, skipping the events being claimed by the other replicas, instead of processing the notified events; the notifications only wake up the workers.
+#use it if the same subscriber runs in several processes
+SUBSCRIBER_PULL = env("EVENTHUB_SUBSCRIBER_PULL",False)
+#the maximum seconds a worker in pull mode waits without a notification before pulling again
+PULL_INTERVAL = env("EVENTHUB_PULL_INTERVAL",5)
+
+#the number of the partitions the events are split into among the replicas of a partitioned subscriber
+SUBSCRIBER_PARTITIONS = env("EVENTHUB_SUBSCRIBER_PARTITIONS",64)
+#the seconds between two heartbeats of a subscriber replica
+REPLICA_HEARTBEAT = env("EVENTHUB_REPLICA_HEARTBEAT",10)
+#the replica is dead if it has no heartbeat in these seconds, and its partitions are reassigned to the live replicas
+REPLICA_TTL = env("EVENTHUB_REPLICA_TTL",30)
+
+#the maximum bytes of the event notification with the inlined event; the larger event is notified with its id only and fetched by the subscribers.
+#the notification payload must be shorter than 8000 bytes; 0 means the events are never inlined
+NOTIFY_INLINE_SIZE = env("EVENTHUB_NOTIFY_INLINE_SIZE",7900)
+#the names of the notification triggers on the table event created before eventhub_event_notify, separated by ',';
+#they are dropped when eventhub_event_notify is installed, otherwise the subscribers are notified twice
+LEGACY_EVENT_NOTIFY_TRIGGERS = env("EVENTHUB_LEGACY_EVENT_NOTIFY_TRIGGERS",[],vtype=list)
+
+#the seconds to wait before retrying a failed event the first time, doubled for each retry
+RETRY_BACKOFF = env("EVENTHUB_RETRY_BACKOFF",60)
+#the maximum seconds to wait before retrying a failed event
+MAX_RETRY_BACKOFF = env("EVENTHUB_MAX_RETRY_BACKOFF",21600)
+#a failed event is dead and not retried any more after processed so many times
+MAX_PROCESS_TIMES = env("EVENTHUB_MAX_PROCESS_TIMES",10)
+#the maximum number of retries fetched from database at a time
+RETRY_FETCH_SIZE = env("EVENTHUB_RETRY_FETCH_SIZE",1000)
+
+#the range of a partition of the partitioned tables: day, week or month
+PARTITION_INTERVAL = env("EVENTHUB_PARTITION_INTERVAL","month")
+#the number of the future partitions created in advance
+PARTITION_PREMAKE = env("EVENTHUB_PARTITION_PREMAKE",3)
+#the days to keep the partitions; the partitions are kept until all the subscribers don't need them
+EVENT_RETENTION_DAYS = env("EVENTHUB_EVENT_RETENTION_DAYS",365)
+EVENT_PROCESSING_HISTORY_RETENTION_DAYS = env("EVENTHUB_EVENT_PROCESSING_HISTORY_RETENTION_DAYS",90)
+
 class Database(object):
     class Default(object):
         _databases = {}
@@ -25,7 +101,8 @@ class Database(object):
                     password=DatabaseConfig.default["password"],
                     host=DatabaseConfig.default["host"], 
                     port=DatabaseConfig.default["port"],
-                    thread_safe=thread_safe
+                    thread_safe=thread_safe,
+                    liveness=liveness_strategy(DB_LIVENESS_STRATEGY,idle_seconds=DB_LIVENESS_IDLE)
                 ) 
             return cls._databases[name]
 
@@ -35,10 +112,17 @@ class DatabasePool(object):
         password=DatabaseConfig.default["password"],
         host=DatabaseConfig.default["host"], 
         port=DatabaseConfig.default["port"],
-        max_connections=5,
-        stale_timeout=300,
-        timeout=5
+        max_connections=DB_POOL_MAX_CONNECTIONS,
+        stale_timeout=DB_POOL_STALE_TIMEOUT,
+        timeout=DB_POOL_TIMEOUT,
+        liveness=liveness_strategy(DB_LIVENESS_STRATEGY,idle_seconds=DB_LIVENESS_IDLE)
     ) 
 
+if DB_POOL_PREWARM:
+    try:
+        DatabasePool.default.prewarm(DB_POOL_PREWARM)
+    except:
+        logger.warning("Failed to prewarm the connection pool.{}".format(traceback.format_exc()))
+
 class Introspector(object):
     default = reflection.Introspector.from_database(DatabasePool.default,schema="public")
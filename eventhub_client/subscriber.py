@@ -1,31 +1,172 @@
 import select
 import os
+import re
+import uuid
+import hashlib
 import logging
 import json
-from threading import Thread
+import collections
+from threading import Thread,Lock,RLock,Semaphore,Condition,Event
+from concurrent.futures import ThreadPoolExecutor,ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 import queue
+import heapq
+import pickle
 import traceback
 import time
 
 from . import settings
 from eventhub_utils.decorators import (repeat_if_failed,)
 from . import models
-from eventhub_utils import timezone
+from eventhub_utils import timezone,hashvalue
 
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.DEBUG)
 
 NOT_READY = ([], [], [])
 
-class ReplayFailedEventsWorker(Thread):
+#the messages put into the queue of the worker to wake it up, they are not events
+_SHUTDOWN = object()
+_REFILL = object()
+
+#the seconds to wait before refilling the events from database again if failed
+REFILL_RETRY_INTERVAL = 2
+
+#the minimum seconds between two fetches of the retry scheduler
+RETRY_FETCH_MIN_INTERVAL = 1
+
+#the executor to run the event callbacks
+THREAD = 1
+PROCESS = 2
+
+EXECUTOR_CHOICES = (
+    (THREAD,"Thread"),
+    (PROCESS,"Process")
+)
+
+#the callback modules compiled in the child process, key is (module name,code hash,parameters)
+_process_modules = {}
+
+def _run_in_process(module,callback,event):
+    """
+    Run the callback in the child process of the process pool
+    module: (module name,code,parameters) of the managed event processing module; None if callback is provided
+    callback: the picklable callback function; None if module is provided
+    event: (id,publisher,event type,source,publish time,payload)
+    """
+    if module:
+        module_name,code,parameters = module
+        key = (module_name,hashvalue(code),json.dumps(parameters,sort_keys=True))
+        m = _process_modules.get(key)
+        if not m:
+            m = models.load_callback_module(module_name,code,parameters)
+            _process_modules[key] = m
+        callback = m.process
+
+    publisher = models.Publisher(name=event[1])
+    return callback(models.Event(
+        id=event[0],
+        publisher=publisher,
+        event_type=models.EventType(name=event[2],publisher=publisher),
+        source=event[3],
+        publish_time=event[4],
+        payload=event[5]
+    ))
+
+def _same_function(f1,f2):
+    """
+    Return True if the two functions are the same object, or are created from the same code with the same defaults and closure values;
+    so the lambda created in each call is treated as the same function
+    """
+    if f1 is f2:
+        return True
+    code1,code2 = getattr(f1,"__code__",None),getattr(f2,"__code__",None)
+    if code1 is None or code1 != code2 or f1.__defaults__ != f2.__defaults__:
+        return False
+    try:
+        return [c.cell_contents for c in (f1.__closure__ or ())] == [c.cell_contents for c in (f2.__closure__ or ())]
+    except ValueError:
+        #empty cell
+        return False
+
+class ProcessCallback(object):
+    """
+    A callback to run the event processing in the process pool of the subscriber.
+    The calling thread waits for the result, and then updates the subscribed event status.
+    """
+    def __init__(self,subscriber,subscribed_event_type,callback):
+        self.subscriber = subscriber
+        self.callback = callback
+        m = subscribed_event_type.callback_module if subscribed_event_type.event_processing_module_id else None
+        if m and callback == m.process:
+            #managed event processing module, the child process compiles and caches the module
+            self._module = (subscribed_event_type.callback_module_name,subscribed_event_type.processing_module.code,subscribed_event_type.parameters)
+            self._callback = None
+        else:
+            try:
+                pickle.dumps(callback)
+            except:
+                raise Exception("The callback of subscribed event type({}) can't be run in process pool, only module-level function is supported".format(subscribed_event_type))
+            self._module = None
+            self._callback = callback
+
+    def __call__(self,event):
+        pool = self.subscriber.process_pool
+        try:
+            future = pool.submit(
+                _run_in_process,
+                self._module,
+                self._callback,
+                (event.id,event.publisher_id,event.event_type_id,event.source,event.publish_time,event.payload)
+            )
+            return future.result()
+        except BrokenProcessPool:
+            #a child process was terminated abruptly, recreate the process pool for the next event
+            self.subscriber._reset_process_pool(broken=pool)
+            raise
+
+class RetryScheduler(Thread):
+    """
+    Retry the failed subscribed events and the processing subscribed events which maybe timeout at their 'next_retry_at'.
+    The due subscribed events are fetched with an index friendly query on 'next_retry_at' and kept in a min-heap;
+    the thread sleeps until the earliest retry time or the next fetch time, and is woken up earlier if an event failed or an event type is subscribed.
+    An event is not enqueued again before its 'next_retry_at' is changed by the claim or the completion.
+    """
     def __init__(self,subscriber):
-        super().__init__(name="Replay Failed Events Worker {}".format(subscriber.subscriber.name),daemon=False)
+        super().__init__(name="Retry Scheduler {}".format(subscriber.subscriber.name),daemon=False)
         self.subscriber = subscriber
         self._shutdown = False
         self._running = None
+        self._ended = Event()
+        self._condition = Condition()
+        #(retry timestamp,event id,event type name,next retry at)
+        self._heap = []
+        #event id -> next retry at, the events in the heap
+        self._scheduled = {}
+        #event id -> (next retry at,dispatched timestamp), the events passed to the workers.
+        #an event is passed again if it is still due with the same 'next_retry_at' one fetch interval later, for example the claim failed
+        self._dispatched = {}
+        #(next retry at,event id) of the last fetched event if more events are due, the next page is fetched after it
+        self._cursor = None
+        #the timestamp to fetch the due events from database
+        self._fetch_at = 0
+
+    def wake(self,delay=0):
+        """
+        Fetch the due events from database after delay seconds
+        """
+        with self._condition:
+            fetch_at = time.time() + delay
+            if fetch_at < self._fetch_at:
+                self._fetch_at = fetch_at
+                #the woken events maybe before the cursor
+                self._cursor = None
+                self._condition.notify_all()
 
     def shutdown(self):
-        self._shutdown=True
+        with self._condition:
+            self._shutdown = True
+            self._condition.notify_all()
         if self.is_alive():
             self.join()
 
@@ -36,39 +177,91 @@ class ReplayFailedEventsWorker(Thread):
     def is_alive(self):
         return True if self._running else False
 
-    def join(self):
-        while self._running:
-            time.sleep(0.1)
+    def join(self,timeout=None):
+        if self._running:
+            self._ended.wait(timeout)
+
+    def _fetch(self):
+        fetch_interval = models.SubscribedEvent.REPROCESSING_INTERVAL.total_seconds()
+        now = time.time()
+        try:
+            rows = self.subscriber._retry_events(timezone.now() + models.SubscribedEvent.REPROCESSING_INTERVAL,settings.RETRY_FETCH_SIZE,self._cursor)
+        except:
+            logger.error("Failed to fetch the events to retry for {}.{}".format(self.subscriber.subscriber.name,traceback.format_exc()))
+            with self._condition:
+                self._fetch_at = now + 2
+            return
+
+        with self._condition:
+            for event_id,event_type_name,next_retry_at in rows:
+                dispatched = self._dispatched.get(event_id)
+                if (dispatched and dispatched[0] == next_retry_at and dispatched[1] > now - fetch_interval) or self._scheduled.get(event_id) == next_retry_at:
+                    #already enqueued recently or scheduled
+                    continue
+                self._scheduled[event_id] = next_retry_at
+                heapq.heappush(self._heap,(next_retry_at.timestamp(),event_id,event_type_name,next_retry_at))
+
+            if len(rows) < settings.RETRY_FETCH_SIZE:
+                #all the due events are fetched, fetch from the earliest one next time
+                self._cursor = None
+                for event_id in [k for k,v in self._dispatched.items() if v[1] <= now - fetch_interval]:
+                    del self._dispatched[event_id]
+                self._fetch_at = now + fetch_interval
+            else:
+                #more events are due, fetch the next page after the last fetched event when it is due
+                self._cursor = (rows[-1][2],rows[-1][0])
+                self._fetch_at = max(now + RETRY_FETCH_MIN_INTERVAL,min(now + fetch_interval,rows[-1][2].timestamp()))
+
+    def _dispatch(self):
+        with self._condition:
+            now = time.time()
+            while self._heap and self._heap[0][0] <= now:
+                retry_time,event_id,event_type_name,next_retry_at = heapq.heappop(self._heap)
+                if self._scheduled.get(event_id) != next_retry_at:
+                    #rescheduled
+                    continue
+                del self._scheduled[event_id]
+                value = self.subscriber._event_types.get(event_type_name)
+                if not value:
+                    #unsubscribed
+                    continue
+                value[2].add(event_id)
+                self._dispatched[event_id] = (next_retry_at,now)
 
     def run(self):
         self._running = True
-        logger.info("Retrieve Failed Events for {} is running".format(self.subscriber.subscriber.name))
+        logger.info("Retry scheduler for {} is running".format(self.subscriber.subscriber.name))
         try:
-            waited_seconds = 0
             while not self._shutdown:
-                time.sleep(1)
-                waited_seconds += 1
-                if waited_seconds >= models.SubscribedEvent.REPROCESSING_INTERVAL.seconds:
-                    for event_type_name,value in self.subscriber._event_types.items():
-                        self.subscriber._replay_failed_events(event_type_name,value[0])
-                    waited_seconds = 0
+                with self._condition:
+                    wait_seconds = min(self._fetch_at,self._heap[0][0] if self._heap else self._fetch_at) - time.time()
+                    if wait_seconds > 0:
+                        self._condition.wait(wait_seconds)
+                        continue
+                    fetch = self._fetch_at <= time.time()
+                if fetch:
+                    self._fetch()
+                self._dispatch()
         except KeyboardInterrupt:
             pass
-        logger.info("Retrieve Failed Events for {} is end".format(self.subscriber.subscriber.name))
-        self._running = False
+        finally:
+            self._running = False
+            self._ended.set()
+        logger.info("Retry scheduler for {} is end".format(self.subscriber.subscriber.name))
 
 class Listener(Thread):
     def __init__(self,subscriber):
         super().__init__(name="Listener {}".format(subscriber.subscriber.name),daemon=False)
         self.subscriber = subscriber
         self._running = None
+        self._ended = Event()
 
     def is_alive(self):
         return True if self._running else False
 
-    def join(self):
-        while self._running:
-            time.sleep(0.1)
+    def join(self,timeout=None):
+        if self._running:
+            self._ended.wait(timeout)
 
     def run(self):
         self._running = True
@@ -77,144 +270,893 @@ class Listener(Thread):
             self.subscriber.listen()
         finally:
             self.subscriber.close()
+            self._running = False
+            self._ended.set()
         logger.info("Event listener for {} is end".format(self.subscriber.subscriber.name))
-        self._running = False
+
+#the partition key of a partitioned subscriber, the event source or a top level key of the payload
+PARTITION_KEY_RE = re.compile(r"^(source|payload\.[A-Za-z0-9_]+)$")
+
+def partition_value(partition_key,event):
+    """
+    Return the text of the partition key of the event, the same as the value in the sql expression returned by 'partition_sql'
+    """
+    if partition_key == "source":
+        value = event.source
+    else:
+        value = event.payload.get(partition_key[8:]) if isinstance(event.payload,dict) else None
+    if value is None:
+        return ""
+    return value if isinstance(value,str) else json.dumps(value)
+
+def partition_of(value,partitions):
+    """
+    Return the partition of the partition key text
+    """
+    return int(hashlib.md5(value.encode("utf-8")).hexdigest()[:8],16) % partitions
+
+def partition_sql(partition_key,partitions,alias="e"):
+    """
+    Return the sql expression of the partition of the event, the same as 'partition_of(partition_value(partition_key,event),partitions)'
+    """
+    if partition_key == "source":
+        value = "{}.source".format(alias)
+    else:
+        value = "{}.payload->>'{}'".format(alias,partition_key[8:])
+    #mod() instead of the operator '%', which is a parameter placeholder in the queries with parameters
+    return "mod(('x' || substr(md5(COALESCE({},'')),1,8))::bit(32)::bigint,{})".format(value,int(partitions))
+
+def assign_partitions(replica,replicas,partitions):
+    """
+    Return the set of the partitions assigned to the replica.
+    Each partition is assigned to the replica with the highest hash of (replica,partition), so only the partitions of the joined or dead replicas are moved
+    """
+    return frozenset(p for p in range(partitions) if max(replicas,key=lambda r:hashlib.md5("{}:{}".format(r,p).encode("utf-8")).digest()) == replica)
+
+class ReplicaMembership(Thread):
+    """
+    Keep the heartbeat of a replica of a partitioned subscriber, and assign the partitions of the events to the live replicas.
+    The partitions are rebalanced when a replica joins or its heartbeat expires, and the missed events of the acquired partitions are replayed
+    from the earliest position of the replicas
+    """
+    def __init__(self,subscriber,replica=None):
+        super().__init__(name="Replica Membership {}".format(subscriber.subscriber.name),daemon=True)
+        self.subscriber = subscriber
+        self.replica = replica or "{}:{}:{}".format(settings.HOSTNAME,os.getpid(),uuid.uuid4().hex[:8])
+        self.partitions = frozenset()
+        self.replicas = 0
+        #the earliest positions of all the replicas read by the latest heartbeat, event type name -> event id
+        self.positions = {}
+        self._shutdown = False
+        self._running = None
+        self._ended = Event()
+        self._wakeup = Event()
+
+    def is_alive(self):
+        return True if self._running else False
+
+    def join(self,timeout=None):
+        if self._running:
+            self._ended.wait(timeout)
+
+    def beat(self):
+        """
+        Save the heartbeat and rebalance the partitions if the live replicas are changed
+        """
+        with models.SubscriberReplica.database.active_context():
+            rows = models.SubscriberReplica.heartbeat(self.subscriber.subscriber,self.replica,self.subscriber._positions(),settings.REPLICA_TTL)
+        #the own row read by the statement is the one before this heartbeat
+        replicas = set(row[0] for row in rows if row[1])
+        replicas.add(self.replica)
+        positions = {}
+        for row in rows:
+            for event_type_name,position in (row[2] or {}).items():
+                if position is not None and (event_type_name not in positions or position < positions[event_type_name]):
+                    positions[event_type_name] = position
+        self.positions = positions
+        partitions = assign_partitions(self.replica,replicas,settings.SUBSCRIBER_PARTITIONS)
+        self.replicas = len(replicas)
+        if partitions == self.partitions:
+            return
+        acquired = partitions - self.partitions
+        logger.info("The partitions of {} are rebalanced among {} replicas, replica {} owns {} partitions, {} acquired".format(
+            self.subscriber.subscriber.name,len(replicas),self.replica,len(partitions),len(acquired)
+        ))
+        self.partitions = partitions
+        if acquired:
+            self.subscriber._on_partitions_acquired()
+
+    def run(self):
+        self._running = True
+        logger.info("Replica membership {} for {} is running".format(self.replica,self.subscriber.subscriber.name))
+        try:
+            while not self._shutdown:
+                #beat once started, the recreated membership owns no partitions before its first heartbeat
+                try:
+                    self.beat()
+                except:
+                    logger.error(traceback.format_exc())
+                self._wakeup.wait(settings.REPLICA_HEARTBEAT)
+            try:
+                with models.SubscriberReplica.database.active_context():
+                    models.SubscriberReplica.leave(self.subscriber.subscriber,self.replica,settings.REPLICA_TTL)
+            except:
+                logger.error(traceback.format_exc())
+        finally:
+            self._running = False
+            self._ended.set()
+        logger.info("Replica membership {} for {} is end".format(self.replica,self.subscriber.subscriber.name))
+
+    def shutdown(self):
+        self._shutdown = True
+        self._wakeup.set()
+        if self.is_alive():
+            self.join()
+
+    @property
+    def is_shutdown_requested(self):
+        return self._shutdown
+
+class ListenerHub(Thread):
+    """
+    The process-wide listener which listens to the channels of all the subscribers with one database connection.
+    The channels are reference counted, a channel is listened while at least one subscriber registers it,
+    and the notifications of a channel are dispatched to the subscribers registering the channel.
+    The channels are listened again after reconnecting, and the subscribers are told to subscribe again to replay the missed events.
+    """
+    _instance = None
+    _instance_lock = Lock()
+
+    def __init__(self):
+        super().__init__(name="Listener Hub",daemon=True)
+        self._database = settings.Database.Default.get("listener_hub",thread_safe=False)
+        self._connection = None
+        self._broken = False
+        self._connected_once = False
+        #channel -> the set of the subscribers registering the channel
+        self._channels = {}
+        self._lock = RLock()
+        #the pipe to wake up the hub blocked in select when the connection is broken.
+        #the hub is created once per process and runs until the process exits, the pipe is closed when the hub is finalised
+        self._wakeup_fds = os.pipe()
+        os.set_blocking(self._wakeup_fds[0],False)
+
+    def __del__(self):
+        for fd in self._wakeup_fds:
+            try:
+                os.close(fd)
+            except OSError:
+                pass
+
+    @classmethod
+    def get(cls):
+        """
+        Return the listener hub of the process, start it if not started
+        """
+        if not cls._instance:
+            with cls._instance_lock:
+                if not cls._instance:
+                    hub = ListenerHub()
+                    hub.start()
+                    cls._instance = hub
+        return cls._instance
+
+    @property
+    def channels(self):
+        return list(self._channels.keys())
+
+    def register(self,subscriber,channel):
+        """
+        Dispatch the notifications of the channel to the subscriber; the channel is listened if it's not listened before
+        """
+        with self._lock:
+            subscribers = self._channels.get(channel)
+            if subscribers is None:
+                subscribers = set()
+                self._channels[channel] = subscribers
+                self._execute('LISTEN "{}";'.format(channel))
+                logger.info("Listener hub listens to {}".format(channel))
+            subscribers.add(subscriber)
+
+    def unregister(self,subscriber,channel):
+        """
+        Stop dispatching the notifications of the channel to the subscriber; the channel is unlistened if no subscriber registers it
+        """
+        with self._lock:
+            subscribers = self._channels.get(channel)
+            if not subscribers or subscriber not in subscribers:
+                return
+            subscribers.discard(subscriber)
+            if not subscribers:
+                del self._channels[channel]
+                self._execute('UNLISTEN "{}";'.format(channel))
+                logger.info("Listener hub stops listening to {}".format(channel))
+
+    def _execute(self,sql):
+        """
+        Execute the statement if connected; otherwise the channels are listened by the hub thread after connected
+        """
+        if not self._connection or self._broken:
+            return
+        try:
+            with self._connection.cursor() as cur:
+                cur.execute(sql)
+            if self._connection.notifies:
+                #the notifications read by the statement don't make the socket readable again, wake up the hub to dispatch them
+                os.write(self._wakeup_fds[1],b"\0")
+        except:
+            logger.error("Failed to execute '{}' in listener hub, reconnect.{}".format(sql,traceback.format_exc()))
+            self._broken = True
+            os.write(self._wakeup_fds[1],b"\0")
+
+    def _connect(self):
+        self._database.connect(reuse_if_open=True)
+        connection = self._database.connection()
+        connection.autocommit = True
+        with self._lock:
+            with connection.cursor() as cur:
+                for channel in self._channels.keys():
+                    cur.execute('LISTEN "{}";'.format(channel))
+            self._connection = connection
+            self._broken = False
+            subscribers = set()
+            if self._connected_once:
+                for v in self._channels.values():
+                    subscribers.update(v)
+            self._connected_once = True
+        #the notifications are lost when the connection was broken
+        for subscriber in subscribers:
+            try:
+                subscriber._on_reconnected()
+            except:
+                logger.error("Failed to subscribe again for {}.{}".format(subscriber.subscriber.name,traceback.format_exc()))
+
+    def _listen(self):
+        while True:
+            readable = select.select([self._connection,self._wakeup_fds[0]],[],[])[0]
+            if self._wakeup_fds[0] in readable:
+                try:
+                    os.read(self._wakeup_fds[0],1024)
+                except BlockingIOError:
+                    pass
+            if self._broken:
+                raise Exception("The connection of listener hub is broken")
+            if self._connection not in readable and not self._connection.notifies:
+                continue
+            targets = collections.OrderedDict()
+            with self._lock:
+                self._connection.poll()
+                notifies = self._connection.notifies
+                self._connection.notifies = []
+                for notify_event in notifies:
+                    for subscriber in self._channels.get(notify_event.channel,()):
+                        if subscriber in targets:
+                            targets[subscriber].append(notify_event)
+                        else:
+                            targets[subscriber] = [notify_event]
+            for subscriber,subscriber_notifies in targets.items():
+                try:
+                    subscriber._dispatch_notifies(subscriber_notifies)
+                except:
+                    logger.error("Failed to dispatch the notifications to {}.{}".format(subscriber.subscriber.name,traceback.format_exc()))
+
+    def run(self):
+        logger.info("Listener hub is running")
+        while True:
+            try:
+                self._connect()
+                self._listen()
+            except:
+                logger.error("The listener hub is broken, try again after 2 seconds.{}".format(traceback.format_exc()))
+                with self._lock:
+                    self._connection = None
+                try:
+                    self._database.close()
+                except:
+                    pass
+                time.sleep(2)
 
 class Worker(Thread):
-    def __init__(self,subscriber,event_type_name):
+    def __init__(self,subscriber,event_type_name,concurrency=1,ordering_key=None,batch_size=1,replay_page_size=500,queue_size=10000):
+        """
+        concurrency: the maximum number of events processed concurrently; the events are processed in a thread pool if concurrency is greater than 1
+        ordering_key: optional function to get the ordering key from the event; the events with the same key are processed in order. ignored in batch mode
+        batch_size: the maximum number of events claimed and completed together; batch mode is enabled if batch_size is greater than 1
+        replay_page_size: the number of event ids fetched from the database at one time when replaying events
+        queue_size: the maximum number of events in the queue; the events added into a full queue are refilled from the database later
+        """
         super().__init__(name="Worker {}.{} ".format(subscriber.subscriber.name,event_type_name),daemon=False)
         self.subscriber = subscriber
         self.event_type_name = event_type_name
+        self.concurrency = concurrency or 1
+        self.ordering_key = ordering_key
+        self.batch_size = batch_size or 1
+        self.queue_size = queue_size or 10000
+        #a page is refilled when the queue is shorter than a page, so a page is at most half of the queue
+        self.replay_page_size = max(1,min(replay_page_size,self.queue_size // 2))
+        #the queue is not bounded, so the shutdown and refill messages can always be put; the size of the events is limited by 'add'
         self._queue = queue.Queue()
+        #the event id range [start,end] of the events which were not queued because the queue was full
+        self._overflow = None
+        self.overflowed = 0
+        #the ids of the events which are queued or being processed, the duplicated events are dropped when added
+        self._inflight = set()
+        self.deduplicated = 0
+        #the event id ranges [start,end] to replay from the database, end is None means no upper bound
+        self._replay_ranges = collections.deque()
         self._shutdown = False
         self._running = None
+        self._ended = Event()
+        self._executor = None
+        #limit the number of events submitted to the thread pool
+        self._slots = Semaphore(self.concurrency)
+        #the pending events per ordering key, the key exists if one event with the key is being processed
+        self._keys = {}
+        self._lock = Lock()
 
     def is_alive(self):
         return True if self._running else False
 
-    def join(self):
-        while self._running:
-            time.sleep(0.1)
+    def join(self,timeout=None):
+        if self._running:
+            self._ended.wait(timeout)
 
     def run(self):
         self._running = True
         logger.info("The worker thread for {}->{} is running".format(self.subscriber.subscriber.name,self.event_type_name))
+        if self.concurrency > 1:
+            self._executor = ThreadPoolExecutor(max_workers=self.concurrency,thread_name_prefix="Worker {}.{}".format(self.subscriber.subscriber.name,self.event_type_name))
         while True:
             event = None
             try:
-                event = self._queue.get(block=True,timeout=2)
-                logger.debug("Got Event({} for )({}->{})".format(event,self.subscriber.subscriber.name,self.event_type_name))
-                processed = self.subscriber.process_event(event)
-                if not processed:
-                    #event is not processed, add to the end of the queue again.
-                    self._queue.put(event)
-            except queue.Empty:
-                #logger.debug("Event queue({}->{}) is empty,shutdown={}".format(self.subscriber.subscriber.name,self.event_type_name,self._shutdown))
                 if self._shutdown:
-                    #no more event to processing,and user already requests to shutdown
-                    break
+                    #stop fetching the replayed and overflowed events after shutdown is requested, only the queued events are processed;
+                    #the dropped events are replayed from last_dispatched_event_id when the event type is subscribed again
+                    with self._lock:
+                        self._replay_ranges.clear()
+                        self._overflow = None
+                    if self._queue.empty():
+                        break
+                if self._overflow and self._queue.qsize() < self.replay_page_size:
+                    #the queue is draining, refill the overflowed events from the database
+                    with self._lock:
+                        self._replay_ranges.append(self._overflow)
+                        self._overflow = None
+                if self._replay_ranges and self._queue.qsize() < self.replay_page_size:
+                    self._refill()
+                #block until an event or a message is put; wake up later to refill again if the refill failed
+                event = self._queue.get(block=True,timeout=REFILL_RETRY_INTERVAL if self._replay_ranges else None)
+                if event is _SHUTDOWN or event is _REFILL:
+                    event = None
+                    continue
+                logger.debug("Got Event({} for )({}->{})".format(event,self.subscriber.subscriber.name,self.event_type_name))
+                if self.batch_size > 1:
+                    events = [event]
+                    event = None
+                    while len(events) < self.batch_size:
+                        try:
+                            e = self._queue.get(block=False)
+                        except queue.Empty:
+                            break
+                        if e is not _SHUTDOWN and e is not _REFILL:
+                            events.append(e)
+                    if self._executor:
+                        self._slots.acquire()
+                        self._executor.submit(self._run_batch,events)
+                    else:
+                        self._process_batch(events)
+                elif self._executor:
+                    event = self._dispatch(event)
                 else:
-                    pass
+                    self._process(event)
+            except queue.Empty:
+                #the refill failed before, try again
+                pass
             except KeyboardInterrupt:
                 break
             except:
                 #failed to process the event,add to the end of the queue again
                 logger.error(traceback.format_exc())
                 if event:
-                    self._queue.put(event)
+                    self._requeue([event])
 
+        if self._executor:
+            #wait for the events being processed
+            self._executor.shutdown(wait=True)
+            self._executor = None
         logger.info("The worker thread for {}->{} is end".format(self.subscriber.subscriber.name,self.event_type_name))
         self._running = False
+        self._ended.set()
+
+    def _process(self,event):
+        try:
+            processed = self.subscriber.process_event(event)
+            if not processed:
+                #event is not processed, add to the end of the queue again.
+                self._requeue([event])
+                return
+        except:
+            #failed to process the event,add to the end of the queue again
+            logger.error(traceback.format_exc())
+            self._requeue([event])
+            return
+        self._release([event])
+
+    def _process_batch(self,events):
+        try:
+            self.subscriber.process_events(events)
+        except:
+            #failed to process the events,add to the end of the queue again
+            logger.error(traceback.format_exc())
+            self._requeue(events)
+            return
+        self._release(events)
+
+    def _run_batch(self,events):
+        try:
+            self._process_batch(events)
+        finally:
+            self._slots.release()
+
+    def _dispatch(self,event):
+        """
+        Submit the event to the thread pool; the event is queued after the event being processed with the same ordering key.
+        Return None if dispatched; otherwise return the event
+        """
+        key = None
+        if self.ordering_key:
+            if not isinstance(event,models.Event):
+                try:
+                    with models.Event.database.active_context():
+                        event = models.Event.fetch(event)
+                except models.Event.DoesNotExist:
+                    #the event is deleted, for example its partition is dropped
+                    logger.warning("The event({}) doesn't exist, ignore it".format(event))
+                    self._release([event])
+                    return None
+            key = self.ordering_key(event)
+            with self._lock:
+                if key in self._keys:
+                    #the event with the same key is being processed
+                    self._keys[key].append(event)
+                    return None
+                self._keys[key] = collections.deque()
+
+        self._slots.acquire()
+        try:
+            self._executor.submit(self._run,event,key)
+        except:
+            self._slots.release()
+            if key is not None:
+                with self._lock:
+                    pending = self._keys.pop(key)
+                self._requeue(pending)
+            raise
+        return None
+
+    def _run(self,event,key):
+        """
+        Process the event and then the pending events with the same ordering key in the thread pool
+        """
+        try:
+            while True:
+                self._process(event)
+                if key is None:
+                    break
+                with self._lock:
+                    pending = self._keys[key]
+                    if pending:
+                        event = pending.popleft()
+                    else:
+                        del self._keys[key]
+                        break
+        finally:
+            self._slots.release()
 
     def add(self,event):
-        self._queue.put(event)
+        """
+        Add the event into the queue without blocking.
+        If the queue is full, the event id is recorded in the overflow range and the events in the range are refilled from the database once the queue is draining.
+        Return True if queued; return False if overflowed or the event is already queued or being processed
+        """
+        return self.add_many([event]) == 1
 
-    def shutdown(self):
+    def add_many(self,events):
+        """
+        Add the events into the queue without blocking; the events which are already queued or being processed are dropped.
+        Return the number of the queued events
+        """
+        queued = 0
+        with self._lock:
+            for event in events:
+                event_id = event.id if isinstance(event,models.Event) else event
+                if event_id in self._inflight:
+                    self.deduplicated += 1
+                    continue
+                if self._queue.qsize() < self.queue_size:
+                    self._inflight.add(event_id)
+                    self._queue.put(event,block=False)
+                    queued += 1
+                elif self._overflow:
+                    self._overflow[0] = min(self._overflow[0],event_id - 1)
+                    self._overflow[1] = max(self._overflow[1],event_id)
+                    self.overflowed += 1
+                else:
+                    logger.warning("The queue of {}->{} is full, the new events will be refilled from the database later".format(self.subscriber.subscriber.name,self.event_type_name))
+                    self._overflow = [event_id - 1,event_id]
+                    self.overflowed += 1
+        return queued
+
+    def _release(self,events):
+        """
+        Remove the processed events from the in-flight events
+        """
+        with self._lock:
+            for event in events:
+                self._inflight.discard(event.id if isinstance(event,models.Event) else event)
+
+    def _requeue(self,events):
+        """
+        Add the events which are failed to process to the end of the queue again.
+        The events are still in-flight, they are queued even if the queue is full instead of widening the overflow range back to their ids
+        """
+        with self._lock:
+            for event in events:
+                self._queue.put(event,block=False)
+
+    @property
+    def position(self):
+        """
+        Return the event id before the earliest event which is queued, being processed, overflowed or to be replayed; None if the worker is idle
+        """
+        with self._lock:
+            positions = [event_id - 1 for event_id in self._inflight]
+            if self._overflow:
+                positions.append(self._overflow[0])
+        positions.extend(replay_range[0] for replay_range in list(self._replay_ranges))
+        return min(positions) if positions else None
+
+    def replay(self,start,end=None):
+        """
+        Replay the events whose id is in range (start,end], end is None means no upper bound.
+        The event ids are fetched from the database page by page only when the queue is running low.
+        """
+        self._replay_ranges.append([start,end])
+        self._queue.put(_REFILL)
+
+    def _refill(self):
+        """
+        Fetch the next page of event ids from the first replay range into the queue
+        """
+        replay_range = self._replay_ranges[0]
+        #only fetch the events fitting in the queue, otherwise the refilled events overflow the queue they are refilling
+        limit = min(self.replay_page_size,self.queue_size - self._queue.qsize())
+        if limit <= 0:
+            return
+        try:
+            event_ids = self.subscriber._event_ids(self.event_type_name,replay_range[0],replay_range[1],limit)
+        except:
+            logger.error("Failed to fetch the events to replay for {}->{}.{}".format(self.subscriber.subscriber.name,self.event_type_name,traceback.format_exc()))
+            return
+        if event_ids:
+            replay_range[0] = event_ids[-1]
+        if len(event_ids) < limit:
+            #no more events in the range
+            self._replay_ranges.popleft()
+        self.add_many(event_ids)
+
+    def shutdown(self,wait=True):
+        """
+        wait: wait for the queued events to be processed if True
+        """
         self._shutdown=True
-        if self.is_alive():
+        #wake up the worker blocked on the empty queue
+        self._queue.put(_SHUTDOWN)
+        if wait and self.is_alive():
             self.join()
 
     @property
     def is_shutdown_requested(self):
         return self._shutdown
 
+class PullWorker(Worker):
+    """
+    The worker in pull mode.
+    The events are claimed from database in batches and the events being claimed by the other replicas are skipped, so the replicas of the subscriber claim different events
+    instead of racing on the same events; the notifications and the retry scheduler only wake up the worker to pull.
+    The events with the same ordering key are processed in order in one pulled batch, but not across the replicas.
+    """
+    def __init__(self,*args,**kwargs):
+        super().__init__(*args,**kwargs)
+        #pull the new events after this event id; None before the position is set by the subscriber
+        self._after = None
+        self._wakeup = Event()
+
+    def run(self):
+        self._running = True
+        logger.info("The pull worker thread for {}->{} is running".format(self.subscriber.subscriber.name,self.event_type_name))
+        if self.concurrency > 1:
+            self._executor = ThreadPoolExecutor(max_workers=self.concurrency,thread_name_prefix="Worker {}.{}".format(self.subscriber.subscriber.name,self.event_type_name))
+        try:
+            while not self._shutdown:
+                #clear before pulling, the events notified during pulling are pulled next time
+                self._wakeup.clear()
+                if self._after is None:
+                    #wait until the pull position is set by the subscriber
+                    self._wakeup.wait()
+                    continue
+                try:
+                    start = self._after
+                    claimed,after = self.subscriber._pull_events(self.event_type_name,start,self.batch_size * self.concurrency)
+                    with self._lock:
+                        #keep the position if it's moved back by replay during pulling
+                        if self._after == start:
+                            self._after = after
+                except:
+                    logger.error("Failed to pull the events for {}->{}.{}".format(self.subscriber.subscriber.name,self.event_type_name,traceback.format_exc()))
+                    self._wakeup.wait(REFILL_RETRY_INTERVAL)
+                    continue
+                if claimed:
+                    self._process_claimed(claimed,after)
+                else:
+                    #wait for a notification, a due retry or the next pull
+                    self._wakeup.wait(settings.PULL_INTERVAL)
+        except KeyboardInterrupt:
+            pass
+        finally:
+            if self._executor:
+                self._executor.shutdown(wait=True)
+                self._executor = None
+            logger.info("The pull worker thread for {}->{} is end".format(self.subscriber.subscriber.name,self.event_type_name))
+            self._running = False
+            self._ended.set()
+
+    def _process_claimed(self,claimed,position):
+        """
+        Process the claimed events, the events are split into chunks by ordering key and processed in the thread pool if concurrency is greater than 1
+        position: the pull position returned with the claimed events
+        """
+        if not self._executor:
+            self._process_chunk(claimed,position)
+            return
+        chunks = [[] for i in range(self.concurrency)]
+        for i,item in enumerate(claimed):
+            index = hash(self.ordering_key(item[0])) if self.ordering_key else i
+            chunks[index % self.concurrency].append(item)
+        for future in [self._executor.submit(self._process_chunk,chunk,position) for chunk in chunks if chunk]:
+            future.result()
+
+    def _process_chunk(self,claimed,position):
+        try:
+            self.subscriber._process_claimed(claimed,position)
+        except:
+            #the claimed events are retried after the processing timeout
+            logger.error(traceback.format_exc())
+
+    def add_many(self,events):
+        """
+        The events are pulled from database, only wake up the worker
+        """
+        self._wakeup.set()
+        return 0
+
+    def replay(self,start,end=None):
+        """
+        Move the pull position back to start, the events after start which are not claimed are pulled
+        """
+        with self._lock:
+            self._after = start if self._after is None else min(self._after,start)
+        self._wakeup.set()
+
+    def shutdown(self,wait=True):
+        self._shutdown=True
+        self._wakeup.set()
+        if wait and self.is_alive():
+            self.join()
+
 
 class Subscriber(object):
-    def __init__(self,subscriber,database=None,select_timeout=5,process_missed_events=True,category=models.PROGRAMMATIC):
+    def __init__(self,subscriber,database=None,select_timeout=5,process_missed_events=True,category=models.PROGRAMMATIC,executor=THREAD,processes=None,shared_listener=None,pull=None,partition_key=None):
+        """
+        partition_key: split the events among the replicas of the subscriber by the hash of the key, "source" or "payload.<key>";
+            each replica only processes and replays the events of its own partitions, which are rebalanced when a replica joins or its heartbeat expires
+        pull: claim the events from database in batches in pull workers, skipping the events being claimed by the other replicas, default is settings.SUBSCRIBER_PULL; use it if the subscriber runs in several processes
+        shared_listener: listen with the process-wide ListenerHub instead of a dedicated connection, default is settings.SHARED_LISTENER; database and select_timeout are not used if True
+        executor: the default executor to run the callbacks, THREAD or PROCESS; managed event types are always subscribed with this executor
+        processes: the number of the processes in the process pool, default is the number of cpus
+        """
         if isinstance(subscriber,models.Subscriber):
             self.subscriber = subscriber
         elif category == models.MANAGED:
-            with models.Subscriber.database.active_context():
-                self.subscriber = models.Subscriber.get_by_id(subscriber)
+            self.subscriber = models.Subscriber.cache.get(subscriber)
         else:
-            with models.Subscriber.database.active_context():
-                self.subscriber,created = models.Subscriber.get_or_create(name=subscriber,defaults={
-                    'category':category,
-                    'active':True,
-                    'active_modifier':models.User.PROGRAMMATIC,
-                    'active_modified':timezone.now(),
-                    'modifier':models.User.PROGRAMMATIC,
-                    'modified':timezone.now(),
-                    'creator':models.User.PROGRAMMATIC,
-                    'created':timezone.now(),
-                })
+            self.subscriber = models.Subscriber.cache.get_or_create(subscriber,defaults={
+                'category':category,
+                'active':True,
+                'active_modifier':models.User.PROGRAMMATIC,
+                'active_modified':timezone.now(),
+                'modifier':models.User.PROGRAMMATIC,
+                'modified':timezone.now(),
+                'creator':models.User.PROGRAMMATIC,
+                'created':timezone.now(),
+            })
 
         self._host = settings.HOSTNAME
-        self._database = database or settings.Database.Default.get("listener_{}".format(self.subscriber.name),thread_safe=False)
+        if shared_listener is None:
+            shared_listener = settings.SHARED_LISTENER
+        self._hub = ListenerHub.get() if shared_listener else None
+        self._database = None if self._hub else (database or settings.Database.Default.get("listener_{}".format(self.subscriber.name),thread_safe=False))
         self._connection = None
+        self._worker_class = PullWorker if (settings.SUBSCRIBER_PULL if pull is None else pull) else Worker
+        if partition_key and not PARTITION_KEY_RE.match(partition_key):
+            raise Exception("The partition key({}) is invalid, it should be 'source' or 'payload.<key>'".format(partition_key))
+        if partition_key and self._worker_class is PullWorker:
+            raise Exception("The partitioned subscriber can't run in pull mode")
+        self._partition_key = partition_key
         self._select_timeout = select_timeout
         self._event_types = {}
+        #the items of the unsubscribed event types whose workers are retired without waiting, the queued events are finished with the old callbacks
+        self._retired = {}
         self._process_missed_events = process_missed_events
-        #automatically listen to managed events
-        with models.SubscribedEventType.database.active_context():
-            managed_event_types = models.SubscribedEventType.select().where(
-                (models.SubscribedEventType.subscriber == self.subscriber) &
-                (models.SubscribedEventType.active == True) &
-                (models.SubscribedEventType.category == models.MANAGED) 
-            )
-            for event_type in managed_event_types:
-                if not event_type.callback:
-                    #no event processing module, ignore
-                    continue
-                try:
-                    if not event_type.callback:
-                        #no event processing module, ignore
-                        continue
-                    self.subscribe(event_type,event_type.callback,auto_subscribe=True)
-
-                except:
-                    logger.error(traceback.format_exc())
-
+        self._executor = executor
+        self._processes = processes
+        self._process_pool = None
+        self._process_pool_lock = Lock()
+        self._control_listened = False
         self._listener = Listener(self)
-        self._replay_failed_events_worker = ReplayFailedEventsWorker(self)
+        self._retry_scheduler = RetryScheduler(self)
         self._shutdown = False
+        #the pipe to wake up the listener blocked in select when shutdown is requested; opened when started and closed when closed
+        self._wakeup_fds = None
+        self._wakeup_lock = Lock()
+        if self._hub:
+            #listen the changes of the managed subscriptions
+            self._hub.register(self,settings.SUBSCRIPTION_CHANNEL)
+            self._control_listened = True
+        self._membership = None
+        if partition_key:
+            #join the replicas before subscribing, so the missed events of the own partitions are replayed
+            self._membership = ReplicaMembership(self)
+            self._membership.beat()
+        #automatically listen to managed events
+        self.reload_managed_subscriptions()
 
 
     @property
     def started(self):
         return self._listener.is_alive()
 
+    @property
+    def process_pool(self):
+        #the workers create the pool lazily and concurrently, only one pool can be created
+        with self._process_pool_lock:
+            if not self._process_pool:
+                self._process_pool = ProcessPoolExecutor(max_workers=self._processes)
+            return self._process_pool
+
+    def _reset_process_pool(self,wait=False,broken=None):
+        """
+        broken: only reset the pool if it is still the broken pool, which maybe already recreated by another worker
+        """
+        with self._process_pool_lock:
+            pool = self._process_pool
+            if broken is not None and pool is not broken:
+                return
+            self._process_pool = None
+        if pool:
+            try:
+                pool.shutdown(wait=wait)
+            except:
+                pass
+
     @property
     def connection(self):
-        if not self._database.is_active or not self._connection:
+        #the listen loop cleans the database if an error happened, so only check the connection state instead of running 'SELECT 1' for each access
+        if not self._connection or self._connection.closed or self._database.is_closed():
             logger.info("Try to connect to database")
             self._database.connect(reuse_if_open=True,check_active=True)
             self._connection = self._database.connection()
             self._connection.autocommit = True
-
-            for event_type_name,value in self._event_types.items():
-                self.subscribe(value[0].event_type,value[1],resubscribe=True,auto_subscribe=True)
+            self._on_reconnected()
 
         return self._connection
 
-    def shutdown(self,async=False):
+    def _on_reconnected(self):
+        """
+        Subscribe the event types again to replay the missed events, and reload the managed subscriptions;
+        called after the listen connection is connected
+        """
+        for event_type_name,value in list(self._event_types.items()):
+            self.subscribe(value[0].event_type_id,value[1],resubscribe=True,auto_subscribe=True)
+
+        #listen the changes of the managed subscriptions
+        self._listen(settings.SUBSCRIPTION_CHANNEL)
+        if self._control_listened:
+            #the changes may be missed when the connection was broken
+            try:
+                self.reload_managed_subscriptions()
+            except:
+                logger.error("Failed to reload the managed subscriptions.{}".format(traceback.format_exc()))
+        self._control_listened = True
+
+    def _listen(self,channel):
+        if self._hub:
+            self._hub.register(self,channel)
+        else:
+            with self.connection.cursor() as cur:
+                cur.execute('LISTEN "{}";'.format(channel))
+
+    def _unlisten(self,channel):
+        if self._hub:
+            self._hub.unregister(self,channel)
+        else:
+            with self.connection.cursor() as cur:
+                cur.execute('UNLISTEN "{}";'.format(channel))
+
+    def reload_managed_subscriptions(self):
+        """
+        Compare the active managed subscribed event types in database with the current subscriptions,
+        subscribe the new ones, unsubscribe the removed or deactivated ones, and swap the subscribed event type and callback of the others.
+        The callbacks are swapped and the workers of the unsubscribed ones are retired without draining the workers, the events being processed are finished with the old callbacks.
+        """
+        with models.SubscribedEventType.database.active_context():
+            managed_event_types = dict(('{}.{}'.format(o.publisher_id,o.event_type_id),o) for o in models.SubscribedEventType.select().where(
+                (models.SubscribedEventType.subscriber == self.subscriber.name) &
+                (models.SubscribedEventType.active == True) &
+                (models.SubscribedEventType.category == models.MANAGED) 
+            ))
+
+        for event_type_name,value in list(self._event_types.items()):
+            if value[0].category == models.MANAGED and event_type_name not in managed_event_types:
+                logger.info("The managed subscription({}) is removed or deactivated".format(value[0]))
+                #the reload runs on the listener thread, don't block the notifications of the other subscriptions
+                self.unsubscribe(value[0].event_type_id,wait=False)
+
+        for event_type_name,subscribed_event_type in managed_event_types.items():
+            try:
+                callback = subscribed_event_type.callback
+                value = self._event_types.get(event_type_name)
+                if not callback:
+                    #no event processing module, ignore
+                    if value and value[0].category == models.MANAGED:
+                        self.unsubscribe(subscribed_event_type.event_type_id,wait=False)
+                    continue
+                if not value:
+                    self.subscribe(subscribed_event_type,callback,auto_subscribe=True)
+                    continue
+                if isinstance(value[1],ProcessCallback):
+                    callback = ProcessCallback(self,subscribed_event_type,callback)
+                #replace the whole item, so the subscribed event type and the callback are always read together
+                self._event_types[event_type_name] = [subscribed_event_type,callback,value[2]]
+            except:
+                logger.error(traceback.format_exc())
+
+    def _on_subscription_changed(self,notify_event):
+        """
+        Process the notification from the subscription channel
+        """
+        payload = json.loads(notify_event.payload)
+        if payload.get("module"):
+            #the event processing module is changed, reload it before the invalidator thread
+            models.EventProcessingModule.cache.invalidate(payload["module"])
+        elif payload.get("subscriber") != self.subscriber.name:
+            return
+        logger.info("The managed subscriptions of {} are changed, reload them".format(self.subscriber.name))
+        self.reload_managed_subscriptions()
+
+    def shutdown(self,wait=True):
         self._shutdown = True
-        if self._replay_failed_events_worker.is_alive():
-            self._replay_failed_events_worker.shutdown()
+        with self._wakeup_lock:
+            if self._wakeup_fds:
+                os.write(self._wakeup_fds[1],b"\0")
+        if self._retry_scheduler.is_alive():
+            self._retry_scheduler.shutdown()
+        if self._membership and self._membership.is_alive():
+            self._membership.shutdown()
 
         if not self._listener.is_alive():
             self.close()
-        elif not async:
+        elif wait:
             if self._listener.is_alive():
                 self._listener.join()
 
@@ -226,173 +1168,298 @@ class Subscriber(object):
             self.shutdown()
 
 
+    def _subscription(self,event_type_name):
+        """
+        Return the item [subscribed event type,callback,worker] of the event type, or the item of the retired worker if the event type is unsubscribed
+        """
+        value = self._event_types.get(event_type_name)
+        return value if value else self._retired[event_type_name]
+
     def _replay_missed_events(self,event_type_name,subscribed_event_type):
-        if not subscribed_event_type.replay_missed_events:
-            return
+        """
+        Replay the events after the last dispatched event; the worker fetches the event ids page by page when its queue is running low
+        """
+        worker = self._event_types[event_type_name][2]
+        if subscribed_event_type.replay_missed_events:
+            worker.replay(self._replay_start(event_type_name,subscribed_event_type))
+        elif isinstance(worker,PullWorker):
+            #pull the events published after subscribing
+            worker.replay(self._latest_event_id(event_type_name))
+
+    def _event_ids(self,event_type_name,start,end,limit):
+        """
+        Return the ids of the events whose id is in range (start,end] in order, end is None means no upper bound
+        """
+        subscribed_event_type = self._subscription(event_type_name)[0]
+        if self._membership:
+            return self._partition_event_ids(subscribed_event_type,start,end,limit)
+        condition = (models.Event.event_type == subscribed_event_type.event_type_id) & (models.Event.id > start)
+        if end is not None:
+            condition = condition & (models.Event.id <= end)
         with models.Event.database.active_context():
-            if subscribed_event_type.last_dispatched_event:
-                missing_events = models.Event.select().where(
-                    (models.Event.event_type == subscribed_event_type.event_type) &
-                    (models.Event.id > subscribed_event_type.last_dispatched_event.id)
-                )
-            else:
-                missing_events = models.Event.select().where(
-                    (models.Event.event_type == subscribed_event_type.event_type)
-                )
+            return [row[0] for row in models.Event.select(models.Event.id).where(condition).order_by(models.Event.id).limit(limit).tuples()]
 
-            for event in missing_events:
-                self._event_types[event_type_name][2].add(event)
+    def _partition_condition(self,alias="e"):
+        """
+        Return (sql,params) of the condition that the event is in the own partitions
+        """
+        return ("{} = ANY(%s)".format(partition_sql(self._partition_key,settings.SUBSCRIBER_PARTITIONS,alias)),[sorted(self._membership.partitions)])
 
-    def _replay_failed_events(self,event_type_name,subscribed_event_type):
-        if not subscribed_event_type.replay_failed_events:
-            return
+    def _owns(self,event):
+        return partition_of(partition_value(self._partition_key,event),settings.SUBSCRIBER_PARTITIONS) in self._membership.partitions
+
+    def _partition_event_ids(self,subscribed_event_type,start,end,limit):
+        """
+        Return the ids of the events of the own partitions whose id is in range (start,end] in order, the events processed by any replica are skipped
+        """
+        partition_condition,params = self._partition_condition()
+        sql = """
+SELECT e.id FROM event AS e
+WHERE e.event_type_id = %s AND e.id > %s{} AND {}
+AND NOT EXISTS (SELECT 1 FROM subscribed_event AS s WHERE s.subscriber_id = %s AND s.event_id = e.id)
+ORDER BY e.id LIMIT %s
+""".format("" if end is None else " AND e.id <= %s",partition_condition)
+        params = [subscribed_event_type.event_type_id,start] + ([] if end is None else [end]) + params + [self.subscriber.name,limit]
+        with models.Event.database.active_context():
+            return [row[0] for row in models.Event.database.execute_sql(sql,params).fetchall()]
+
+    def _filter_event_ids(self,event_ids):
+        """
+        Return the ids of the events of the own partitions in the event ids
+        """
+        partition_condition,params = self._partition_condition()
+        with models.Event.database.active_context():
+            return [row[0] for row in models.Event.database.execute_sql(
+                "SELECT e.id FROM event AS e WHERE e.id = ANY(%s) AND {} ORDER BY e.id".format(partition_condition),
+                [event_ids] + params
+            ).fetchall()]
+
+    def _positions(self):
+        """
+        Return the positions of the replica: event type name -> the event id before which all the notified events are processed
+        """
+        positions = {}
+        for event_type_name,value in list(self._event_types.items()):
+            position = value[2].position
+            positions[event_type_name] = (value[0].last_dispatched_event_id or 0) if position is None else position
+        return positions
+
+    def _replay_start(self,event_type_name,subscribed_event_type):
+        """
+        Return the event id to replay the missed events after
+        """
+        start = subscribed_event_type.last_dispatched_event_id or 0
+        if self._membership and event_type_name in self._membership.positions:
+            #last_dispatched_event_id is advanced by the fastest replica, the events of the own partitions before it may be not processed
+            start = min(start,self._membership.positions[event_type_name])
+        return start
+
+    def _on_partitions_acquired(self):
+        """
+        Replay the missed events of the acquired partitions from the earliest position of the replicas
+        """
+        for event_type_name,value in list(self._event_types.items()):
+            value[2].replay(self._replay_start(event_type_name,value[0]))
+        #the failed events of the acquired partitions are retried by this replica now
+        self._retry_scheduler.wake()
+
+    def _latest_event_id(self,event_type_name):
+        """
+        Return the id of the latest event of the event type; 0 if no event
+        """
+        subscribed_event_type = self._event_types[event_type_name][0]
+        with models.Event.database.active_context():
+            return models.Event.select(models.Event.id).where(models.Event.event_type == subscribed_event_type.event_type_id).order_by(models.Event.id.desc()).limit(1).scalar() or 0
+
+    def _pull_events(self,event_type_name,after,limit):
+        """
+        Claim the due retries and then the new events after 'after' of the event type, the events claimed by the other replicas are skipped.
+        Return (claimed,after): claimed is the list of (event,subscribed event id,created); after is the event id to pull the new events after next time
+        """
+        subscribed_event_type = self._subscription(event_type_name)[0]
+        claimed = []
         with models.SubscribedEvent.database.active_context():
-            if subscribed_event_type.replay_missed_events:
-                failed_events = models.SubscribedEvent.select().where(
-                    (models.SubscribedEvent.subscriber == subscribed_event_type.subscriber) &
-                    (models.SubscribedEvent.publisher == subscribed_event_type.publisher) & 
-                    (models.SubscribedEvent.event_type == subscribed_event_type.event_type) &
-                    ( 
-                        ((models.SubscribedEvent.status == models.SubscribedEvent.PROCESSING) & (models.SubscribedEvent.process_start_time < timezone.now() - models.SubscribedEvent.PROCESSING_TIMEOUT)) |
-                        (models.SubscribedEvent.status < 0)
-                    )
-                )
-            else:
-                failed_events = models.SubscribedEvent.select().where(
-                    (models.SubscribedEvent.subscriber == subscribed_event_type.subscriber) &
-                    (models.SubscribedEvent.publisher == subscribed_event_type.publisher) & 
-                    (models.SubscribedEvent.event_type == subscribed_event_type.event_type) &
-                    (models.SubscribedEvent.process_start_time > subscribed_event_type.last_listening_time) &
-                    ( 
-                        ((models.SubscribedEvent.status == models.SubscribedEvent.PROCESSING) & (models.SubscribedEvent.process_start_time < timezone.now() - models.SubscribedEvent.PROCESSING_TIMEOUT)) |
-                        (models.SubscribedEvent.status < 0)
-                    )
-                )
-            for event in failed_events:
-                self._event_types[event_type_name][2].add(event.event)
+            if subscribed_event_type.replay_failed_events:
+                claimed = models.SubscribedEvent.pull_retries(self.subscriber,subscribed_event_type.event_type_id,limit,self._host,os.getpid())
+            if len(claimed) < limit:
+                pulled,after = models.SubscribedEvent.pull(self.subscriber,subscribed_event_type.event_type_id,after,limit - len(claimed),self._host,os.getpid())
+                claimed.extend(pulled)
+        return (claimed,after)
+
+    def _retry_events(self,until,limit,after=None):
+        """
+        Return the list of (event id,event type name,next retry at) which should be retried before 'until', ordered by (next retry at,event id);
+        only the event types subscribed with replay_failed_events are included.
+        after: optional (next retry at,event id), only return the events after it
+        """
+        event_types = [value[0].event_type_id for value in list(self._event_types.values()) if value[0].replay_failed_events]
+        if not event_types:
+            return []
+        if self._membership:
+            partition_condition,params = self._partition_condition()
+            with models.SubscribedEvent.database.active_context():
+                return [(row[0],'{}.{}'.format(row[1],row[2]),row[3]) for row in models.SubscribedEvent.database.execute_sql("""
+SELECT s.event_id,s.publisher_id,s.event_type_id,s.next_retry_at FROM subscribed_event AS s JOIN event AS e ON e.id = s.event_id
+WHERE s.subscriber_id = %s AND s.next_retry_at <= %s AND s.event_type_id = ANY(%s) AND {}{}
+ORDER BY s.next_retry_at,s.event_id LIMIT %s
+""".format(partition_condition,"" if after is None else " AND (s.next_retry_at,s.event_id) > (%s,%s)"),
+                    [self.subscriber.name,until,event_types] + params + ([] if after is None else list(after)) + [limit]
+                ).fetchall()]
+        condition = (
+            (models.SubscribedEvent.subscriber == self.subscriber.name) &
+            (models.SubscribedEvent.next_retry_at <= until) &
+            (models.SubscribedEvent.event_type << event_types)
+        )
+        if after is not None:
+            condition = condition & (
+                (models.SubscribedEvent.next_retry_at > after[0]) |
+                ((models.SubscribedEvent.next_retry_at == after[0]) & (models.SubscribedEvent.event > after[1]))
+            )
+        with models.SubscribedEvent.database.active_context():
+            return [(row[0],'{}.{}'.format(row[1],row[2]),row[3]) for row in models.SubscribedEvent.select(
+                models.SubscribedEvent.event,
+                models.SubscribedEvent.publisher,
+                models.SubscribedEvent.event_type,
+                models.SubscribedEvent.next_retry_at
+            ).where(condition).order_by(models.SubscribedEvent.next_retry_at,models.SubscribedEvent.event).limit(limit).tuples()]
+
+    def _callback_result(self,callback,event):
+        """
+        Call the callback to process the event
+        Return (status,result)
+        """
+        try:
+            return (models.SubscribedEvent.SUCCEED,json.dumps(callback(event)))
+        except:
+            return (models.SubscribedEvent.FAILED,traceback.format_exc())
+
+    def _batch_callback(self,event_type_name):
+        """
+        Return the 'process_batch' function if the event type is subscribed with a managed event processing module which declares it; otherwise return None
+        """
+        subscribed_event_type,callback = self._subscription(event_type_name)[0:2]
+        if not subscribed_event_type.event_processing_module_id:
+            return None
+        try:
+            m = subscribed_event_type.callback_module
+        except:
+            return None
+        if m and callback == m.process:
+            return getattr(m,"process_batch",None)
+        return None
 
     def process_event(self,event):
         """
         Return True if processed; return False if already processed or being processed by other process
+        The processing lock is claimed with one statement before calling the callback, and the result is saved with one statement after.
+        The event is only read from the database if the event id is passed, the event inlined in the notification is used as it is.
         """
         with models.SubscribedEvent.database.active_context():
-            if not isinstance(event,models.Event):
-                event = models.Event.get_by_id(event)
-
-            event_type_name = '{}.{}'.format(event.publisher.name,event.event_type.name)
-            #get the processing lock(required when multiple processes are running for the same subscriber.)
-            subscribedevent,created = models.SubscribedEvent.get_or_create(
-                subscriber=self.subscriber,
-                publisher=event.publisher,
-                event_type=event.event_type,
-                event=event,
-                defaults={
-                    'process_host':self._host,
-                    'process_pid':os.getpid(),
-                    'process_times':1,
-                    'process_start_time':timezone.now(),
-                    'status':models.SubscribedEvent.PROCESSING,
-                }
-            )
-            if not created:
-                if subscribedevent.status == models.SubscribedEvent.FAILED:
-                    #failed event, process again
-                    pass
-                elif subscribedevent.status == models.SubscribedEvent.SUCCEED:
-                    #processed
-                    return True
-                elif subscribedevent.status == models.SubscribedEvent.PROCESSING and (timezone.now() - subscribedevent.process_start_time > models.SubscribedEvent.PROCESSING_TIMEOUT):
-                    #processed over 1 hour, treat it as failed.
-                    pass
-                else:
-                    #is processing by other process,treat it as processed
-                    return True
-
-                #get the processing lock
-                updated_rows = models.SubscribedEvent.update(
-                    process_host = self._host,
-                    process_pid = os.getpid(),
-                    process_times = subscribedevent.process_times + 1,
-                    process_start_time = timezone.now(),
-                    process_end_time = None,
-                    status = models.SubscribedEvent.PROCESSING,
-                    result = None
-                ).where(
-                    (models.SubscribedEvent.id == subscribedevent.id) & 
-                    (models.SubscribedEvent.process_times == subscribedevent.process_times)
-                ).execute()
-
-                if not updated_rows:
-                    #is processing by other process,treat it as processed
-                    return True
-        
-            try:
-                now = timezone.now()
-    
-                if not created:
-                    #save the processing history for the failed event before reprocessing.
-                    models.EventProcessingHistory.create(
-                        subscribed_event = subscribedevent,
-                        process_host = subscribedevent.process_host,
-                        process_pid = subscribedevent.process_pid,
-                        process_start_time = subscribedevent.process_start_time,
-                        process_end_time = subscribedevent.process_end_time,
-                        status = models.SubscribedEvent.TIMEOUT if subscribedevent.status == models.SubscribedEvent.PROCESSING else subscribedevent.status,
-                        result = subscribedevent.result
-                    )
-                    
-                #call callback to process the event
-                result = self._event_types[event_type_name][1](event)
-                #update subscribed event status
-                updated_rows = models.SubscribedEvent.update(
-                    process_end_time = timezone.now(),
-                    status = models.SubscribedEvent.SUCCEED,
-                    result = json.dumps(result)
-                ).where(
-                    (models.SubscribedEvent.id == subscribedevent.id)
-                ).execute()
-            except:
-                #update subscribed event status
-                updated_rows = models.SubscribedEvent.update(
-                    process_end_time = timezone.now(),
-                    status = models.SubscribedEvent.FAILED,
-                    result = traceback.format_exc()
-                ).where(
-                    (models.SubscribedEvent.id == subscribedevent.id)
-                ).execute()
-    
-    
-            #update the last dispatched event in SubscribedEventType table
-            if created:
-                updated_rows = models.SubscribedEventType.update({
-                    models.SubscribedEventType.last_dispatched_event : event,
-                    models.SubscribedEventType.last_dispatched_time : now,
-                }).where(
-                    (models.SubscribedEventType.id ==  self._event_types[event_type_name][0]) &
-                    (
-                        (models.SubscribedEventType.last_dispatched_event >> None) | 
-                        (models.SubscribedEventType.last_dispatched_event_id <  event.id)
-                    )
-                ).execute()
-
-                if updated_rows:
-                    #update successfully, update the local object
-                    self._event_types[event_type_name][0].last_dispatched_event = event
-                    self._event_types[event_type_name][0].last_dispatched_time = now
-                else:
-                    #other process already update the object, retrieve it from database
-                    self._event_types[event_type_name][0] = models.SubscribedEventType.get_by_id(self._event_types[event_type_name][0].id)
+            claimed = models.SubscribedEvent.claim(self.subscriber,event,self._host,os.getpid())
+
+        if not claimed:
+            logger.warning("The event({}) doesn't exist, ignore it".format(event))
+            return True
+
+        loaded_event,subscribed_event_id,created = claimed
+        if not subscribed_event_id:
+            #already processed or is processing by other process,treat it as processed
+            return True
+        if not isinstance(event,models.Event):
+            event = loaded_event
+
+        event_type_name = '{}.{}'.format(event.publisher_id,event.event_type_id)
+        #read the subscribed event type and the callback together, the item is replaced as a whole when the subscription is changed
+        subscribed_event_type,callback = self._subscription(event_type_name)[0:2]
+        now = timezone.now()
+        #call callback to process the event
+        status,result = self._callback_result(callback,event)
+
+        #update subscribed event status and the last dispatched event in SubscribedEventType table
+        with models.SubscribedEvent.database.active_context():
+            last_dispatched = models.SubscribedEvent.complete(subscribed_event_id,status,result,subscribed_event_type,event.id,created,now)
+        if status == models.SubscribedEvent.FAILED:
+            #fetch the event to retry when it is due
+            self._retry_scheduler.wake(models.SubscribedEvent.RETRY_BACKOFF.total_seconds())
+
+        if last_dispatched:
+            #update the local object with the latest value in database
+            subscribed_event_type.last_dispatched_event_id = last_dispatched[0]
+            subscribed_event_type.last_dispatched_time = last_dispatched[1]
 
         return True
 
+    def process_events(self,events):
+        """
+        Process a batch of events: claim all the events with one statement, call the callback per event
+        or call 'process_batch(events)' once if the managed event processing module declares it, and then save all results with one statement.
+        'process_batch' returns None or a list of results with the same order as events; a result which is an Exception means the event is failed.
+        Return True
+        """
+        with models.SubscribedEvent.database.active_context():
+            claimed = models.SubscribedEvent.claim_many(self.subscriber,events,self._host,os.getpid())
+        self._process_claimed(claimed)
+        return True
+
+    def _process_claimed(self,claimed,position=None):
+        """
+        Process the claimed events: the list of (event,subscribed event id,created)
+        position: the pull position in pull mode; the last dispatched event is not moved after it, because the events before the claimed events maybe not committed yet
+        """
+        event_types = collections.OrderedDict()
+        for event,subscribed_event_id,created in claimed:
+            if not subscribed_event_id:
+                #already processed or is processing by other process,treat it as processed
+                continue
+            event_type_name = '{}.{}'.format(event.publisher_id,event.event_type_id)
+            if event_type_name not in event_types:
+                event_types[event_type_name] = []
+            event_types[event_type_name].append((event,subscribed_event_id,created))
+
+        for event_type_name,items in event_types.items():
+            subscribed_event_type,callback = self._subscription(event_type_name)[0:2]
+            now = timezone.now()
+            batch_callback = self._batch_callback(event_type_name)
+            if batch_callback:
+                try:
+                    results = batch_callback([item[0] for item in items])
+                    if results is None:
+                        results = [None] * len(items)
+                    elif len(results) != len(items):
+                        raise Exception("'process_batch' returns {} results for {} events".format(len(results),len(items)))
+                    results = [
+                        (models.SubscribedEvent.FAILED,repr(r)) if isinstance(r,Exception) else (models.SubscribedEvent.SUCCEED,json.dumps(r))
+                        for r in results
+                    ]
+                except:
+                    results = [(models.SubscribedEvent.FAILED,traceback.format_exc())] * len(items)
+            else:
+                results = [self._callback_result(callback,item[0]) for item in items]
+
+            created_events = [item[0].id for item in items if item[2] and (position is None or item[0].id <= position)]
+            #update subscribed event status and the last dispatched event in SubscribedEventType table
+            with models.SubscribedEvent.database.active_context():
+                last_dispatched = models.SubscribedEvent.complete_many(
+                    [(item[1],r[0],r[1]) for item,r in zip(items,results)],
+                    subscribed_event_type,
+                    max(created_events) if created_events else None,
+                    now
+                )
+            if any(r[0] == models.SubscribedEvent.FAILED for r in results):
+                #fetch the events to retry when they are due
+                self._retry_scheduler.wake(models.SubscribedEvent.RETRY_BACKOFF.total_seconds())
+            if last_dispatched:
+                #update the local object with the latest value in database
+                subscribed_event_type.last_dispatched_event_id = last_dispatched[0]
+                subscribed_event_type.last_dispatched_time = last_dispatched[1]
+
     def subscribed(self,event_type):
         if isinstance(event_type,models.SubscribedEventType):
-            event_type = subscribed_event_type.event_type
+            event_type = models.EventType.cache.get(event_type.event_type_id)
         elif not isinstance(event_type,models.EventType):
-            with models.EventType.database.active_context():
-                event_type = models.EventType.get_by_id(event_type)
+            event_type = models.EventType.cache.get(event_type)
 
-        event_type_name = '{}.{}'.format(event_type.publisher.name,event_type.name)
+        event_type_name = '{}.{}'.format(event_type.publisher_id,event_type.name)
 
         return event_type_name in self._event_types
 
@@ -400,21 +1467,27 @@ class Subscriber(object):
     def has_subscription(self):
         return True if self._event_types else False
 
-    def subscribe(self,event_type,callback=None,resubscribe=True,auto_subscribe=False):
+    def subscribe(self,event_type,callback=None,resubscribe=True,auto_subscribe=False,concurrency=None,ordering_key=None,executor=None,batch_size=None,queue_size=None):
         """
+        batch_size: the maximum number of events claimed, processed and completed together, keep the current value if None; default is 1 (no batch)
+        queue_size: the maximum number of queued events, keep the current value if None; the events overflowing the queue are refilled from the database later
+        executor: THREAD or PROCESS, use the subscriber's executor if None. With PROCESS executor, the callback must be a managed event processing module or a module-level function;
+            the worker threads wait for the results from the process pool, so set concurrency to the number of events processed in parallel.
+        concurrency: the maximum number of events processed concurrently for the event type, keep the current value if None; default is 1
+        ordering_key: optional function to get the ordering key from the event; the events with the same key are processed in order, keep the current value if None
         Return (SubscribedEventType,True) if subscribed successfully; return (SubscribedEventType,False) if already subscribed
         """
         with models.EventType.database.active_context():
             if isinstance(event_type,models.SubscribedEventType):
                 subscribed_event_type = event_type
-                event_type = subscribed_event_type.event_type
+                event_type = models.EventType.cache.get(subscribed_event_type.event_type_id)
             else:
                 if not isinstance(event_type,models.EventType):
-                    event_type = models.EventType.get_by_id(event_type)
+                    event_type = models.EventType.cache.get(event_type)
 
                 subscribed_event_type,created = models.SubscribedEventType.get_or_create(
                     subscriber=self.subscriber,
-                    publisher=event_type.publisher,
+                    publisher=event_type.publisher_id,
                     event_type=event_type,
                     defaults={
                         'category':self.subscriber.category,
@@ -428,7 +1501,7 @@ class Subscriber(object):
                     }
                 )
 
-            event_type_name = '{}.{}'.format(event_type.publisher.name,event_type.name)
+            event_type_name = '{}.{}'.format(event_type.publisher_id,event_type.name)
             if event_type_name in self._event_types and not resubscribe:
                 #already subscribed
                 return (subscribed_event_type,False)
@@ -454,31 +1527,49 @@ publish time={}
 payload={}
 """.format(event.publisher.name,event.event_type.name,event.source,event.publish_time,event.payload)))
 
+            if executor is None:
+                executor = PROCESS if isinstance(callback,ProcessCallback) else self._executor
+            if executor == PROCESS:
+                if not isinstance(callback,ProcessCallback):
+                    callback = ProcessCallback(self,subscribed_event_type,callback)
+            elif isinstance(callback,ProcessCallback):
+                callback = callback.callback
+
             if event_type_name in self._event_types:
                 worker = self._event_types[event_type_name][2]
-                if not worker or not worker.is_alive():
-                    worker = Worker(self,event_type_name)
-                    worker.start()
-                elif worker.is_shutdown_requested:
-                    if worker.is_alive():
-                        worker.join()
-                    worker = Worker(self,event_type_name)
+                if worker and worker.is_alive() and not worker.is_shutdown_requested and (
+                    (concurrency and concurrency != worker.concurrency) or
+                    (ordering_key and not _same_function(ordering_key,worker.ordering_key)) or
+                    (batch_size and batch_size != worker.batch_size) or
+                    (queue_size and queue_size != worker.queue_size)
+                ):
+                    #the processing options passed by the caller are changed, retire the worker without waiting;
+                    #it only processes its queued events, and the new worker processes the new events and the replayed events
+                    worker.shutdown(wait=False)
+                if worker:
+                    concurrency = concurrency or worker.concurrency
+                    ordering_key = ordering_key or worker.ordering_key
+                    batch_size = batch_size or worker.batch_size
+                    queue_size = queue_size or worker.queue_size
+                if not worker or not worker.is_alive() or worker.is_shutdown_requested:
+                    worker = self._worker_class(self,event_type_name,concurrency=concurrency,ordering_key=ordering_key,batch_size=batch_size,queue_size=queue_size)
                     worker.start()
             else:
-                worker = Worker(self,event_type_name)
+                worker = self._worker_class(self,event_type_name,concurrency=concurrency,ordering_key=ordering_key,batch_size=batch_size,queue_size=queue_size)
                 worker.start()
 
-            #try to connect to database, this maybe trigger a reregister for all event_types in _event_types if connection to database is not established before
-            self.connection
+            if not self._hub:
+                #try to connect to database, this maybe trigger a reregister for all event_types in _event_types if connection to database is not established before
+                self.connection
+            #replace the whole item, so the subscribed event type, the callback and the worker are always read together
             if event_type_name in self._event_types:
-                self._event_types[event_type_name][1] = callback
-                self._event_types[event_type_name][2] = worker
+                self._event_types[event_type_name] = [self._event_types[event_type_name][0],callback,worker]
             else:
                 self._event_types[event_type_name] = [subscribed_event_type,callback,worker]
 
             if subscribed_event_type.replay_missed_events:
                 #replay failed event only if replay missed events is enabled
-                self._replay_failed_events(event_type_name,subscribed_event_type)
+                self._retry_scheduler.wake()
             self._replay_missed_events(event_type_name,subscribed_event_type)
             
             models.SubscribedEventType.update(
@@ -486,38 +1577,42 @@ payload={}
             ).where(
                 (models.SubscribedEventType.id == subscribed_event_type.id)
             ).execute()
-            with self.connection.cursor() as cur:
-                #listen pg notification
-                cur.execute('LISTEN "{}";'.format(event_type_name))
+            #listen pg notification
+            self._listen(event_type_name)
             logger.info("Listen to {}".format(event_type_name))
 
         return (subscribed_event_type,True)
 
-    def unsubscribe(self,event_type,remove=True):
+    def unsubscribe(self,event_type,remove=True,wait=True):
         """
+        wait: wait for the queued events to be processed if True; otherwise the worker is retired and finishes the queued events in background
         Return true if unsubscribed successfully; return False if not subscribed before
         """
         try:
-            with models.EventType.database.active_context():
-                if not isinstance(event_type,models.EventType):
-                    event_type = models.EventType.get_by_id(event_type)
+            if not isinstance(event_type,models.EventType):
+                event_type = models.EventType.cache.get(event_type)
 
-            event_type_name = '{}.{}'.format(event_type.publisher.name,event_type.name)
+            event_type_name = '{}.{}'.format(event_type.publisher_id,event_type.name)
             if event_type_name not in self._event_types:
                 #not subscribed
                 return False
 
-            with self.connection.cursor() as cur:
-                cur.execute('UNLISTEN "{}";'.format(event_type_name))
+            self._unlisten(event_type_name)
             logger.info("Stop listen to {}".format(event_type_name))
         except:
             pass
 
         #shutdown the worker thread
-        self._event_types[event_type_name][2].shutdown()
+        value = self._event_types[event_type_name]
+        value[2].shutdown(wait=wait)
 
         if remove:
             del self._event_types[event_type_name]
+            for name,retired in list(self._retired.items()):
+                if not retired[2].is_alive():
+                    del self._retired[name]
+            if value[2].is_alive():
+                self._retired[event_type_name] = value
 
         return True
 
@@ -527,40 +1622,113 @@ payload={}
 
     def start(self):
         self._shutdown = False
+        with self._wakeup_lock:
+            if not self._wakeup_fds:
+                self._wakeup_fds = os.pipe()
+                os.set_blocking(self._wakeup_fds[0],False)
         self._listener.start()
-        self._replay_failed_events_worker.start()
+        self._retry_scheduler.start()
+        if self._membership:
+            self._membership.start()
 
     @repeat_if_failed(retry=-1,retry_interval=2000,retry_message="Waiting {2} milliseconds and then trying to listen again, {0}")
     def listen(self):
         while not self._shutdown:
+            if self._hub:
+                if not self._control_listened:
+                    #the channels were unregistered when the subscriber was closed, register them again
+                    self._on_reconnected()
+                #the notifications are dispatched by the listener hub, only wait for the shutdown request
+                select.select([self._wakeup_fds[0]], [], [])
+                self._clear_wakeup()
+                continue
             try:
-                if select.select([self.connection], [], [], self._select_timeout) == NOT_READY:
-                    pass
-                else:
+                readable = select.select([self.connection,self._wakeup_fds[0]], [], [], self._select_timeout)[0]
+                if self._wakeup_fds[0] in readable:
+                    self._clear_wakeup()
+                    continue
+                #the notifications read by the LISTEN statements executed in the other threads are taken after the select timeout
+                if readable or self.connection.notifies:
                     self.connection.poll()
-                    while self.connection.notifies:
-                        notify_event = self.connection.notifies.pop(0)
-                        event_type_name = notify_event.channel
-                        logger.debug("{}:{} in {}".format(event_type_name,notify_event,self._event_types.keys()))
-                        
-                        if event_type_name not in self._event_types:
-                            #not listening this event type. skip
-                            logger.info("The subscriber({}) is not listening this event type ({}), skip the event({}).".format(self.subscriber,event_type_name,json.dumps(notify_event)))
-                            continue
-                        #get the event object
-                        notify_payload = json.loads(notify_event.payload)
-                        self._event_types[event_type_name][2].add(notify_payload['id'])
+                    if self.connection.notifies:
+                        #take all the received notifications at once
+                        notifies = self.connection.notifies
+                        self.connection.notifies = []
+                        self._dispatch_notifies(notifies)
             except:
                 #check whether the connection is broken or not
                 self._database.clean_if_inactive()
                 raise
-                     
+
+    def _clear_wakeup(self):
+        try:
+            os.read(self._wakeup_fds[0],1024)
+        except BlockingIOError:
+            pass
+
+    def _dispatch_notifies(self,notifies):
+        """
+        Group the events of the notifications per event type and add them into the workers with one call per event type
+        """
+        events = collections.OrderedDict()
+        for notify_event in notifies:
+            if notify_event.channel == settings.SUBSCRIPTION_CHANNEL:
+                self._on_subscription_changed(notify_event)
+                continue
+            payloads = events.get(notify_event.channel)
+            if payloads is None:
+                payloads = []
+                events[notify_event.channel] = payloads
+            payloads.append(notify_event.payload)
+
+        for event_type_name,payloads in events.items():
+            value = self._event_types.get(event_type_name)
+            if not value:
+                #not listening this event type. skip
+                logger.info("The subscriber({}) is not listening this event type ({}), skip {} events.".format(self.subscriber,event_type_name,len(payloads)))
+                continue
+            event_list = []
+            for payload in payloads:
+                #use the event inlined in the notification; the event is fetched by the worker if it's too large to inline
+                payload = json.loads(payload)
+                event_list.append(models.Event.from_notification(payload) or payload['id'])
+            if self._membership:
+                #drop the events of the other replicas' partitions, the partitions of the events which are not inlined are checked in database
+                event_ids = [e for e in event_list if not isinstance(e,models.Event)]
+                owned_ids = set()
+                if event_ids:
+                    try:
+                        owned_ids = set(self._filter_event_ids(event_ids))
+                    except:
+                        #the events are replayed after the next rebalance or reconnection
+                        logger.error(traceback.format_exc())
+                event_list = [e for e in event_list if (self._owns(e) if isinstance(e,models.Event) else e in owned_ids)]
+            value[2].add_many(event_list)
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug("Received {} events of {}".format(len(event_list),event_type_name))
 
     def close(self):
         for v in self._event_types.values():
-            self.unsubscribe(v[0].event_type,remove=False)
-        self._connection = None
-        self._database.close()
+            self.unsubscribe(v[0].event_type_id,remove=False)
+        #wait for the retired workers to finish their queued events
+        for v in list(self._retired.values()):
+            v[2].join()
+        self._retired.clear()
+        if self._hub:
+            self._hub.unregister(self,settings.SUBSCRIPTION_CHANNEL)
+            self._control_listened = False
+        else:
+            self._connection = None
+            self._database.close()
+        self._reset_process_pool(wait=True)
+        with self._wakeup_lock:
+            if self._wakeup_fds:
+                os.close(self._wakeup_fds[0])
+                os.close(self._wakeup_fds[1])
+                self._wakeup_fds = None
 
         self._listener = Listener(self)
-        self._replay_failed_events_worker = ReplayFailedEventsWorker(self)
+        self._retry_scheduler = RetryScheduler(self)
+        if self._membership:
+            #the partitions are assigned again after the next start
+            self._membership = ReplicaMembership(self,self._membership.replica)
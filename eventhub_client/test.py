@@ -1,13 +1,19 @@
 import time
+import json
+import shutil
+import tempfile
 import traceback
+from datetime import timedelta
 
-from .publisher import Publisher
+from .publisher import Publisher,BufferedPublisher,BufferClosed
+from .outbox import Outbox
 
-from .subscriber import Subscriber
+from .subscriber import Subscriber,partition_of,partition_value,partition_sql,assign_partitions
 from . import settings
 from . import models
 
 from eventhub_utils import timezone
+from eventhub_utils.database import AlwaysCheck,IdleCheck,ErrorCheck,PoolStats,liveness_strategy
 
 class BaseTest(object):
     def __init__(self,name,desc,database=None,**kwargs):
@@ -43,6 +49,19 @@ publish time={}
 payload={}
 """.format(event.id,event.publisher.name,event.event_type.name,event.source,event.publish_time,event.payload))
 
+    @staticmethod
+    def wait(condition,timeout=60):
+        """
+        Wait until the condition is True.
+        Return False if timeout
+        """
+        deadline = time.time() + timeout
+        while not condition():
+            if time.time() > deadline:
+                return False
+            time.sleep(0.2)
+        return True
+
     def __call__(self):
         try:
             print("")
@@ -67,7 +86,7 @@ payload={}
 
     def tearup(self):
         for sub in self.subscribes:
-            sub.shutdown(async=True)
+            sub.shutdown(wait=False)
 
         for sub in self.subscribes:
             sub.wait_to_shutdown()
@@ -75,7 +94,10 @@ payload={}
         
         with models.Event.database:
             #delete testing data
+            has_replicas = models.Event.database.execute_sql("select to_regclass('subscriber_replica')").fetchone()[0]
             for sub in self.subs:
+                if has_replicas:
+                    models.Event.database.execute_sql("delete from subscriber_replica where subscriber_id = '{}'".format(sub.name))
                 models.Event.database.execute_sql("delete from event_processing_history as a using subscribed_event as b where a.subscribed_event_id = b.id and b.subscriber_id = '{}'".format(sub.name))
                 models.Event.database.execute_sql("delete from subscribed_event where subscriber_id = '{}'".format(sub.name))
                 models.Event.database.execute_sql("delete from subscribed_event_type where subscriber_id = '{}'".format(sub.name))
@@ -90,7 +112,12 @@ payload={}
 
 
 class SinglePubSubTest(BaseTest):
-    def __init__(self,name,desc,database=None):
+    def __init__(self,name,desc,database=None,publisher_class=Publisher,pub_options=None,sub_options=None,replicas=1):
+        """
+        pub_options: the keyword arguments to create the publisher
+        sub_options: the keyword arguments to create the subscribers
+        replicas: the number of the subscribers with the same subscriber name, the subscribers are 'sub','sub2',...
+        """
         with models.Publisher.database:
             pub,created=models.Publisher.get_or_create(name='Pub_Unitest',defaults={
                 'category':models.UNITESTING,
@@ -126,12 +153,23 @@ class SinglePubSubTest(BaseTest):
                 'creator':models.User.PROGRAMMATIC,
                 'created':timezone.now(),
             })
-        super().__init__(
-            name,
-            desc,
-            pub=Publisher(pub,event_type),
-            sub=Subscriber(sub)
-        )
+        kwargs = {"pub":publisher_class(pub,event_type,**(pub_options or {}))}
+        for i in range(replicas):
+            kwargs["sub{}".format(i + 1 if i else "")] = Subscriber(sub,**(sub_options or {}))
+        super().__init__(name,desc,database=database,**kwargs)
+
+    def subscribed_events(self,event_ids):
+        return list(models.SubscribedEvent.select().where(models.SubscribedEvent.event << list(event_ids)))
+
+    def assert_processed_once(self,event_ids,processed_events,status=models.SubscribedEvent.SUCCEED):
+        """
+        Check that each event is processed once by the subscribers and its subscribed event is in the status
+        """
+        assert sorted(processed_events) == sorted(event_ids),"Processed events({}) are not the published events({})".format(sorted(processed_events),sorted(event_ids))
+        subscribed_events = self.subscribed_events(event_ids)
+        assert len(event_ids) == len(subscribed_events),"Only {}/{} events were subscribed".format(len(subscribed_events),len(event_ids))
+        unexpected = [e.event_id for e in subscribed_events if e.status != status]
+        assert not unexpected,"The status of the events({}) is not {}".format(unexpected,status)
 
 class BasicPubSubTest(SinglePubSubTest):
     def __init__(self,name="Basic Pub/Sub Testing",desc="Test basic publish/subscribe event"):
@@ -216,10 +254,392 @@ class FailedProcessingTest(SinglePubSubTest):
         failed_subscribed_events = subscribed_events.where(models.SubscribedEvent.status == models.SubscribedEvent.FAILED)
         assert len(events) == len(subscribed_events),"Only {}/{} events were processed unsuccessfully".format(len(subscribed_events),len(events))
 
+class PublishManyTest(SinglePubSubTest):
+    def __init__(self,name="Publish Many Testing",desc="Test publishing events with one statement"):
+        super().__init__(name,desc)
+
+    def test(self):
+        now = timezone.now()
+        processed_events = []
+        def _process(event):
+            processed_events.append(event.id)
+
+        self.sub.subscribe('unitest_event',callback=_process)
+        self.sub.start()
+
+        payloads = [{"data":"{}: event {}".format(now,i)} for i in range(10)]
+        event_ids = self.pub.publish_many(payloads)
+        assert len(event_ids) == len(payloads),"Only {}/{} events were published".format(len(event_ids),len(payloads))
+        assert event_ids == sorted(event_ids),"The event ids({}) are not in the order of the payloads".format(event_ids)
+        saved_payloads = [e.payload for e in models.Event.select().where(models.Event.id << event_ids).order_by(models.Event.id)]
+        assert saved_payloads == payloads,"The saved payloads({}) are not the published payloads({})".format(saved_payloads,payloads)
+
+        assert self.wait(lambda:len(processed_events) >= len(event_ids)),"Only {}/{} events were processed".format(len(processed_events),len(event_ids))
+        self.assert_processed_once(event_ids,processed_events)
+
+class BufferedPublisherTest(SinglePubSubTest):
+    def __init__(self,name="Buffered Publisher Testing",desc="Test flushing and closing the buffered publisher"):
+        super().__init__(name,desc,publisher_class=BufferedPublisher,pub_options={"batch_size":4,"flush_interval":200})
+
+    def published_payloads(self):
+        return [e.payload for e in models.Event.select().where(models.Event.publisher == self.pub.publisher).order_by(models.Event.id)]
+
+    def test(self):
+        now = timezone.now()
+        payloads = ["{}: event {}".format(now,i) for i in range(10)]
+        for payload in payloads:
+            self.pub.publish(payload)
+        assert self.pub.flush(30),"{} events were not flushed".format(self.pub.pending)
+        assert self.pub.pending == 0,"{} events are still pending after flushed".format(self.pub.pending)
+        assert self.published_payloads() == payloads,"The flushed payloads are not the published payloads"
+
+        #the buffered events are written when the publisher is closed
+        more_payloads = ["{}: more event {}".format(now,i) for i in range(3)]
+        for payload in more_payloads:
+            self.pub.publish(payload)
+        assert self.pub.close(30),"{} events were not written when closed".format(self.pub.pending)
+        assert self.published_payloads() == payloads + more_payloads,"The buffered payloads are not written when closed"
+        assert self.pub.lost == 0 and self.pub.dropped == 0,"{} events were lost and {} events were dropped".format(self.pub.lost,self.pub.dropped)
+
+        try:
+            self.pub.publish("{}: event after closed".format(now))
+            closed = False
+        except BufferClosed:
+            closed = True
+        assert closed,"The event is published after the publisher is closed"
+
+    def tearup(self):
+        self.pub.close(0)
+        super().tearup()
+
+class OutboxTest(SinglePubSubTest):
+    def __init__(self,name="Outbox Testing",desc="Test spooling the events into the outbox and replaying them"):
+        self.outbox_folder = tempfile.mkdtemp(prefix="eventhub_outbox_")
+        super().__init__(name,desc,pub_options={"outbox":Outbox(self.outbox_folder,retry_interval=200)})
+
+    def test(self):
+        now = timezone.now()
+        outbox = self.pub.outbox
+        payloads = ["{}: event {}".format(now,i) for i in range(8)]
+
+        #the events are spooled without connecting to the database after a connection error
+        outbox.database_unavailable()
+        assert self.pub.publish(payloads[0]) is None,"The event is not spooled when the database is unavailable"
+        outbox.database_unavailable()
+        assert self.pub.publish_many(payloads[1:]) is None,"The events are not spooled when the database is unavailable"
+
+        #the replay worker finds the database active and replays the events in order
+        assert self.wait(lambda:outbox.is_empty and outbox.database_available),"{} events are not replayed from the outbox".format(outbox.pending)
+        saved_payloads = [e.payload for e in models.Event.select().where(models.Event.publisher == self.pub.publisher).order_by(models.Event.id)]
+        assert saved_payloads == payloads,"The replayed payloads({}) are not the spooled payloads({})".format(saved_payloads,payloads)
+
+        #the events are published directly once the outbox is empty
+        event = self.pub.publish("{}: direct event".format(now))
+        assert event is not None,"The event is spooled after the outbox is replayed"
+
+    def tearup(self):
+        self.pub.outbox.close()
+        shutil.rmtree(self.outbox_folder,ignore_errors=True)
+        super().tearup()
+
+class BatchProcessingTest(SinglePubSubTest):
+    def __init__(self,name="Batch Processing Testing",desc="Test claiming and completing the events in batches"):
+        super().__init__(name,desc)
+
+    def test(self):
+        now = timezone.now()
+        processed_events = []
+        def _process(event):
+            processed_events.append(event.id)
+
+        self.sub.subscribe('unitest_event',callback=_process,batch_size=5)
+        self.sub.start()
+        worker = self.sub._event_types["{}.unitest_event".format(self.pub.publisher.name)][2]
+        assert worker.batch_size == 5,"The batch size of the worker is {}".format(worker.batch_size)
+
+        event_ids = self.pub.publish_many(["{}: event {}".format(now,i) for i in range(12)])
+        assert self.wait(lambda:len(processed_events) >= len(event_ids)),"Only {}/{} events were processed".format(len(processed_events),len(event_ids))
+        self.assert_processed_once(event_ids,processed_events)
+
+class OverflowTest(SinglePubSubTest):
+    def __init__(self,name="Overflow Testing",desc="Test replaying the missed events and refilling the overflowed events through a small queue"):
+        super().__init__(name,desc)
+
+    def test(self):
+        now = timezone.now()
+        processed_events = []
+        def _process(event):
+            time.sleep(0.05)
+            processed_events.append(event.id)
+
+        #published before subscribing, replayed page by page
+        missed_event_ids = self.pub.publish_many(["{}: missed event {}".format(now,i) for i in range(10)])
+
+        self.sub.subscribe('unitest_event',callback=_process,queue_size=2)
+        self.sub.start()
+        worker = self.sub._event_types["{}.unitest_event".format(self.pub.publisher.name)][2]
+
+        #notified faster than processed, overflow the queue and refilled from the database
+        event_ids = missed_event_ids + self.pub.publish_many(["{}: event {}".format(now,i) for i in range(20)])
+        assert self.wait(lambda:len(processed_events) >= len(event_ids)),"Only {}/{} events were processed".format(len(processed_events),len(event_ids))
+        assert worker.overflowed > 0,"The queue was not overflowed"
+        self.assert_processed_once(event_ids,processed_events)
+
+class RetryTest(SinglePubSubTest):
+    def __init__(self,name="Retry Testing",desc="Test retrying the failed events with backoff until they are dead"):
+        super().__init__(name,desc)
+        self._retry_settings = (models.SubscribedEvent.RETRY_BACKOFF,models.SubscribedEvent.MAX_RETRY_BACKOFF,models.SubscribedEvent.MAX_PROCESS_TIMES)
+
+    def test(self):
+        models.SubscribedEvent.RETRY_BACKOFF = timedelta(seconds=1)
+        models.SubscribedEvent.MAX_RETRY_BACKOFF = timedelta(seconds=2)
+        models.SubscribedEvent.MAX_PROCESS_TIMES = 3
+
+        now = timezone.now()
+        #event id -> the times the event was processed
+        processed_times = {}
+        def _process(event):
+            processed_times.setdefault(event.id,[]).append(time.time())
+            raise Exception("Failed processing testing")
+
+        self.sub.subscribe('unitest_event',callback=_process)
+        self.sub.start()
+
+        event_ids = self.pub.publish_many(["{}: event {}".format(now,i) for i in range(2)])
+        assert self.wait(lambda:all(e.status == models.SubscribedEvent.DEAD for e in self.subscribed_events(event_ids)) and len(self.subscribed_events(event_ids)) == len(event_ids)),"The events are not dead after failed {} times".format(models.SubscribedEvent.MAX_PROCESS_TIMES)
+
+        for e in self.subscribed_events(event_ids):
+            assert e.process_times == 3,"The event({}) was processed {} times".format(e.event_id,e.process_times)
+            assert e.next_retry_at is None,"The dead event({}) is scheduled to retry at {}".format(e.event_id,e.next_retry_at)
+        for event_id in event_ids:
+            times = processed_times.get(event_id,[])
+            assert len(times) == 3,"The callback was called {} times for the event({})".format(len(times),event_id)
+            #retried after 1 second and then 2 seconds
+            intervals = [t2 - t1 for t1,t2 in zip(times[:-1],times[1:])]
+            assert intervals[0] >= 0.9 and intervals[1] >= 1.9,"The event({}) was retried without backoff, the intervals are {}".format(event_id,intervals)
+
+    def tearup(self):
+        models.SubscribedEvent.RETRY_BACKOFF,models.SubscribedEvent.MAX_RETRY_BACKOFF,models.SubscribedEvent.MAX_PROCESS_TIMES = self._retry_settings
+        super().tearup()
+
+class PullReplicasTest(SinglePubSubTest):
+    def __init__(self,name="Pull Replicas Testing",desc="Test two subscribers pulling the events of the same subscription"):
+        super().__init__(name,desc,sub_options={"pull":True},replicas=2)
+
+    def test(self):
+        now = timezone.now()
+        processed_events = []
+        def _process(event):
+            processed_events.append(event.id)
+
+        for sub in (self.sub,self.sub2):
+            sub.subscribe('unitest_event',callback=_process,batch_size=5)
+            sub.start()
+
+        event_ids = self.pub.publish_many(["{}: event {}".format(now,i) for i in range(30)])
+        assert self.wait(lambda:len(processed_events) >= len(event_ids)),"Only {}/{} events were processed".format(len(processed_events),len(event_ids))
+        #wait a pull interval, the events must not be processed again by the other replica
+        time.sleep(settings.PULL_INTERVAL)
+        self.assert_processed_once(event_ids,processed_events)
+
+class PartitionRebalanceTest(SinglePubSubTest):
+    def __init__(self,name="Partition Rebalance Testing",desc="Test splitting the events among the replicas by partition and rebalancing them when a replica leaves"):
+        self._heartbeat = settings.REPLICA_HEARTBEAT
+        settings.REPLICA_HEARTBEAT = 1
+        super().__init__(name,desc,sub_options={"partition_key":"payload.key"},replicas=2)
+
+    def wait_balanced(self,subs):
+        all_partitions = set(range(settings.SUBSCRIBER_PARTITIONS))
+        def _balanced():
+            partitions = [sub._membership.partitions for sub in subs]
+            return all(sub._membership.replicas == len(subs) for sub in subs) and sum(len(p) for p in partitions) == len(all_partitions) and set().union(*partitions) == all_partitions
+        return self.wait(_balanced)
+
+    def publish(self,count):
+        now = timezone.now()
+        return self.pub.publish_many([{"key":"{}:{}".format(now,i)} for i in range(count)])
+
+    def test(self):
+        #replica index -> processed events
+        processed_events = ([],[])
+        def _callback(replica):
+            def _process(event):
+                processed_events[replica].append(event)
+            return _process
+
+        for i,sub in enumerate((self.sub,self.sub2)):
+            sub.subscribe('unitest_event',callback=_callback(i))
+            sub.start()
+        assert self.wait_balanced([self.sub,self.sub2]),"The partitions are not assigned to the two replicas"
+
+        event_ids = self.publish(40)
+        assert self.wait(lambda:len(processed_events[0]) + len(processed_events[1]) >= len(event_ids)),"Only {}/{} events were processed".format(len(processed_events[0]) + len(processed_events[1]),len(event_ids))
+        self.assert_processed_once(event_ids,[e.id for e in processed_events[0] + processed_events[1]])
+        for sub,events in zip((self.sub,self.sub2),processed_events):
+            for event in events:
+                partition = partition_of(partition_value("payload.key",event),settings.SUBSCRIBER_PARTITIONS)
+                assert partition in sub._membership.partitions,"The event({}) of partition {} was processed by the replica which doesn't own it".format(event.id,partition)
+
+        #the partitions of the leaving replica are acquired by the other replica
+        self.sub2.shutdown()
+        self.subscribes.remove(self.sub2)
+        assert self.wait_balanced([self.sub]),"The partitions of the leaving replica are not acquired"
+        del processed_events[0][:]
+        more_event_ids = self.publish(20)
+        assert self.wait(lambda:len(processed_events[0]) >= len(more_event_ids)),"Only {}/{} events were processed after rebalanced".format(len(processed_events[0]),len(more_event_ids))
+        assert sorted(e.id for e in processed_events[0]) == sorted(more_event_ids),"The events are not processed by the remaining replica after rebalanced"
+
+    def tearup(self):
+        settings.REPLICA_HEARTBEAT = self._heartbeat
+        super().tearup()
+
+class ModelCacheTest(BaseTest):
+    def __init__(self,name="Model Cache Testing",desc="Test the expiration, eviction and invalidation of the model cache"):
+        super().__init__(name,desc)
+
+    def test(self):
+        #the objects are not saved, reading them from the database raises DoesNotExist
+        def _cached(cache,pk):
+            try:
+                return cache.get(pk)
+            except models.Publisher.DoesNotExist:
+                return None
+
+        cached_cache = models.MODEL_CACHES.get(models.Publisher._meta.table_name)
+        try:
+            cache = models.ModelCache(models.Publisher,maxsize=2,ttl=1)
+            objs = [models.Publisher(name="Pub_Unitest_Cache{}".format(i)) for i in range(5)]
+
+            cache.put(objs[0])
+            cache.put(objs[1])
+            assert _cached(cache,objs[0].name) is objs[0],"The cached object is not returned"
+            #the least recently used object is evicted
+            cache.put(objs[2])
+            assert _cached(cache,objs[1].name) is None,"The least recently used object is not evicted"
+            assert _cached(cache,objs[0].name) is objs[0],"The recently used object is evicted"
+
+            #the object loaded before the invalidation is not cached
+            generation = cache._generation
+            cache.invalidate(objs[0].name)
+            assert _cached(cache,objs[0].name) is None,"The invalidated object is still cached"
+            cache.put(objs[3],generation)
+            assert _cached(cache,objs[3].name) is None,"The object loaded before the invalidation is cached"
+            cache.invalidate()
+            assert _cached(cache,objs[2].name) is None,"The object is still cached after all objects are invalidated"
+
+            #the object expires after ttl
+            cache.put(objs[4])
+            assert _cached(cache,objs[4].name) is objs[4],"The cached object is not returned"
+            time.sleep(1.1)
+            assert _cached(cache,objs[4].name) is None,"The object is not expired after ttl"
+        finally:
+            if cached_cache:
+                models.MODEL_CACHES[models.Publisher._meta.table_name] = cached_cache
+
+class PartitionAssignmentTest(BaseTest):
+    def __init__(self,name="Partition Assignment Testing",desc="Test assigning the partitions to the replicas and computing the partition in python and sql"):
+        super().__init__(name,desc)
+
+    def test(self):
+        partitions = 64
+        replicas = ["replica{}".format(i) for i in range(4)]
+        assigned = dict((r,assign_partitions(r,replicas,partitions)) for r in replicas)
+        for p in range(partitions):
+            owners = [r for r in replicas if p in assigned[r]]
+            assert len(owners) == 1,"The partition {} is assigned to {}".format(p,owners)
+        #only the partitions of the leaving replica are moved
+        reassigned = dict((r,assign_partitions(r,replicas[:-1],partitions)) for r in replicas[:-1])
+        for r in replicas[:-1]:
+            assert assigned[r] <= reassigned[r],"The partitions of the replica {} are moved when another replica leaves".format(r)
+        assert set().union(*reassigned.values()) == set(range(partitions)),"Some partitions are not assigned after a replica leaves"
+
+        #the partition computed in python is the same as the one computed in sql
+        for payload in [{"key":"abc"},{"key":"中文"},{"key":12},{"key":12.5},{"key":True},{"key":None},{"other":"abc"},{"key":{"a":[1,2]}}]:
+            event = models.Event(source="host{}".format(len(str(payload))),payload=payload)
+            for partition_key in ("source","payload.key"):
+                expected = partition_of(partition_value(partition_key,event),partitions)
+                actual = self._database.execute_sql(
+                    "SELECT {} FROM (SELECT %s::varchar AS source,%s::jsonb AS payload) AS e".format(partition_sql(partition_key,partitions)),
+                    (event.source,json.dumps(payload))
+                ).fetchone()[0]
+                assert actual == expected,"The partition of {}({}) is {} in python, but {} in sql".format(partition_key,payload,expected,actual)
+
+class LivenessStrategyTest(BaseTest):
+    def __init__(self,name="Liveness Strategy Testing",desc="Test when the liveness strategies check the connections"):
+        super().__init__(name,desc)
+
+    def test(self):
+        conn = object()
+
+        strategy = AlwaysCheck()
+        strategy.verified(conn)
+        assert strategy.should_check(conn),"AlwaysCheck doesn't check the verified connection"
+
+        strategy = IdleCheck(idle_seconds=0.5)
+        assert strategy.should_check(conn),"IdleCheck doesn't check the unknown connection"
+        strategy.verified(conn)
+        assert not strategy.should_check(conn),"IdleCheck checks the recently verified connection"
+        time.sleep(0.6)
+        assert strategy.should_check(conn),"IdleCheck doesn't check the idle connection"
+        strategy.verified(conn)
+        strategy.invalidate(conn)
+        assert strategy.should_check(conn),"IdleCheck doesn't check the connection after a connection error"
+
+        strategy = ErrorCheck()
+        strategy.forget(conn)
+        assert not strategy.should_check(conn),"ErrorCheck checks the new connection"
+        strategy.invalidate(conn)
+        assert strategy.should_check(conn),"ErrorCheck doesn't check the connection after a connection error"
+        strategy.verified(conn)
+        assert not strategy.should_check(conn),"ErrorCheck checks the verified connection"
+
+        strategy = liveness_strategy("IDLE",idle_seconds=5)
+        assert isinstance(strategy,IdleCheck) and strategy.idle_seconds == 5,"The liveness strategy 'idle' is not created"
+        assert isinstance(liveness_strategy("always"),AlwaysCheck) and isinstance(liveness_strategy("error"),ErrorCheck),"The liveness strategies are not created"
+        try:
+            liveness_strategy("never")
+            created = True
+        except Exception:
+            created = False
+        assert not created,"The unsupported liveness strategy is created"
+
+class PoolStatsTest(BaseTest):
+    def __init__(self,name="Pool Stats Testing",desc="Test the checkout statistics of the connection pool"):
+        super().__init__(name,desc)
+
+    def test(self):
+        stats = PoolStats(rate_window=10)
+        stats.record_checkout(0.0005,False)
+        stats.record_checkout(0.02,True)
+        stats.record_checkout(10,True)
+        stats.record_timeout()
+
+        result = stats.as_dict()
+        assert (result["checkouts"],result["waits"],result["timeouts"]) == (3,3,1),"The counts are wrong: {}".format(result)
+        histogram = result["wait_histogram"]
+        assert (histogram["<=1ms"],histogram["<=50ms"],histogram[">5000ms"]) == (1,1,1) and sum(histogram.values()) == 3,"The wait histogram is wrong: {}".format(histogram)
+        assert abs(result["checkouts_per_second"] - 0.3) < 0.0001,"The checkouts per second is {}".format(result["checkouts_per_second"])
+
+        stats.reset()
+        result = stats.as_dict()
+        assert (result["checkouts"],result["waits"],result["timeouts"],result["checkouts_per_second"]) == (0,0,0,0),"The stats are not reset: {}".format(result)
+        assert sum(result["wait_histogram"].values()) == 0,"The wait histogram is not reset: {}".format(result["wait_histogram"])
+
 def test_all():
     BasicPubSubTest()()
     FailedProcessingTest()()
-
+    PublishManyTest()()
+    BufferedPublisherTest()()
+    OutboxTest()()
+    BatchProcessingTest()()
+    OverflowTest()()
+    RetryTest()()
+    PullReplicasTest()()
+    PartitionRebalanceTest()()
+    ModelCacheTest()()
+    PartitionAssignmentTest()()
+    LivenessStrategyTest()()
+    PoolStatsTest()()
 
 test_all()
 
@@ -3,12 +3,139 @@ import playhouse.pool
 import playhouse.postgres_ext
 import threading
 import logging
+import time
+import collections
+import weakref
 
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.DEBUG)
 
 _localdata = threading.local()
 
+class LivenessStrategy(object):
+    """
+    Decide whether a connection should be verified with 'SELECT 1' when it is checked out.
+    Each connection carries the last time it was known to be working, which is set by a successful check
+    or a successful unit of work, and is cleared if a unit of work failed with a connection error.
+    """
+    def __init__(self):
+        self._verified = {}
+
+    def should_check(self,conn):
+        raise NotImplementedError("Not implemented")
+
+    def verified(self,conn):
+        self._verified[id(conn)] = time.time()
+
+    def invalidate(self,conn):
+        self._verified.pop(id(conn),None)
+
+    def forget(self,conn):
+        self._verified.pop(id(conn),None)
+
+class AlwaysCheck(LivenessStrategy):
+    """
+    Check the connection every time it is checked out
+    """
+    def should_check(self,conn):
+        return True
+
+class IdleCheck(LivenessStrategy):
+    """
+    Check the connection if it is not known to be working in the last idle_seconds, or a connection error happened.
+    """
+    def __init__(self,idle_seconds=30):
+        super().__init__()
+        self.idle_seconds = idle_seconds
+
+    def should_check(self,conn):
+        verified = self._verified.get(id(conn))
+        return verified is None or time.time() - verified > self.idle_seconds
+
+class ErrorCheck(LivenessStrategy):
+    """
+    Check the connection only if a connection error happened in the last unit of work
+    """
+    def should_check(self,conn):
+        return id(conn) not in self._verified
+
+    def forget(self,conn):
+        #a new connection with the same id is assumed working
+        self._verified[id(conn)] = time.time()
+
+LIVENESS_STRATEGIES = {
+    "always":AlwaysCheck,
+    "idle":IdleCheck,
+    "error":ErrorCheck
+}
+
+def liveness_strategy(name,**kwargs):
+    """
+    Return the liveness strategy object with the name 'always','idle' or 'error'
+    """
+    try:
+        cls = LIVENESS_STRATEGIES[name.lower()]
+    except KeyError:
+        raise Exception("Unsupported liveness strategy({}), only support {}".format(name,",".join(LIVENESS_STRATEGIES.keys())))
+    return cls(**kwargs) if cls is IdleCheck else cls()
+
+class PreparedStatement(object):
+    """
+    A server side prepared statement.
+    The statement is prepared once per connection with 'PREPARE name(types) AS sql' and then executed with 'EXECUTE name(params)',
+    so the sql is neither built nor planned again for each execution.
+    The sql uses the pyformat parameters '%(name)s'.
+    """
+    def __init__(self,name,sql,params,prepare=True):
+        """
+        name: the statement name, must be unique in the process
+        params: the list of (parameter name,postgres type)
+        prepare: execute the sql directly with the parameters if False; useful if the connections are shared by a transaction pooler
+        """
+        self.name = name
+        self.sql = sql
+        self.params = params
+        self.prepare = prepare
+        prepared_sql = sql
+        numbered_sql = sql
+        for i,(param,ptype) in enumerate(params,start=1):
+            prepared_sql = prepared_sql.replace("%({})s".format(param),"${}".format(i))
+            numbered_sql = numbered_sql.replace("%({})s".format(param),"${}::{}".format(i,ptype))
+        #the sql with the typed numbered parameters '$n::type', used by the drivers without the pyformat parameters, for example asyncpg
+        self.numbered_sql = numbered_sql
+        self.prepare_sql = "PREPARE {}({}) AS {}".format(name,",".join(ptype for param,ptype in params),prepared_sql)
+        self.execute_sql = "EXECUTE {}({})".format(name,",".join(["%s"] * len(params)))
+        #the connections which have prepared the statement
+        self._connections = weakref.WeakKeyDictionary()
+        self._lock = threading.Lock()
+
+    def execute(self,database,params):
+        """
+        Execute the statement with the params(dict) in the current connection of the database and return the cursor
+        """
+        if not self.prepare:
+            return database.execute_sql(self.sql,params)
+        conn = database.connection()
+        if conn not in self._connections:
+            with self._lock:
+                if conn not in self._connections:
+                    cursor = database.cursor()
+                    try:
+                        cursor.execute(self.prepare_sql)
+                    finally:
+                        cursor.close()
+                    self._connections[conn] = True
+        return database.execute_sql(self.execute_sql,self.values(params))
+
+    def values(self,params):
+        """
+        Return the list of the parameter values in the order of the numbered parameters
+        """
+        return [params[param] for param,ptype in self.params]
+
+#the exceptions which mean the connection is broken
+CONNECTION_ERRORS = (peewee.OperationalError,peewee.InterfaceError)
+
 class ActiveContext(object):
     def __init__(self,database):
         self.database = database
@@ -28,12 +155,26 @@ class ActiveContext(object):
 
     def __exit__(self, exc_type, exc_val, exc_tb):
         if _localdata.active_context == 1:
+            if not self.database.is_closed():
+                conn = self.database.connection()
+                if exc_type and issubclass(exc_type,CONNECTION_ERRORS):
+                    #the connection maybe broken, check it at next checkout
+                    self.database.liveness.invalidate(conn)
+                elif not exc_type:
+                    self.database.liveness.verified(conn)
             self.database.__exit__(exc_type,exc_val,exc_tb)
             logger.debug("{}: {}- Disconnect to database".format(id(threading.current_thread()),self.database))
 
         _localdata.active_context -= 1
 
 class IsActiveMixin(object):
+    def __init__(self,*args,liveness=None,**kwargs):
+        """
+        liveness: the LivenessStrategy to decide whether to check the connection when connecting with check_active; default is AlwaysCheck
+        """
+        self.liveness = liveness or AlwaysCheck()
+        super().__init__(*args,**kwargs)
+
     @property
     def is_active(self):
         try:
@@ -46,6 +187,13 @@ class IsActiveMixin(object):
         if self.is_closed():
             raise peewee.ProgrammingError("Database is closed")
         self.execute_sql("SELECT 1;")
+        self.liveness.verified(self.connection())
+
+    def should_check_active(self):
+        """
+        Return True if the current connection should be checked according to the liveness strategy
+        """
+        return self.is_closed() or self.liveness.should_check(self.connection())
 
     def active_context(self):
         return ActiveContext(self)
@@ -64,6 +212,10 @@ class PostgresqlExtDatabase(IsActiveMixin,playhouse.postgres_ext.PostgresqlExtDa
     def active_connect(self):
         return self.connect(reuse_if_open=True,check_active=True)
 
+    def _close(self,conn):
+        self.liveness.forget(conn)
+        return super()._close(conn)
+
     def connect(self,reuse_if_open=False,check_active=False):
         if not check_active:
             #use the original logic to get connection
@@ -71,6 +223,8 @@ class PostgresqlExtDatabase(IsActiveMixin,playhouse.postgres_ext.PostgresqlExtDa
         else:
             closed =  self.is_closed()
             result = super().connect(reuse_if_open)
+            if not self.should_check_active():
+                return result
             try:
                 self.check_active()
                 return result
@@ -94,7 +248,147 @@ class PostgresqlExtDatabase(IsActiveMixin,playhouse.postgres_ext.PostgresqlExtDa
                     raise
 
 
+class PoolStats(object):
+    """
+    The checkout statistics of a connection pool
+    """
+    #the upper bounds(milliseconds) of the wait time histogram buckets; the last bucket is for the longer wait time
+    WAIT_BUCKETS = (1,5,10,50,100,500,1000,5000)
+
+    def __init__(self,rate_window=60):
+        """
+        rate_window: the seconds used to compute the checkouts per second
+        """
+        self._lock = threading.Lock()
+        self._rate_window = rate_window
+        self.checkouts = 0
+        self.waits = 0
+        self.timeouts = 0
+        self.wait_histogram = [0] * (len(self.WAIT_BUCKETS) + 1)
+        #the checkout counts per second in the rate window, [second,count]
+        self._rates = collections.deque()
+
+    def record_checkout(self,wait_time,waited):
+        """
+        wait_time: the seconds to get the connection
+        waited: True if the pool was exhausted and the checkout had to wait for a connection
+        """
+        now = int(time.time())
+        wait_time = wait_time * 1000
+        with self._lock:
+            self.checkouts += 1
+            if waited:
+                self.waits += 1
+            for i,bucket in enumerate(self.WAIT_BUCKETS):
+                if wait_time <= bucket:
+                    self.wait_histogram[i] += 1
+                    break
+            else:
+                self.wait_histogram[-1] += 1
+            if self._rates and self._rates[-1][0] == now:
+                self._rates[-1][1] += 1
+            else:
+                self._rates.append([now,1])
+            self._expire(now)
+
+    def record_timeout(self):
+        with self._lock:
+            self.waits += 1
+            self.timeouts += 1
+
+    def _expire(self,now):
+        while self._rates and self._rates[0][0] <= now - self._rate_window:
+            self._rates.popleft()
+
+    @property
+    def checkouts_per_second(self):
+        now = int(time.time())
+        with self._lock:
+            self._expire(now)
+            return sum(count for second,count in self._rates) / self._rate_window
+
+    def reset(self):
+        with self._lock:
+            self.checkouts = 0
+            self.waits = 0
+            self.timeouts = 0
+            self.wait_histogram = [0] * (len(self.WAIT_BUCKETS) + 1)
+            self._rates.clear()
+
+    def as_dict(self):
+        with self._lock:
+            result = {
+                "checkouts":self.checkouts,
+                "waits":self.waits,
+                "timeouts":self.timeouts,
+                "wait_histogram":collections.OrderedDict(
+                    [("<={}ms".format(bucket),count) for bucket,count in zip(self.WAIT_BUCKETS,self.wait_histogram)] + 
+                    [(">{}ms".format(self.WAIT_BUCKETS[-1]),self.wait_histogram[-1])]
+                )
+            }
+        result["checkouts_per_second"] = self.checkouts_per_second
+        return result
+
 class PooledPostgresqlExtDatabase(IsActiveMixin,playhouse.pool.PooledPostgresqlExtDatabase):
+    def __init__(self,*args,**kwargs):
+        self.pool_stats = PoolStats()
+        super().__init__(*args,**kwargs)
+
+    @property
+    def stats(self):
+        """
+        Return the live statistics of the pool
+        """
+        result = self.pool_stats.as_dict()
+        result["in_use"] = len(self._in_use)
+        result["idle"] = len(self._connections)
+        result["max_connections"] = self._max_connections
+        return result
+
+    def prewarm(self,connections):
+        """
+        Open connections until the pool has at least 'connections' idle connections; the total number of connections is limited by max_connections.
+        Return the number of idle connections
+        """
+        conns = []
+        with self._lock:
+            try:
+                while len(conns) < connections:
+                    try:
+                        conns.append(self._connect())
+                    except playhouse.pool.MaxConnectionsExceeded:
+                        break
+            finally:
+                for conn in conns:
+                    self.liveness.verified(conn)
+                    self._close(conn)
+        logger.debug("{}: Prewarmed {} connections".format(self,len(conns)))
+        return len(self._connections)
+
+    def _connect(self):
+        try:
+            return super()._connect()
+        except playhouse.pool.MaxConnectionsExceeded:
+            #the pool is exhausted, the checkout has to wait
+            _localdata.pool_waited = True
+            raise
+
+    def _checkout(self,reuse_if_open):
+        """
+        Get a connection from the pool and record the statistics
+        """
+        if not self.is_closed():
+            return super().connect(reuse_if_open=reuse_if_open)
+        _localdata.pool_waited = False
+        start = time.time()
+        try:
+            result = super().connect(reuse_if_open=reuse_if_open)
+        except playhouse.pool.MaxConnectionsExceeded:
+            self.pool_stats.record_timeout()
+            raise
+        self.pool_stats.record_checkout(time.time() - start,_localdata.pool_waited)
+        return result
+
     def clean_if_inactive(self):
         """
         Return True if cleaned; else return False
@@ -114,15 +408,23 @@ class PooledPostgresqlExtDatabase(IsActiveMixin,playhouse.pool.PooledPostgresqlE
     def active_connect(self):
         return self.connect(reuse_if_open=True,check_active=True)
 
+    def _close(self,conn,close_conn=False):
+        if close_conn:
+            self.liveness.forget(conn)
+        return super()._close(conn,close_conn=close_conn)
+
     def connect(self,reuse_if_open=False,check_active=False):
-        result = super().connect(reuse_if_open=reuse_if_open)
+        result = self._checkout(reuse_if_open)
         if not check_active:
             return result
+        elif not self.should_check_active():
+            #the connection is known to be working recently
+            return result
         else:
             if self.clean_if_inactive():
                 #connection is inactive,reget again.
                 print("cleaned broken connection pool")
-                result = super().connect()
+                result = self._checkout(False)
                 #check connection again, if failed, database is not running or have connection issue.
                 self.check_active()
                 return result
@@ -15,5 +15,8 @@ setup(
         'pytz==2019.3',
         'psycopg2==2.8.4',
         'peewee==3.13.1'
-    ]
+    ],
+    extras_require={
+        'aio':['asyncpg==0.20.1']
+    }
 )